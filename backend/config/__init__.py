@@ -1,3 +1,8 @@
 """
 Django configuration package.
-""" 
\ No newline at end of file
+"""
+
+# Load the Celery app so shared tasks use its broker configuration
+from .celery import app as celery_app
+
+__all__ = ('celery_app',)
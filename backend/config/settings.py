@@ -171,6 +171,15 @@ CORS_ALLOWED_ORIGINS = os.environ.get(
 
 CORS_ALLOW_CREDENTIALS = True
 
+# Raw chunk uploads describe the chunk in request headers
+from corsheaders.defaults import default_headers
+CORS_ALLOW_HEADERS = (
+    *default_headers,
+    'x-chunk-index',
+    'x-chunk-offset',
+    'x-chunk-checksum',
+)
+
 # Celery settings
 CELERY_BROKER_URL = os.environ.get('CELERY_BROKER_URL', 'redis://localhost:6379/0')
 CELERY_RESULT_BACKEND = 'django-db'
@@ -179,10 +188,43 @@ CELERY_ACCEPT_CONTENT = ['application/json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
+CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers:DatabaseScheduler'
+CELERY_BEAT_SCHEDULE = {
+    'sweep-abandoned-uploads': {
+        'task': 'files.tasks.sweep_abandoned_uploads',
+        'schedule': timedelta(hours=1),
+    },
+}
 
 # File upload settings
 MAX_UPLOAD_SIZE = 100 * 1024 * 1024  # 100MB
 CHUNK_SIZE = 1 * 1024 * 1024  # 1MB
+MAX_CHUNK_SIZE = 16 * 1024 * 1024  # Largest chunk size an upload may declare; raw chunks are held in memory up to it
+SMALL_UPLOAD_MAX_SIZE = 4 * 1024 * 1024  # Largest file accepted by the one-shot upload endpoint
+UPLOAD_BATCH_MAX_FILES = 1000  # Most files a single batch upload may allocate
+UPLOAD_SESSION_LIFETIME = timedelta(hours=24)  # Extended while chunks keep arriving
+UPLOAD_PROCESSING_TIMEOUT = timedelta(hours=24)  # How long past its session's expiry a finalizing upload is given before it counts as abandoned
+UPLOAD_SWEEP_BATCH_SIZE = 500  # Abandoned uploads reclaimed per database round trip
+UPLOAD_SWEEP_IO_WORKERS = 8  # Concurrent blob deletions while sweeping
+DELTA_BLOCK_SIZE = 8 * 1024  # Block size of version signatures sent to delta-uploading clients
+VERSION_SNAPSHOT_INTERVAL = 10  # Every Nth version is kept whole, bounding delta chains
+DEDUP_CHUNK_MAX_SIZE = 1 * 1024 * 1024  # Largest content-defined chunk accepted by deduplicated uploads
+DEDUP_QUERY_MAX_HASHES = 10000  # Most chunk hashes one "which do you have" query may ask about
+BULK_JOB_MAX_FILES = 10000  # Most files a single bulk copy/move/delete may select
+BULK_JOB_BATCH_SIZE = 100  # Files per batch of a bulk job; batches run in parallel
+ZIP_DOWNLOAD_MAX_FILES = 1000  # Most files one ZIP download may bundle
+# Stored bytes sent unchanged (client-encrypted files) can be handed off
+# instead of streamed through Python: '' streams them, 'x-accel-redirect'
+# hands them to nginx (see deploy/nginx.conf), 'x-sendfile' to Apache or
+# lighttpd, and 'sendfile' to the WSGI server's file wrapper
+FILE_DELIVERY_OFFLOAD = os.environ.get('FILE_DELIVERY_OFFLOAD', '')
+FILE_DELIVERY_ACCEL_PREFIX = '/protected-media/'  # nginx internal location aliasing MEDIA_ROOT
+DELIVERY_SEGMENT_SIZE = 1024 * 1024  # Unit in which downloads are decrypted, shared by concurrent requests and cached
+CONTENT_CACHE_MEMORY_SIZE = 64 * 1024 * 1024  # Decrypted content kept in memory per process for hot share links; 0 disables the cache
+CONTENT_CACHE_DISK_SIZE = 0  # Optional local-disk tier that memory evictions spill into
+CONTENT_CACHE_DISK_DIR = os.environ.get('CONTENT_CACHE_DISK_DIR')  # Defaults to the system temp directory
+CONTENT_CACHE_TTL = 600  # Seconds a cached segment is served for
+STATUS_POLL_INTERVAL = 1  # Seconds upload and bulk job status responses ask clients to wait (Retry-After) before polling again
 
 # Encryption settings
 ENCRYPTION_ALGORITHM = 'AES'
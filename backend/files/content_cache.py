@@ -0,0 +1,223 @@
+"""
+Short-lived cache of decrypted content for hot downloads.
+
+A popular share link would otherwise open, read and decrypt the same file
+for every visitor. Instead its plaintext is kept in DELIVERY_SEGMENT_SIZE
+segments, in a memory LRU that spills into an optional local-disk tier.
+Nothing is kept in the clear: every entry is sealed with AES-GCM under a
+key that exists only in this process's memory, so the disk tier, or
+anything else that outlives the process, reveals nothing.
+
+Entries are keyed by file id and checksum, so a new version never meets
+the old content, plus a generation kept in the shared Django cache that
+invalidate() bumps, so revocations reach every process. Entries also
+expire after CONTENT_CACHE_TTL, and the least recently used are evicted
+(to disk, then for good) once a tier exceeds its size.
+"""
+import atexit
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from django.conf import settings
+from django.core.cache import cache
+
+from .singleflight import SegmentReader
+
+NONCE_SIZE = 12
+
+class ContentCache:
+    """
+    Thread-safe two-tier LRU of byte strings, sealed under an ephemeral
+    key. Keys are tuples whose first element is the file id.
+    """
+
+    def __init__(self, memory_size, disk_size=0, disk_dir=None, ttl=600):
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.ttl = ttl
+        self._aead = AESGCM(AESGCM.generate_key(bit_length=256))
+        self._lock = threading.Lock()
+        # key -> (expires, sealed bytes) and key -> (expires, size, path)
+        self._memory = OrderedDict()
+        self._disk = OrderedDict()
+        self._memory_used = self._disk_used = 0
+        self._disk_dir = None
+        if disk_size:
+            self._disk_dir = tempfile.mkdtemp(prefix='content-cache-', dir=disk_dir)
+            atexit.register(shutil.rmtree, self._disk_dir, True)
+
+    def _aad(self, key):
+        return repr(key).encode()
+
+    def _seal(self, key, value):
+        nonce = os.urandom(NONCE_SIZE)
+        return nonce + self._aead.encrypt(nonce, value, self._aad(key))
+
+    def _open(self, key, sealed):
+        return self._aead.decrypt(sealed[:NONCE_SIZE], sealed[NONCE_SIZE:], self._aad(key))
+
+    def get(self, key):
+        """The value stored under key, or None if absent or expired."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry:
+                if entry[0] > now:
+                    self._memory.move_to_end(key)
+                    return self._open(key, entry[1])
+                self._drop_memory(key)
+            entry = self._disk.pop(key, None)
+        if not entry:
+            return None
+
+        expires, size, path = entry
+        try:
+            with open(path, 'rb') as f:
+                sealed = f.read()
+            os.remove(path)
+        except OSError:
+            sealed = None
+        with self._lock:
+            self._disk_used -= size
+            if sealed is None or expires <= now:
+                return None
+            # Promoted back into memory
+            self._put_memory(key, expires, sealed)
+        return self._open(key, sealed)
+
+    def put(self, key, value):
+        sealed = self._seal(key, value)
+        if len(sealed) > self.memory_size:
+            return
+        with self._lock:
+            self._drop_memory(key)
+            self._put_memory(key, time.monotonic() + self.ttl, sealed)
+
+    def discard(self, file_id):
+        """Drop every entry for file_id."""
+        with self._lock:
+            for key in [key for key in self._memory if key[0] == file_id]:
+                self._drop_memory(key)
+            doomed = [key for key in self._disk if key[0] == file_id]
+            paths = []
+            for key in doomed:
+                _, size, path = self._disk.pop(key)
+                self._disk_used -= size
+                paths.append(path)
+        for path in paths:
+            self._remove(path)
+
+    def clear(self):
+        with self._lock:
+            paths = [path for _, _, path in self._disk.values()]
+            self._memory.clear()
+            self._disk.clear()
+            self._memory_used = self._disk_used = 0
+        for path in paths:
+            self._remove(path)
+
+    def _drop_memory(self, key):
+        entry = self._memory.pop(key, None)
+        if entry:
+            self._memory_used -= len(entry[1])
+
+    def _put_memory(self, key, expires, sealed):
+        # Called with the lock held
+        self._memory[key] = (expires, sealed)
+        self._memory_used += len(sealed)
+        now = time.monotonic()
+        while self._memory_used > self.memory_size:
+            old_key, (old_expires, old_sealed) = self._memory.popitem(last=False)
+            self._memory_used -= len(old_sealed)
+            if old_expires > now:
+                self._put_disk(old_key, old_expires, old_sealed)
+
+    def _put_disk(self, key, expires, sealed):
+        # Called with the lock held; entries are already sealed, so the
+        # write does not need to be atomic with respect to readers
+        if not self._disk_dir or len(sealed) > self.disk_size:
+            return
+        stale = self._disk.pop(key, None)
+        if stale:
+            self._disk_used -= stale[1]
+        path = os.path.join(self._disk_dir, hashlib.sha256(self._aad(key)).hexdigest())
+        try:
+            with open(path, 'wb') as f:
+                f.write(sealed)
+        except OSError:
+            return
+        self._disk[key] = (expires, len(sealed), path)
+        self._disk_used += len(sealed)
+        while self._disk_used > self.disk_size:
+            _, (_, size, old_path) = self._disk.popitem(last=False)
+            self._disk_used -= size
+            self._remove(old_path)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def content_cache():
+    """
+    This process's ContentCache, or None when CONTENT_CACHE_MEMORY_SIZE is
+    0. A forked worker gets a fresh cache and key rather than sharing its
+    parent's.
+    """
+    global _cache
+    config = (
+        os.getpid(), settings.CONTENT_CACHE_MEMORY_SIZE, settings.CONTENT_CACHE_DISK_SIZE,
+        settings.CONTENT_CACHE_DISK_DIR, settings.CONTENT_CACHE_TTL
+    )
+    with _cache_lock:
+        if _cache is None or _cache[0] != config:
+            _, memory_size, disk_size, disk_dir, ttl = config
+            instance = ContentCache(memory_size, disk_size, disk_dir, ttl) if memory_size else None
+            _cache = (config, instance)
+        return _cache[1]
+
+def _generation_key(file_id):
+    return f'content-cache-generation:{file_id}'
+
+def cache_generation(file_id):
+    return cache.get(_generation_key(file_id), 0)
+
+def invalidate(file_id):
+    """Forget file_id's cached content in every process."""
+    try:
+        cache.incr(_generation_key(file_id))
+    except ValueError:
+        cache.set(_generation_key(file_id), 1, None)
+    instance = content_cache()
+    if instance:
+        instance.discard(str(file_id))
+
+class CachedReader(SegmentReader):
+    """
+    SegmentReader that keeps finished segments in the content cache and
+    takes them from there, so only segments missing from the cache are
+    decrypted.
+    """
+
+    def __init__(self, file, open_content):
+        self._cache = content_cache()
+        super().__init__(file, open_content)
+
+    def _key_prefix(self, file):
+        return super()._key_prefix(file) + (cache_generation(file.pk),)
+
+    def _lookup(self, key):
+        return self._cache.get(key)
+
+    def _keep(self, key, data):
+        self._cache.put(key, data)
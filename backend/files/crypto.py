@@ -0,0 +1,595 @@
+import os
+from base64 import b64encode, b64decode
+from django.core.files.base import File as DjangoFile
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.keywrap import aes_key_wrap, aes_key_unwrap
+from cryptography.exceptions import InvalidTag
+
+# Size of the plaintext/ciphertext blocks moved through the streaming engine.
+# Peak memory per request is a small multiple of this, independent of file size.
+STREAM_BLOCK_SIZE = 64 * 1024
+
+# On-disk ciphertext format.
+#
+# Legacy blobs (format 0) are bare AES-256-CBC ciphertext; the IV lives in
+# the database and the AES key is PBKDF2(key, iv) with 100,000 iterations.
+#
+# Versioned blobs start with a fixed-size header:
+#   magic (4) | format version (1) | KDF id (1) | nonce (16)
+# The stored key is already 32 random bytes, so a single HKDF expansion
+# salted with the nonce is enough to get a per-file AES key; there is
+# nothing for a slow password KDF to protect.
+#
+# Format 1 follows the header with AES-256-CBC ciphertext, using the nonce
+# as IV.
+#
+# Format 2 is a seekable container of independently authenticated
+# segments. The base header is extended with the plaintext segment size
+# (4 bytes, big endian) and followed by AES-256-GCM segments of exactly
+# segment_size + 16 bytes each, except the last which may be shorter.
+# Segment i therefore starts at a fixed offset, so the header doubles as the
+# segment index. Each segment's GCM nonce is the first 7 bytes of the header
+# nonce, the 4-byte segment counter and a 1-byte "last segment" flag, and
+# the header is bound to every segment as associated data. Reordering,
+# truncating or tampering with any segment fails authentication.
+FORMAT_MAGIC = b'SFSE'
+FORMAT_LEGACY = 0
+FORMAT_CBC_V1 = 1
+FORMAT_SEGMENTED_V2 = 2
+KDF_RAW = 0
+KDF_HKDF_SHA256 = 1
+NONCE_SIZE = 16
+HEADER_SIZE = len(FORMAT_MAGIC) + 2 + NONCE_SIZE
+SEGMENTED_HEADER_SIZE = HEADER_SIZE + 4
+SEGMENT_SIZE = 64 * 1024
+TAG_SIZE = 16
+
+def _decode_key(key):
+    """Return raw key bytes from a base64 string (or pass bytes through)."""
+    if isinstance(key, str):
+        try:
+            return b64decode(key)
+        except Exception:
+            raise ValueError("Invalid encryption key format")
+    return key
+
+def _decode_iv(iv):
+    """Return raw IV bytes from a base64 string (or pass bytes through)."""
+    if isinstance(iv, str):
+        try:
+            iv = b64decode(iv)
+        except Exception:
+            raise ValueError("Invalid IV format")
+    if len(iv) != 16:
+        raise ValueError(f"Invalid IV length: {len(iv)}, expected 16 bytes")
+    return iv
+
+def derive_key(key, salt):
+    """Derive an encryption key using PBKDF2."""
+    if isinstance(key, str):
+        try:
+            key = b64decode(key)
+        except Exception:
+            key = key.encode('utf-8')
+
+    kdf = PBKDF2HMAC(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=salt,
+        iterations=100000,
+    )
+    return kdf.derive(key)
+
+def hkdf_key(key, salt, info):
+    """Derive a 32-byte subkey from a random key with a single HKDF-SHA256."""
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=salt,
+        info=info,
+    ).derive(_decode_key(key))
+
+def header_key(key, kdf_id, nonce, info):
+    """Return the AES key for a versioned blob according to its KDF id."""
+    if kdf_id == KDF_HKDF_SHA256:
+        return hkdf_key(key, nonce, info)
+    if kdf_id == KDF_RAW:
+        return _decode_key(key)
+    raise ValueError(f"Unsupported key derivation id: {kdf_id}")
+
+def pack_header(version, kdf_id, nonce):
+    return FORMAT_MAGIC + bytes([version, kdf_id]) + nonce
+
+def unpack_header(data, expected_nonce=None):
+    """
+    Parse a versioned header from the first HEADER_SIZE bytes of a blob.
+    Returns (version, kdf_id, nonce), or None for a legacy blob.
+    When the database IV is known it must match the header nonce, which
+    rules out legacy ciphertext that merely starts with the magic bytes.
+    """
+    if len(data) < HEADER_SIZE or not data.startswith(FORMAT_MAGIC):
+        return None
+    offset = len(FORMAT_MAGIC)
+    version, kdf_id = data[offset], data[offset + 1]
+    nonce = data[offset + 2:HEADER_SIZE]
+    if expected_nonce is not None and nonce != expected_nonce:
+        return None
+    return version, kdf_id, nonce
+
+CBC_V1_INFO = b'secure-file-share/v1/aes-256-cbc'
+SEGMENTED_V2_INFO = b'secure-file-share/v2/aes-256-gcm-segments'
+
+def iter_file(f, block_size=STREAM_BLOCK_SIZE):
+    """Yield successive blocks read from a binary file-like object."""
+    for block in iter(lambda: f.read(block_size), b""):
+        yield block
+
+class SegmentCipher:
+    """
+    Seals and opens the AES-256-GCM segments of a format 2 container.
+    Segments are independent, so they can be produced or checked in any
+    order given their index.
+    """
+
+    def __init__(self, key, nonce, segment_size=SEGMENT_SIZE, kdf_id=KDF_HKDF_SHA256):
+        self.nonce = nonce
+        self.segment_size = segment_size
+        self.header = (
+            pack_header(FORMAT_SEGMENTED_V2, kdf_id, nonce)
+            + segment_size.to_bytes(4, 'big')
+        )
+        self._aead = AESGCM(header_key(key, kdf_id, nonce, SEGMENTED_V2_INFO))
+
+    @classmethod
+    def from_header(cls, key, data, expected_nonce=None):
+        """Build a cipher from the first SEGMENTED_HEADER_SIZE bytes of a blob."""
+        header = unpack_header(data, expected_nonce)
+        if header is None or header[0] != FORMAT_SEGMENTED_V2:
+            raise ValueError("Not a segmented container")
+        if len(data) < SEGMENTED_HEADER_SIZE:
+            raise ValueError("Truncated container header")
+        _, kdf_id, nonce = header
+        segment_size = int.from_bytes(data[HEADER_SIZE:SEGMENTED_HEADER_SIZE], 'big')
+        if segment_size <= 0:
+            raise ValueError("Invalid container segment size")
+        return cls(key, nonce, segment_size, kdf_id)
+
+    @property
+    def stride(self):
+        """Size of one full encrypted segment on disk."""
+        return self.segment_size + TAG_SIZE
+
+    def segment_offset(self, index):
+        """Byte offset of segment index within the blob."""
+        return SEGMENTED_HEADER_SIZE + index * self.stride
+
+    def plaintext_size(self, blob_size):
+        """Plaintext length of a complete container of blob_size bytes."""
+        body = blob_size - SEGMENTED_HEADER_SIZE
+        if body < TAG_SIZE:
+            raise ValueError("Truncated container")
+        segments = -(-body // self.stride)
+        return body - segments * TAG_SIZE
+
+    def _segment_nonce(self, index, final):
+        return self.nonce[:7] + index.to_bytes(4, 'big') + (b'\x01' if final else b'\x00')
+
+    def seal(self, index, plaintext, final=False):
+        return self._aead.encrypt(self._segment_nonce(index, final), plaintext, self.header)
+
+    def open(self, index, ciphertext, final=False):
+        try:
+            return self._aead.decrypt(self._segment_nonce(index, final), ciphertext, self.header)
+        except InvalidTag:
+            raise ValueError(f"Segment {index} failed authentication - invalid key or corrupted data")
+
+class StreamEncryptor:
+    """
+    Incremental encryptor producing a format 2 segmented container.
+    Feed plaintext with update() and call finalize() once at the end.
+    At most one segment of plaintext is buffered, so memory use does not
+    depend on the file size. The header is emitted ahead of the first
+    segment.
+    """
+
+    def __init__(self, key, iv=None, segment_size=SEGMENT_SIZE):
+        self.iv = os.urandom(NONCE_SIZE) if iv is None else _decode_iv(iv)
+        self.cipher = SegmentCipher(key, self.iv, segment_size)
+        self._buffer = bytearray()
+        self._index = 0
+        self._header = self.cipher.header
+
+    @property
+    def iv_b64(self):
+        return b64encode(self.iv).decode('utf-8')
+
+    def _emit(self, out):
+        if self._header:
+            out, self._header = self._header + out, b''
+        return out
+
+    def update(self, data):
+        self._buffer += data
+        out = []
+        # Keep at least one byte back: the last segment is sealed differently
+        while len(self._buffer) > self.cipher.segment_size:
+            segment = bytes(self._buffer[:self.cipher.segment_size])
+            del self._buffer[:self.cipher.segment_size]
+            out.append(self.cipher.seal(self._index, segment))
+            self._index += 1
+        return self._emit(b''.join(out))
+
+    def finalize(self):
+        out = self.cipher.seal(self._index, bytes(self._buffer), final=True)
+        self._buffer = bytearray()
+        return self._emit(out)
+
+    def encrypt_iter(self, blocks):
+        """Encrypt an iterable of plaintext blocks, yielding ciphertext blocks."""
+        for block in blocks:
+            out = self.update(block)
+            if out:
+                yield out
+        yield self.finalize()
+
+class _CBCDecryptEngine:
+    """Incremental CBC decryption with PKCS7 unpadding (formats 0 and 1)."""
+
+    def __init__(self, aes_key, iv):
+        self._decryptor = Cipher(algorithms.AES(aes_key), modes.CBC(iv)).decryptor()
+        self._unpadder = padding.PKCS7(128).unpadder()
+
+    def update(self, data):
+        return self._unpadder.update(self._decryptor.update(data))
+
+    def finalize(self):
+        try:
+            tail = self._decryptor.finalize()
+        except Exception:
+            raise ValueError("Decryption failed - invalid key or corrupted data")
+        try:
+            return self._unpadder.update(tail) + self._unpadder.finalize()
+        except Exception:
+            raise ValueError("Invalid padding - decryption failed")
+
+class _SegmentDecryptEngine:
+    """Incremental opening of format 2 segments, verifying each one."""
+
+    def __init__(self, cipher):
+        self.cipher = cipher
+        self._buffer = bytearray()
+        self._index = 0
+
+    def update(self, data):
+        self._buffer += data
+        out = []
+        stride = self.cipher.stride
+        while len(self._buffer) > stride:
+            out.append(self.cipher.open(self._index, bytes(self._buffer[:stride])))
+            del self._buffer[:stride]
+            self._index += 1
+        return b''.join(out)
+
+    def finalize(self):
+        if len(self._buffer) < TAG_SIZE:
+            raise ValueError("Truncated container")
+        out = self.cipher.open(self._index, bytes(self._buffer), final=True)
+        self._buffer = bytearray()
+        return out
+
+class StreamDecryptor:
+    """
+    Incremental decryptor, the counterpart of StreamEncryptor.
+    The format is detected from the first bytes of the blob: versioned
+    blobs carry their own nonce and KDF id, anything else is treated as a
+    legacy blob keyed with PBKDF2 over the database IV.
+    """
+
+    def __init__(self, key, iv=None):
+        self._key = key
+        self._iv = None if iv is None else _decode_iv(iv)
+        self._pending = b''
+        self._engine = None
+        self.format_version = None
+
+    def _start(self, data):
+        header = unpack_header(data, self._iv)
+        if header is None:
+            if self._iv is None:
+                raise ValueError("An IV is required to decrypt legacy data")
+            self.format_version = FORMAT_LEGACY
+            self._engine = _CBCDecryptEngine(derive_key(_decode_key(self._key), self._iv), self._iv)
+            return data
+
+        version, kdf_id, nonce = header
+        if version == FORMAT_CBC_V1:
+            self._engine = _CBCDecryptEngine(header_key(self._key, kdf_id, nonce, CBC_V1_INFO), nonce)
+            data = data[HEADER_SIZE:]
+        elif version == FORMAT_SEGMENTED_V2:
+            self._engine = _SegmentDecryptEngine(SegmentCipher.from_header(self._key, data, self._iv))
+            data = data[SEGMENTED_HEADER_SIZE:]
+        else:
+            raise ValueError(f"Unsupported encryption format version: {version}")
+        self.format_version = version
+        return data
+
+    def update(self, data):
+        if self._engine is None:
+            self._pending += data
+            if len(self._pending) < SEGMENTED_HEADER_SIZE:
+                return b''
+            data, self._pending = self._start(self._pending), b''
+        return self._engine.update(data)
+
+    def finalize(self):
+        head = b''
+        if self._engine is None:
+            data, self._pending = self._start(self._pending), b''
+            head = self._engine.update(data)
+        return head + self._engine.finalize()
+
+    def decrypt_iter(self, blocks):
+        """Decrypt an iterable of ciphertext blocks, yielding plaintext blocks."""
+        for block in blocks:
+            out = self.update(block)
+            if out:
+                yield out
+        tail = self.finalize()
+        if tail:
+            yield tail
+
+class ContainerReader:
+    """
+    Random-access reader over a format 2 container held in a seekable
+    binary file. Only the segments covering a requested range are read
+    and authenticated.
+    """
+
+    def __init__(self, f, key, iv=None, blob_size=None):
+        self._f = f
+        if blob_size is None:
+            f.seek(0, os.SEEK_END)
+            blob_size = f.tell()
+        f.seek(0)
+        self.cipher = SegmentCipher.from_header(
+            key, f.read(SEGMENTED_HEADER_SIZE), None if iv is None else _decode_iv(iv)
+        )
+        self.blob_size = blob_size
+        self.size = self.cipher.plaintext_size(blob_size)
+        self.segment_count = -(-(blob_size - SEGMENTED_HEADER_SIZE) // self.cipher.stride)
+
+    def read_segment(self, index):
+        """Read, authenticate and return the plaintext of one segment."""
+        if not 0 <= index < self.segment_count:
+            raise ValueError(f"Segment {index} out of range")
+        offset = self.cipher.segment_offset(index)
+        self._f.seek(offset)
+        ciphertext = self._f.read(min(self.cipher.stride, self.blob_size - offset))
+        return self.cipher.open(index, ciphertext, final=index == self.segment_count - 1)
+
+    def iter_range(self, start=0, end=None):
+        """Yield the plaintext bytes in [start, end), segment by segment."""
+        end = self.size if end is None else min(end, self.size)
+        if start >= end:
+            return
+        segment_size = self.cipher.segment_size
+        for index in range(start // segment_size, (end - 1) // segment_size + 1):
+            plaintext = self.read_segment(index)
+            base = index * segment_size
+            yield plaintext[max(start - base, 0):end - base]
+
+class ContainerWriter:
+    """
+    Positional writer for a format 2 container held in a seekable binary
+    file opened for update. Runs of segments can be written in any order
+    and by independent writers, since each segment's position and nonce
+    follow from its index alone. For the same reason a segment must never
+    be written again with different plaintext: the repeated key and nonce
+    would give away the XOR of the two plaintexts and the GHASH key.
+    Segments are sealed as non-final; once the total size is known, seal()
+    re-seals the last one (under the distinct final nonce) and trims the
+    file.
+    """
+
+    def __init__(self, f, key, iv):
+        self._f = f
+        self.cipher = SegmentCipher(key, _decode_iv(iv))
+
+    def write_header(self):
+        self._f.seek(0)
+        self._f.write(self.cipher.header)
+
+    def write_segments(self, first_index, blocks):
+        """
+        Encrypt an iterable of plaintext blocks into consecutive segments
+        starting at first_index. Every segment but the last written must be
+        full. Returns the plaintext length written.
+        """
+        segment_size = self.cipher.segment_size
+        self._f.seek(self.cipher.segment_offset(first_index))
+        index, written = first_index, 0
+        buffer = bytearray()
+        for block in blocks:
+            buffer += block
+            while len(buffer) >= segment_size:
+                self._f.write(self.cipher.seal(index, bytes(buffer[:segment_size])))
+                del buffer[:segment_size]
+                index += 1
+            written += len(block)
+        if buffer:
+            self._f.write(self.cipher.seal(index, bytes(buffer)))
+        return written
+
+    def seal(self, size):
+        """
+        Finish a container holding size bytes of plaintext: re-seal its
+        last segment with the final flag and drop anything beyond it.
+        Only that one segment is read, so this is cheap for any size.
+        Sealing a container again rewrites the same bytes.
+        """
+        segment_size = self.cipher.segment_size
+        last = max(size - 1, 0) // segment_size
+        offset = self.cipher.segment_offset(last)
+        plaintext = b''
+        if size:
+            self._f.seek(offset)
+            length = size - last * segment_size + TAG_SIZE
+            ciphertext = self._f.read(length)
+            try:
+                plaintext = self.cipher.open(last, ciphertext)
+            except ValueError:
+                # Sealed already
+                plaintext = self.cipher.open(last, ciphertext, final=True)
+        self._f.seek(offset)
+        self._f.write(self.cipher.seal(last, plaintext, final=True))
+        self._f.truncate()
+
+class CBCReader:
+    """
+    Random-access reader over a format 0 or 1 (AES-256-CBC) blob held in a
+    seekable binary file. CBC block i only depends on ciphertext blocks i-1
+    and i, so a range is decrypted starting from the block that contains it
+    rather than from the start of the blob.
+    """
+
+    def __init__(self, f, key, iv=None, blob_size=None):
+        self._f = f
+        if blob_size is None:
+            f.seek(0, os.SEEK_END)
+            blob_size = f.tell()
+        iv = None if iv is None else _decode_iv(iv)
+        f.seek(0)
+        header = unpack_header(f.read(HEADER_SIZE), iv)
+        if header is None:
+            if iv is None:
+                raise ValueError("An IV is required to decrypt legacy data")
+            self.format_version, self._data_offset, self._iv = FORMAT_LEGACY, 0, iv
+            aes_key = derive_key(_decode_key(key), iv)
+        else:
+            version, kdf_id, nonce = header
+            if version != FORMAT_CBC_V1:
+                raise ValueError(f"Unsupported encryption format version: {version}")
+            self.format_version, self._data_offset, self._iv = version, HEADER_SIZE, nonce
+            aes_key = header_key(key, kdf_id, nonce, CBC_V1_INFO)
+        self._algorithm = algorithms.AES(aes_key)
+
+        body = blob_size - self._data_offset
+        if body < 16 or body % 16:
+            raise ValueError("Decryption failed - invalid key or corrupted data")
+        last_block = b''.join(self._decrypt_blocks(body // 16 - 1, body))
+        pad = last_block[-1]
+        if not 1 <= pad <= 16 or last_block[-pad:] != bytes([pad]) * pad:
+            raise ValueError("Invalid padding - decryption failed")
+        self._body = body
+        self.size = body - pad
+
+    def _decrypt_blocks(self, first_block, body_end):
+        """Yield plaintext for ciphertext blocks first_block onwards, up to body_end."""
+        if first_block == 0:
+            iv = self._iv
+            self._f.seek(self._data_offset)
+        else:
+            self._f.seek(self._data_offset + (first_block - 1) * 16)
+            iv = self._f.read(16)
+        decryptor = Cipher(self._algorithm, modes.CBC(iv)).decryptor()
+        remaining = body_end - first_block * 16
+        while remaining > 0:
+            block = self._f.read(min(STREAM_BLOCK_SIZE, remaining))
+            if not block:
+                raise ValueError("Truncated ciphertext")
+            remaining -= len(block)
+            yield decryptor.update(block)
+
+    def iter_range(self, start=0, end=None):
+        """Yield the plaintext bytes in [start, end)."""
+        end = self.size if end is None else min(end, self.size)
+        if start >= end:
+            return
+        first_block = start // 16
+        position = first_block * 16
+        body_end = min(-(-end // 16) * 16, self._body)
+        for plaintext in self._decrypt_blocks(first_block, body_end):
+            block_start = position
+            position += len(plaintext)
+            piece = plaintext[max(start - block_start, 0):end - block_start]
+            if piece:
+                yield piece
+
+class PlainReader:
+    """
+    Random-access reader over a blob that is served as stored: the
+    client's own ciphertext for files in end-to-end mode, which the server
+    never decrypts.
+    """
+
+    def __init__(self, f, blob_size=None):
+        self._f = f
+        if blob_size is None:
+            f.seek(0, os.SEEK_END)
+            blob_size = f.tell()
+        self.size = blob_size
+
+    def iter_range(self, start=0, end=None):
+        """Yield the stored bytes in [start, end)."""
+        end = self.size if end is None else min(end, self.size)
+        self._f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            block = self._f.read(min(STREAM_BLOCK_SIZE, remaining))
+            if not block:
+                raise ValueError("Truncated blob")
+            remaining -= len(block)
+            yield block
+
+def open_reader(f, key, iv=None, blob_size=None):
+    """
+    Return a random-access reader (exposing .size and .iter_range()) for
+    the blob in the seekable binary file f, whatever its format.
+    """
+    f.seek(0)
+    header = unpack_header(f.read(HEADER_SIZE), None if iv is None else _decode_iv(iv))
+    if header is not None and header[0] == FORMAT_SEGMENTED_V2:
+        return ContainerReader(f, key, iv, blob_size)
+    return CBCReader(f, key, iv, blob_size)
+
+def wrap_key(wrapping_key, key):
+    """
+    Wrap a content key under another key (RFC 3394 AES key wrap), so a
+    File record can hold the key to a blob it shares with other records
+    without storing it in the clear. Both keys are base64; so is the result.
+    """
+    return b64encode(aes_key_wrap(_decode_key(wrapping_key), _decode_key(key))).decode('ascii')
+
+def unwrap_key(wrapping_key, wrapped):
+    """Inverse of wrap_key. Raises InvalidUnwrap if either key is wrong."""
+    return b64encode(aes_key_unwrap(_decode_key(wrapping_key), b64decode(wrapped))).decode('ascii')
+
+class StreamingContent(DjangoFile):
+    """
+    A Django File whose content comes from an iterator of byte blocks,
+    so it can be handed to storage.save() without being materialised.
+    """
+
+    def __init__(self, blocks, name=None):
+        super().__init__(None, name)
+        self._blocks = blocks
+
+    def chunks(self, chunk_size=None):
+        yield from self._blocks
+
+    def __iter__(self):
+        return self.chunks()
+
+    def multiple_chunks(self, chunk_size=None):
+        return True
+
+    def open(self, mode=None):
+        return self
+
+    def close(self):
+        pass
@@ -0,0 +1,227 @@
+"""
+Deduplicated uploads of content-defined chunks.
+
+The client cuts a file into chunks wherever a rolling gear hash of the
+content hits a boundary pattern, so an edit only moves the boundaries
+next to it and the same data yields the same chunks in any file. It then
+asks which chunks' SHA-256 hashes the server already holds, uploads only
+the others, and commits the file as the ordered list of hashes.
+
+Chunks are stored once per owner. The index uses an HMAC of the SHA-256
+under a key derived for that owner, so identical content belonging to
+different owners is stored separately and an owner cannot learn anything
+about anyone else's data by asking about hashes. The committed file is a
+chunked Blob; copies and versions then share and release it like any
+other blob.
+"""
+import bisect
+import hashlib
+import hmac
+import uuid
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+
+from .crypto import StreamEncryptor, StreamingContent, open_reader
+from .exceptions import ChunkMissingError, ChunkUploadError, FileNotFoundError, FileSizeError
+from .models import Blob, BlobChunk, ContentChunk, File, FileVersion
+from .utils import combine_chunk_hashes, generate_encrypted_path, generate_encryption_key
+
+# Reference chunking parameters; the server accepts any boundaries up to
+# DEDUP_CHUNK_MAX_SIZE, but clients should cut the same way to share chunks
+CHUNK_MIN_SIZE = 16 * 1024
+CHUNK_AVG_SIZE = 64 * 1024
+CHUNK_MAX_SIZE = 256 * 1024
+
+GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], 'big') for i in range(256)]
+
+def content_defined_chunks(data, min_size=CHUNK_MIN_SIZE, avg_size=CHUNK_AVG_SIZE,
+                           max_size=CHUNK_MAX_SIZE):
+    """
+    Split data at content-defined boundaries (a gear hash whose low bits
+    are all zero, FastCDC style). Returns the list of chunks.
+    """
+    mask = avg_size - 1
+    chunks = []
+    start = 0
+    while start < len(data):
+        end = min(start + max_size, len(data))
+        position = min(start + min_size, end)
+        h = 0
+        while position < end:
+            h = ((h << 1) + GEAR[data[position]]) & 0xffffffff
+            position += 1
+            if not h & mask:
+                break
+        chunks.append(data[start:position])
+        start = position
+    return chunks
+
+def owner_chunk_digest(owner_id, checksum):
+    """Index key of a chunk with hex SHA-256 checksum, for owner_id only."""
+    owner_key = hmac.new(
+        settings.SECRET_KEY.encode(), f'dedup:{owner_id}'.encode(), hashlib.sha256
+    ).digest()
+    return hmac.new(owner_key, bytes.fromhex(checksum), hashlib.sha256).hexdigest()
+
+def is_checksum(value):
+    return isinstance(value, str) and len(value) == 64 and all(c in '0123456789abcdef' for c in value)
+
+def held_chunks(owner, checksums):
+    """The subset of checksums owner already has stored chunks for."""
+    digests = {owner_chunk_digest(owner.pk, checksum): checksum for checksum in checksums}
+    found = ContentChunk.objects.filter(owner=owner, digest__in=digests).values_list('digest', flat=True)
+    return {digests[digest] for digest in found}
+
+def store_chunk(owner, checksum, blocks):
+    """
+    Encrypt a chunk's plaintext blocks into storage under its own key,
+    unless owner already holds it. Returns the ContentChunk and whether
+    it was stored now; raises ChunkUploadError if the content does not
+    hash to checksum.
+    """
+    digest = owner_chunk_digest(owner.pk, checksum)
+    chunk = ContentChunk.objects.filter(owner=owner, digest=digest).first()
+    if chunk:
+        return chunk, False
+
+    hasher = hashlib.sha256()
+    size = 0
+
+    def plaintext_blocks():
+        nonlocal size
+        for block in blocks:
+            hasher.update(block)
+            size += len(block)
+            yield block
+
+    key = generate_encryption_key()
+    encryptor = StreamEncryptor(key)
+    path = default_storage.save(
+        f"files/{owner.pk}/chunks/{uuid.uuid4()}",
+        StreamingContent(encryptor.encrypt_iter(plaintext_blocks()))
+    )
+    if hasher.hexdigest() != checksum:
+        default_storage.delete(path)
+        raise ChunkUploadError("Chunk checksum mismatch")
+
+    chunk, created = ContentChunk.objects.get_or_create(
+        owner=owner,
+        digest=digest,
+        defaults={'size': size, 'path': path, 'encryption_key': key, 'iv': encryptor.iv_b64}
+    )
+    if not created:
+        # Another request stored the same chunk first
+        default_storage.delete(path)
+    return chunk, created
+
+def commit_chunked_file(owner, checksums, name, mime_type, description='', tags=()):
+    """
+    Create a completed File whose content is owner's stored chunks with
+    the given checksums, in order. Raises ChunkMissingError if any are
+    not stored.
+    """
+    digests = [owner_chunk_digest(owner.pk, checksum) for checksum in checksums]
+    with transaction.atomic():
+        # Lock the chunks so none is released and deleted under us
+        chunks = {
+            chunk.digest: chunk for chunk in
+            ContentChunk.objects.select_for_update().filter(owner=owner, digest__in=set(digests))
+        }
+        missing = len([digest for digest in digests if digest not in chunks])
+        if missing:
+            raise ChunkMissingError(f"Missing {missing} of {len(digests)} chunks")
+        size = sum(chunks[digest].size for digest in digests)
+        if size > settings.MAX_UPLOAD_SIZE:
+            raise FileSizeError()
+
+        # One reference for the file and one for its initial version
+        blob_id = uuid.uuid4()
+        blob = Blob.objects.create(id=blob_id, path=f"chunked/{blob_id}", chunked=True, ref_count=2)
+        entries, offset = [], 0
+        for index, digest in enumerate(digests):
+            entries.append(BlobChunk(blob=blob, index=index, offset=offset, chunk=chunks[digest]))
+            offset += chunks[digest].size
+        BlobChunk.objects.bulk_create(entries)
+        ContentChunk.acquire(chunks[digest].pk for digest in digests)
+
+        encryption_key = generate_encryption_key()
+        file = File.objects.create(
+            owner=owner,
+            name=name,
+            original_name=name,
+            mime_type=mime_type,
+            size=size,
+            encryption_key=encryption_key,
+            encrypted_path=generate_encrypted_path(name),
+            blob=blob,
+            iv='',
+            checksum=combine_chunk_hashes(checksums),
+            checksum_algorithm=File.ChecksumAlgorithm.SHA256_CDC_TREE,
+            status=File.Status.COMPLETED,
+            upload_completed_at=timezone.now(),
+            description=description,
+            tags=list(tags)
+        )
+        FileVersion.objects.create(
+            file=file,
+            version_number=1,
+            encrypted_path=file.encrypted_path,
+            encryption_key=file.encryption_key,
+            blob=blob,
+            iv=file.iv,
+            checksum=file.checksum,
+            checksum_algorithm=file.checksum_algorithm,
+            size=file.size,
+            created_by=owner
+        )
+    return file
+
+def unreferenced_chunks(now):
+    """Chunks uploaded but never committed to a file, long enough ago to reclaim."""
+    return ContentChunk.objects.filter(
+        ref_count=0, created_at__lte=now - settings.UPLOAD_SESSION_LIFETIME
+    )
+
+class ChunkedReader:
+    """
+    Random-access reader (exposing .size and .iter_range()) over a chunked
+    Blob. Raises FileNotFoundError if any chunk is missing from storage.
+    """
+
+    def __init__(self, blob):
+        self._entries = list(blob.chunks.select_related('chunk'))
+        for entry in self._entries:
+            if not default_storage.exists(entry.chunk.path):
+                raise FileNotFoundError()
+        self._starts = [entry.offset for entry in self._entries]
+        last = self._entries[-1] if self._entries else None
+        self.size = last.offset + last.chunk.size if last else 0
+        self._open = None
+
+    def _reader(self, index):
+        if self._open and self._open[0] == index:
+            return self._open[2]
+        self.close()
+        chunk = self._entries[index].chunk
+        f = default_storage.open(chunk.path, 'rb')
+        self._open = (index, f, open_reader(f, chunk.encryption_key, chunk.iv))
+        return self._open[2]
+
+    def iter_range(self, start=0, end=None):
+        end = self.size if end is None else min(end, self.size)
+        index = max(bisect.bisect_right(self._starts, start) - 1, 0)
+        while start < end and index < len(self._entries):
+            entry = self._entries[index]
+            lo = start - entry.offset
+            hi = min(end - entry.offset, entry.chunk.size)
+            yield from self._reader(index).iter_range(lo, hi)
+            start = entry.offset + hi
+            index += 1
+
+    def close(self):
+        if self._open:
+            self._open[1].close()
+            self._open = None
@@ -0,0 +1,207 @@
+import logging
+import mimetypes
+import time
+from urllib.parse import quote
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.http import FileResponse, HttpResponse
+
+from .content_cache import CachedReader, content_cache
+from .crypto import open_reader
+from .exceptions import FileNotFoundError
+from .ranges import set_range_headers, stream_response
+from .singleflight import SegmentReader
+from .versions import VersionReader
+
+logger = logging.getLogger(__name__)
+
+# Header policies. Every download endpoint picks one of these rather than
+# setting its own headers, so files and share links behave the same way.
+INLINE = 'inline'
+ATTACHMENT = 'attachment'
+VIEW_ONLY = 'view_only'
+
+_NO_STORE_HEADERS = {
+    'X-Content-Type-Options': 'nosniff',
+    'Cache-Control': 'no-store, no-cache, must-revalidate, max-age=0',
+    'Pragma': 'no-cache',
+}
+
+_POLICY_HEADERS = {
+    INLINE: {
+        **_NO_STORE_HEADERS,
+        'Content-Security-Policy': "default-src 'self'",
+    },
+    ATTACHMENT: {
+        **_NO_STORE_HEADERS,
+        'Content-Security-Policy': "default-src 'self'",
+    },
+    VIEW_ONLY: {
+        **_NO_STORE_HEADERS,
+        'Content-Security-Policy': "default-src 'self'; object-src 'none'",
+        'X-Frame-Options': 'SAMEORIGIN',
+        # Discourage browsers from offering to save the content
+        'X-Download-Options': 'noopen',
+        'X-Permitted-Cross-Domain-Policies': 'none',
+    },
+}
+
+# Ways of handing stored bytes to someone who can send them without
+# copying them through Python (FILE_DELIVERY_OFFLOAD)
+X_ACCEL_REDIRECT = 'x-accel-redirect'
+X_SENDFILE = 'x-sendfile'
+SENDFILE = 'sendfile'
+
+def resolve_content_type(file):
+    """The stored MIME type, falling back to a guess from the file name."""
+    if file.client_encrypted:
+        # Only the client can make sense of the bytes
+        return 'application/octet-stream'
+    if file.mime_type and file.mime_type != 'application/octet-stream':
+        return file.mime_type
+    return mimetypes.guess_type(file.name)[0] or 'application/octet-stream'
+
+def content_disposition(policy, filename):
+    if policy == VIEW_ONLY:
+        return 'inline'
+    return f'{policy}; filename="{filename}"'
+
+def offload_response(request, file, path, content_type):
+    """
+    A response that leaves sending the object stored at path, unchanged,
+    to the front proxy or the WSGI server as FILE_DELIVERY_OFFLOAD says,
+    or None when it has to be streamed here after all: offloading is off,
+    the storage has no local files, or the WSGI server would be asked for
+    a range. The proxies serve ranges of the object themselves.
+    """
+    mode = settings.FILE_DELIVERY_OFFLOAD
+    if not mode:
+        return None
+    try:
+        full_path = default_storage.path(path)
+    except NotImplementedError:
+        return None
+
+    if mode == X_ACCEL_REDIRECT:
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = settings.FILE_DELIVERY_ACCEL_PREFIX + quote(path)
+    elif mode == X_SENDFILE:
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = full_path
+    elif mode == SENDFILE and not request.META.get('HTTP_RANGE'):
+        # Served through wsgi.file_wrapper, which can use os.sendfile
+        response = FileResponse(open(full_path, 'rb'), content_type=content_type)
+    else:
+        return None
+    return set_range_headers(response, file)
+
+def open_content(file):
+    """A closeable handle and a reader on file's current, decrypted content."""
+    if file.blob_id and file.blob.chunked:
+        reader = VersionReader(file)
+        return reader, reader
+    file_path = file.get_file_path()
+    if not default_storage.exists(file_path):
+        raise FileNotFoundError()
+    f = default_storage.open(file_path, 'rb')
+    try:
+        return f, open_reader(f, file.content_key(), file.iv)
+    except Exception:
+        f.close()
+        raise
+
+def apply_policy(response, policy, filename):
+    """Set the Content-Disposition and headers of policy on response."""
+    response['Content-Disposition'] = content_disposition(policy, filename)
+    for header, value in _POLICY_HEADERS[policy].items():
+        response[header] = value
+    return response
+
+def _timed(content, metrics):
+    """Pass the body through, logging how long it took to send once done."""
+    try:
+        for block in content:
+            metrics['bytes'] += len(block)
+            yield block
+    finally:
+        metrics['stream_ms'] = (time.perf_counter() - metrics['started']) * 1000
+        _log_metrics(metrics)
+
+def _log_metrics(metrics):
+    logger.info(
+        'delivery file=%s policy=%s status=%s bytes=%s open_ms=%.2f stream_ms=%.2f',
+        metrics['file'], metrics['policy'], metrics['status'], metrics['bytes'],
+        metrics['open_ms'], metrics.get('stream_ms', 0.0)
+    )
+
+def deliver_file(request, file, policy=ATTACHMENT, filename=None, version=None, cached=False):
+    """
+    Build the response for downloading or viewing file. This is the one
+    download path shared by the files and sharing apps: it looks the blob
+    up in storage, streams the decrypted content (honouring Range
+    requests), resolves the content type and applies the header policy.
+    Raises FileNotFoundError when the blob is missing from storage; access
+    checks and bookkeeping are left to the caller. Pass one of file's
+    versions as version to deliver that instead of the current content.
+    Content kept as a delta or as deduplicated chunks is reassembled as
+    it is streamed, while client-encrypted content, sent exactly as
+    stored, can be offloaded (see offload_response). Concurrent deliveries
+    of the same current content share one decryption (files.singleflight).
+    Pass cached=True for
+    content many visitors are likely to fetch, such as public share
+    links, to serve it through the content cache (files.content_cache).
+
+    Each delivery is logged with the time spent opening the blob (also
+    sent as a Server-Timing header) and the time spent streaming it.
+    """
+    started = time.perf_counter()
+    offloaded = False
+    if version is None and file.checksum and not file.client_encrypted:
+        # Concurrent requests for the same content share its decryption
+        reader_class = CachedReader if cached and content_cache() else SegmentReader
+        reader = reader_class(file, lambda: open_content(file))
+        response = stream_response(
+            request, reader, file, content_type=resolve_content_type(file), reader=reader
+        )
+    elif version is not None or file.blob_id and file.blob.chunked:
+        reader = VersionReader(version or file)
+        response = stream_response(
+            request, reader, version or file,
+            content_type=resolve_content_type(file), reader=reader
+        )
+    else:
+        file_path = file.get_file_path()
+        if not default_storage.exists(file_path):
+            raise FileNotFoundError()
+
+        response = None
+        if file.client_encrypted:
+            response = offload_response(request, file, file_path, resolve_content_type(file))
+        offloaded = response is not None
+        if not offloaded:
+            response = stream_response(
+                request, default_storage.open(file_path, 'rb'), file,
+                content_type=resolve_content_type(file)
+            )
+    apply_policy(response, policy, filename or file.name)
+
+    open_ms = (time.perf_counter() - started) * 1000
+    response['Server-Timing'] = f'open;dur={open_ms:.2f}'
+    metrics = {
+        'file': file.id,
+        'policy': policy,
+        'status': response.status_code,
+        'bytes': 0,
+        'open_ms': open_ms,
+        'started': started,
+    }
+    if offloaded:
+        # Sent elsewhere; wrapping the body would also defeat sendfile
+        metrics['bytes'] = file.size
+        _log_metrics(metrics)
+    elif response.streaming:
+        response.streaming_content = _timed(response.streaming_content, metrics)
+    else:
+        metrics['bytes'] = len(response.content)
+        _log_metrics(metrics)
+    return response
@@ -0,0 +1,277 @@
+"""
+Delta encoding of file versions, rsync style.
+
+A client uploading a new version first fetches the signature of the
+current version: a weak rolling checksum and a strong hash for each
+fixed-size block. It slides a window over its new content, and wherever
+the rolling checksum and then the strong hash match a block it refers to
+that block instead of sending it. The upload is a stream of operations:
+
+    COPY     0x00 | offset (8) | length (8)   bytes of the current version
+    LITERAL  0x01 | length (8) | data          bytes sent in full
+
+with integers big endian. compute_delta is the reference implementation of
+the client side.
+
+On the server the new version is stored in full, since it is the one
+downloads read, and the previous version is rewritten as a delta against
+it (see invert_copies). Stored deltas use a seekable layout so a version
+can be read back a range at a time:
+
+    magic (4) | format (1) | op count (4) | ops | literal section
+
+where each op is type (1) | offset (8) | length (8), and a LITERAL's
+offset points into the literal section.
+"""
+import bisect
+import hashlib
+import struct
+from itertools import accumulate
+
+from .exceptions import FileVersionError
+
+COPY = 0
+LITERAL = 1
+
+DELTA_MAGIC = b'SFSD'
+DELTA_FORMAT = 1
+_DELTA_HEADER = struct.Struct('>4sBI')
+_STORED_OP = struct.Struct('>BQQ')
+_COPY_ARGS = struct.Struct('>QQ')
+_LENGTH = struct.Struct('>Q')
+
+_MOD = 1 << 16
+
+def weak_checksum(block):
+    """rsync's rolling checksum of a block, as a 32-bit integer."""
+    # b weights byte i by (length - i), which is the sum of the prefix sums
+    return (sum(block) % _MOD) | ((sum(accumulate(block)) % _MOD) << 16)
+
+def strong_hash(block):
+    return hashlib.sha256(block).hexdigest()[:32]
+
+class SignatureBuilder:
+    """Build a block signature from content fed in pieces of any size."""
+
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self.blocks = []
+        self._pending = b''
+
+    def update(self, data):
+        data = self._pending + data
+        cut = len(data) - len(data) % self.block_size
+        for i in range(0, cut, self.block_size):
+            block = data[i:i + self.block_size]
+            self.blocks.append([weak_checksum(block), strong_hash(block)])
+        self._pending = data[cut:]
+
+    def finalize(self):
+        if self._pending:
+            self.blocks.append([weak_checksum(self._pending), strong_hash(self._pending)])
+            self._pending = b''
+        return self.blocks
+
+def compute_delta(signature, block_size, base_size, data):
+    """
+    Express data as COPY and LITERAL operations against the base_size
+    bytes of content signature describes. Returns a list of
+    (COPY, offset, length) and (LITERAL, bytes) tuples, with adjacent
+    operations merged.
+    """
+    full_blocks = base_size // block_size
+    index = {}
+    for number, (weak, strong) in enumerate(signature[:full_blocks]):
+        index.setdefault(weak, []).append((strong, number))
+
+    ops = []
+
+    def emit_copy(offset, length):
+        if ops and ops[-1][0] == COPY and ops[-1][1] + ops[-1][2] == offset:
+            ops[-1] = (COPY, ops[-1][1], ops[-1][2] + length)
+        else:
+            ops.append((COPY, offset, length))
+
+    def emit_literal(chunk):
+        if not chunk:
+            return
+        if ops and ops[-1][0] == LITERAL:
+            ops[-1] = (LITERAL, ops[-1][1] + chunk)
+        else:
+            ops.append((LITERAL, chunk))
+
+    size = len(data)
+    position = literal_start = 0
+    a = b = None
+    while position + block_size <= size:
+        window = data[position:position + block_size]
+        if a is None:
+            weak = weak_checksum(window)
+            a, b = weak & 0xffff, weak >> 16
+        match = next((
+            number for strong, number in index.get(a | (b << 16), ())
+            if strong == strong_hash(window)
+        ), None)
+        if match is not None:
+            emit_literal(data[literal_start:position])
+            emit_copy(match * block_size, block_size)
+            position += block_size
+            literal_start = position
+            a = b = None
+            continue
+        # Roll the window one byte forward
+        if position + block_size < size:
+            out, incoming = data[position], data[position + block_size]
+            a = (a - out + incoming) % _MOD
+            b = (b - block_size * out + a) % _MOD
+        position += 1
+
+    # A short final block can only match at the very end
+    tail = base_size - full_blocks * block_size
+    if tail and len(signature) > full_blocks and size - literal_start >= tail:
+        weak, strong = signature[full_blocks]
+        end = data[size - tail:]
+        if weak == weak_checksum(end) and strong == strong_hash(end):
+            emit_literal(data[literal_start:size - tail])
+            emit_copy(full_blocks * block_size, tail)
+            return ops
+    emit_literal(data[literal_start:])
+    return ops
+
+def encode_delta(ops):
+    """Serialize compute_delta's operations in the upload format."""
+    out = []
+    for op in ops:
+        if op[0] == COPY:
+            out.append(bytes([COPY]) + _COPY_ARGS.pack(op[1], op[2]))
+        else:
+            out.append(bytes([LITERAL]) + _LENGTH.pack(len(op[1])) + op[1])
+    return b''.join(out)
+
+def _read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise FileVersionError("Delta ends in the middle of an operation")
+    return data
+
+def apply_delta(stream, base_reader, copies, max_size, block_size=64 * 1024):
+    """
+    Read an uploaded delta from stream and yield the new content it
+    describes, taking COPY ranges from base_reader. Each COPY is recorded
+    in copies as (new offset, base offset, length) for invert_copies.
+    Raises FileVersionError on a malformed delta or one that would exceed
+    max_size bytes.
+    """
+    position = 0
+    while True:
+        op = stream.read(1)
+        if not op:
+            return
+        if op[0] == COPY:
+            offset, length = _COPY_ARGS.unpack(_read_exactly(stream, _COPY_ARGS.size))
+            if offset + length > base_reader.size:
+                raise FileVersionError("Delta copies beyond the end of the base version")
+        elif op[0] == LITERAL:
+            length, = _LENGTH.unpack(_read_exactly(stream, _LENGTH.size))
+        else:
+            raise FileVersionError(f"Unknown delta operation {op[0]}")
+        if position + length > max_size:
+            raise FileVersionError(f"Version exceeds the limit of {max_size} bytes")
+
+        if op[0] == COPY:
+            if length:
+                copies.append((position, offset, length))
+            yield from base_reader.iter_range(offset, offset + length)
+        else:
+            remaining = length
+            while remaining:
+                block = _read_exactly(stream, min(block_size, remaining))
+                remaining -= len(block)
+                yield block
+        position += length
+
+def invert_copies(copies, old_size):
+    """
+    Given the COPY ranges a new version took from the old one, express the
+    old version in terms of the new: returns (COPY, new offset, length) and
+    (LITERAL, old offset, length) operations covering old_size bytes, with
+    literals for whatever the new version did not reuse.
+    """
+    ops = []
+    position = 0
+    for new_offset, old_offset, length in sorted(copies, key=lambda c: c[1]):
+        end = old_offset + length
+        if end <= position:
+            continue
+        if old_offset > position:
+            ops.append((LITERAL, position, old_offset - position))
+            position = old_offset
+        ops.append((COPY, new_offset + position - old_offset, end - position))
+        position = end
+    if position < old_size:
+        ops.append((LITERAL, position, old_size - position))
+    return ops
+
+def stored_delta_size(ops):
+    """Bytes a delta built by invert_copies takes once stored."""
+    literal = sum(length for op, _, length in ops if op == LITERAL)
+    return _DELTA_HEADER.size + len(ops) * _STORED_OP.size + literal
+
+def iter_stored_delta(ops, old_reader):
+    """
+    Yield the stored form of invert_copies' operations, reading the
+    literal section from old_reader.
+    """
+    yield _DELTA_HEADER.pack(DELTA_MAGIC, DELTA_FORMAT, len(ops))
+    literal_offset = 0
+    for op, offset, length in ops:
+        if op == COPY:
+            yield _STORED_OP.pack(COPY, offset, length)
+        else:
+            yield _STORED_OP.pack(LITERAL, literal_offset, length)
+            literal_offset += length
+    for op, offset, length in ops:
+        if op == LITERAL:
+            yield from old_reader.iter_range(offset, offset + length)
+
+class DeltaReader:
+    """
+    Random-access reader (exposing .size and .iter_range()) over content
+    stored as a delta. delta_reader reads the stored delta's plaintext and
+    base_reader the content it refers to.
+    """
+
+    def __init__(self, delta_reader, base_reader):
+        self.delta = delta_reader
+        self.base = base_reader
+        header = b''.join(delta_reader.iter_range(0, _DELTA_HEADER.size))
+        magic, version, count = _DELTA_HEADER.unpack(header)
+        if magic != DELTA_MAGIC or version != DELTA_FORMAT:
+            raise ValueError("Not a stored delta")
+        table_end = _DELTA_HEADER.size + count * _STORED_OP.size
+        table = b''.join(delta_reader.iter_range(_DELTA_HEADER.size, table_end))
+        self._literals = table_end
+        self._ops = []
+        self._starts = []
+        position = 0
+        for i in range(count):
+            op = _STORED_OP.unpack_from(table, i * _STORED_OP.size)
+            self._starts.append(position)
+            self._ops.append(op)
+            position += op[2]
+        self.size = position
+
+    def iter_range(self, start=0, end=None):
+        end = self.size if end is None else min(end, self.size)
+        i = max(bisect.bisect_right(self._starts, start) - 1, 0)
+        while start < end and i < len(self._ops):
+            op, offset, length = self._ops[i]
+            op_start = self._starts[i]
+            lo = start - op_start
+            hi = min(end - op_start, length)
+            if op == COPY:
+                yield from self.base.iter_range(offset + lo, offset + hi)
+            else:
+                yield from self.delta.iter_range(self._literals + offset + lo, self._literals + offset + hi)
+            start = op_start + hi
+            i += 1
@@ -47,6 +47,11 @@ class ChunkUploadError(FileError):
     default_detail = 'An error occurred while uploading file chunk.'
     default_code = 'chunk_upload_error'
 
+class ChunkConflictError(ChunkUploadError):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'The chunk was already uploaded with different content.'
+    default_code = 'chunk_conflict'
+
 class ChunkMissingError(FileError):
     status_code = status.HTTP_400_BAD_REQUEST
     default_detail = 'One or more file chunks are missing.'
@@ -57,6 +62,11 @@ class FileVersionError(FileError):
     default_detail = 'An error occurred while processing file version.'
     default_code = 'file_version_error'
 
+class FileVersionConflictError(FileVersionError):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'The file has a newer version than the one this upload is based on.'
+    default_code = 'file_version_conflict'
+
 class AuthenticationError(APIException):
     """Base exception for authentication-related errors."""
     status_code = status.HTTP_401_UNAUTHORIZED
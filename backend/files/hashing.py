@@ -0,0 +1,36 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Running whole-file hashes of uploads in progress, keyed by file id. hashlib
+# state cannot be persisted, so it lives in the process that received the
+# previous chunk; an upload whose chunks land elsewhere, arrive out of order
+# or outlive the cache simply falls back to a hash of its chunk digests.
+MAX_RUNNING_HASHES = 1024
+
+_lock = threading.Lock()
+_running = OrderedDict()
+
+def claim_running_hash(file_id, chunk_number):
+    """
+    Take the running SHA-256 of an upload if it has consumed exactly the
+    chunks before chunk_number, or start one for chunk 0. Returns None
+    when no usable state exists. The caller owns the returned hash until
+    it hands it back with release_running_hash; any stale state is
+    dropped.
+    """
+    with _lock:
+        entry = _running.pop(file_id, None)
+    if chunk_number == 0:
+        return hashlib.sha256()
+    if entry and entry[0] == chunk_number:
+        return entry[1]
+    return None
+
+def release_running_hash(file_id, next_chunk, hasher):
+    """Keep hasher for the upload's next chunk, evicting the oldest if full."""
+    with _lock:
+        _running[file_id] = (next_chunk, hasher)
+        _running.move_to_end(file_id)
+        while len(_running) > MAX_RUNNING_HASHES:
+            _running.popitem(last=False)
@@ -0,0 +1,105 @@
+"""
+Progress manifests of in-flight chunked uploads.
+
+A manifest records which chunks of an upload have arrived and their SHA-256
+digests. It lives in the cache rather than the database so that receiving a
+chunk costs one cache write: the relational DB is only touched when the
+upload is initialized and when it is committed, at which point the digests
+are copied onto the UploadSession row. Each chunk has its own key, so
+concurrent chunks of one upload never contend for a lock.
+"""
+from base64 import b64encode
+
+from django.conf import settings
+from django.core.cache import cache
+
+def manifest_timeout():
+    # Outlive the session by a margin so a manifest is never lost while
+    # the session still accepts chunks
+    return int(settings.UPLOAD_SESSION_LIFETIME.total_seconds()) + 3600
+
+class UploadManifest:
+    def __init__(self, file_id, chunk_count):
+        self.prefix = f'upload-manifest:{file_id}'
+        self.chunk_count = chunk_count
+
+    def _chunk_key(self, chunk_number):
+        return f'{self.prefix}:chunk:{chunk_number}'
+
+    def _pin_key(self, chunk_number):
+        return f'{self.prefix}:pin:{chunk_number}'
+
+    @property
+    def _sha256_key(self):
+        return f'{self.prefix}:sha256'
+
+    def _keys(self):
+        return (
+            [self._chunk_key(n) for n in range(self.chunk_count)]
+            + [self._pin_key(n) for n in range(self.chunk_count)]
+            + [self._sha256_key]
+        )
+
+    def mark_chunk(self, chunk_number, digest):
+        """
+        Record chunk_number as received with the given hex SHA-256.
+        Returns True if the chunk was not already recorded.
+        """
+        key = self._chunk_key(chunk_number)
+        if cache.add(key, digest, manifest_timeout()):
+            return True
+        cache.set(key, digest, manifest_timeout())
+        return False
+
+    def pin_chunk(self, chunk_number, digest):
+        """
+        Bind chunk_number to the content with the given hex SHA-256 before
+        it is written. Returns False if it is already bound to other
+        content; a binding lasts as long as the manifest, even if the
+        write it preceded never finished.
+        """
+        key = self._pin_key(chunk_number)
+        return cache.add(key, digest, manifest_timeout()) or cache.get(key) == digest
+
+    def chunk_digest(self, chunk_number):
+        """Hex SHA-256 of a received chunk, '' if it has not arrived."""
+        return cache.get(self._chunk_key(chunk_number), '')
+
+    def has_chunk(self, chunk_number):
+        return bool(self.chunk_digest(chunk_number))
+
+    def digests(self):
+        """Map of chunk number to hex SHA-256 for every received chunk."""
+        keys = [self._chunk_key(n) for n in range(self.chunk_count)]
+        found = cache.get_many(keys)
+        return {n: found[key] for n, key in enumerate(keys) if key in found}
+
+    def received_chunks(self):
+        return sorted(self.digests())
+
+    def bitmap(self):
+        """Base64 bitmap, bit n (least significant first) set for chunk n."""
+        bits = bytearray(-(-self.chunk_count // 8))
+        for n in self.digests():
+            bits[n // 8] |= 1 << (n % 8)
+        return b64encode(bytes(bits)).decode('ascii')
+
+    @property
+    def sha256(self):
+        """Whole-file SHA-256, once chunks arriving in order reach the end."""
+        return cache.get(self._sha256_key, '')
+
+    @sha256.setter
+    def sha256(self, value):
+        if value:
+            cache.set(self._sha256_key, value, manifest_timeout())
+        else:
+            cache.delete(self._sha256_key)
+
+    def refresh(self):
+        """Push back the expiry of every entry along with the session's."""
+        for key in self._keys():
+            cache.touch(key, manifest_timeout())
+
+    def delete(self):
+        cache.delete_many(self._keys())
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.7 on 2026-10-17 03:46
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("files", "0002_alter_file_options_alter_filechunk_options_and_more"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UploadSession",
+            fields=[
+                (
+                    "file",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="upload_session",
+                        serialize=False,
+                        to="files.file",
+                    ),
+                ),
+                ("chunk_size", models.PositiveIntegerField()),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                "verbose_name": "upload session",
+                "verbose_name_plural": "upload sessions",
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.7 on 2026-10-17 03:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("files", "0003_upload_session"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="file",
+            name="checksum_algorithm",
+            field=models.CharField(
+                choices=[("SHA256", "SHA-256"), ("SHA256_TREE", "SHA-256 chunk tree")],
+                default="SHA256",
+                max_length=20,
+            ),
+        ),
+        migrations.AddField(
+            model_name="uploadsession",
+            name="sha256",
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-17 03:53
+
+from django.db import migrations, models
+import files.models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("files", "0005_upload_session_error"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="uploadsession",
+            name="expires_at",
+            field=models.DateTimeField(default=files.models.upload_session_expiry),
+        ),
+    ]
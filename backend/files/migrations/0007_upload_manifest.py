@@ -0,0 +1,27 @@
+# Generated by Django 4.2.7 on 2026-10-17 03:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("files", "0006_upload_session_expiry"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="uploadsession",
+            name="digests",
+            field=models.BinaryField(default=b""),
+        ),
+        migrations.AddField(
+            model_name="uploadsession",
+            name="received",
+            field=models.BinaryField(default=b""),
+        ),
+        migrations.AddField(
+            model_name="uploadsession",
+            name="total_size",
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,16 @@
+# Generated by Django 4.2.7 on 2026-10-17 04:03
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("files", "0008_upload_batch"),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name="uploadsession",
+            name="received",
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.7 on 2026-10-17 04:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("files", "0011_bulk_job"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="fileversion",
+            name="base_version",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="+",
+                to="files.fileversion",
+            ),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.7 on 2026-10-17 04:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("files", "0013_content_chunks"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="file",
+            name="client_encrypted",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name="file",
+            name="client_key_metadata",
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AlterField(
+            model_name="file",
+            name="encryption_key",
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AlterField(
+            model_name="file",
+            name="iv",
+            field=models.CharField(blank=True, max_length=32),
+        ),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 4.2.7 on 2026-10-17 05:20
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def label_existing_trees(apps, schema_editor):
+    File = apps.get_model("files", "File")
+    FileVersion = apps.get_model("files", "FileVersion")
+    # Deduplicated uploads hashed content-defined chunks
+    File.objects.filter(checksum_algorithm="SHA256_TREE", blob__chunked=True).update(
+        checksum_algorithm="SHA256_CDC_TREE"
+    )
+    # A version holding its file's current checksum shares its algorithm;
+    # the leaf size of older chunk trees was never kept
+    for algorithm in ("SHA256_TREE", "SHA256_CDC_TREE"):
+        FileVersion.objects.filter(
+            file__checksum_algorithm=algorithm, checksum=F("file__checksum")
+        ).update(checksum_algorithm=algorithm)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("files", "0014_client_encryption"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="file",
+            name="checksum_chunk_size",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="fileversion",
+            name="checksum_algorithm",
+            field=models.CharField(
+                choices=[
+                    ("SHA256", "SHA-256"),
+                    ("SHA256_TREE", "SHA-256 chunk tree"),
+                    ("SHA256_CDC_TREE", "SHA-256 content-defined chunk tree"),
+                ],
+                default="SHA256",
+                max_length=20,
+            ),
+        ),
+        migrations.AddField(
+            model_name="fileversion",
+            name="checksum_chunk_size",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name="file",
+            name="checksum_algorithm",
+            field=models.CharField(
+                choices=[
+                    ("SHA256", "SHA-256"),
+                    ("SHA256_TREE", "SHA-256 chunk tree"),
+                    ("SHA256_CDC_TREE", "SHA-256 content-defined chunk tree"),
+                ],
+                default="SHA256",
+                max_length=20,
+            ),
+        ),
+        migrations.RunPython(label_existing_trees, migrations.RunPython.noop),
+    ]
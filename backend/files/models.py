@@ -1,8 +1,132 @@
+from collections import Counter
 from django.db import models
+from django.db.models import F
 import uuid
 from django.conf import settings
+from django.utils import timezone
+from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
 
+from .crypto import unwrap_key
+from .manifest import UploadManifest
+
+class ContentChunk(models.Model):
+    """
+    A content-defined chunk of an owner's data, stored once however many
+    of their files contain it (see files.dedup). Chunks are indexed by a
+    digest keyed per owner, so equal content in two accounts neither
+    shares storage nor can be detected from the index. ref_count counts
+    the BlobChunk entries using the chunk.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='content_chunks'
+    )
+    digest = models.CharField(max_length=64)  # Keyed hash of the plaintext
+    size = models.PositiveIntegerField()
+    path = models.CharField(max_length=512, unique=True)
+    encryption_key = models.CharField(max_length=64)
+    iv = models.CharField(max_length=32)
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ['owner', 'digest']
+        verbose_name = _('content chunk')
+        verbose_name_plural = _('content chunks')
+
+    def __str__(self):
+        return f"{self.digest} ({self.ref_count} refs)"
+
+    @classmethod
+    def acquire(cls, chunk_ids):
+        """Add one reference for each id in chunk_ids (which may repeat)."""
+        for chunk_id, count in Counter(chunk_ids).items():
+            cls.objects.filter(pk=chunk_id).update(ref_count=F('ref_count') + count)
+
+    @classmethod
+    def release(cls, chunk_ids):
+        """
+        Drop one reference for each id in chunk_ids. Chunks left without
+        references are deleted; returns their storage paths.
+        """
+        counts = Counter(chunk_ids)
+        for chunk_id, count in counts.items():
+            cls.objects.filter(pk=chunk_id).update(ref_count=F('ref_count') - count)
+        unused = cls.objects.filter(pk__in=counts, ref_count=0)
+        paths = list(unused.values_list('path', flat=True))
+        unused.delete()
+        return paths
+
+class Blob(models.Model):
+    """
+    Encrypted content in storage that more than one record points at.
+    Copying a file shares its blob rather than duplicating the ciphertext:
+    ref_count counts the File and FileVersion records using the blob, and
+    the stored object can be deleted once the last of them lets go.
+
+    Files are only moved onto a Blob when first copied; until then their
+    ciphertext is simply at their own storage path. Deduplicated uploads
+    are chunked Blobs, whose content is the sequence of ContentChunks in
+    their BlobChunk entries rather than a single stored object.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    path = models.CharField(max_length=512, unique=True)
+    chunked = models.BooleanField(default=False)
+    ref_count = models.PositiveIntegerField(default=1)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = _('blob')
+        verbose_name_plural = _('blobs')
+
+    def __str__(self):
+        return f"{self.path} ({self.ref_count} refs)"
+
+    @classmethod
+    def acquire(cls, blob_id, count=1):
+        cls.objects.filter(pk=blob_id).update(ref_count=F('ref_count') + count)
+
+    @classmethod
+    def release(cls, blob_ids):
+        """
+        Drop one reference for each id in blob_ids (which may repeat).
+        Blobs left without references are deleted, releasing their chunks
+        if chunked; returns the storage paths no longer used so the caller
+        can remove the content.
+        """
+        counts = Counter(blob_ids)
+        for blob_id, count in counts.items():
+            cls.objects.filter(pk=blob_id).update(ref_count=F('ref_count') - count)
+        unused = cls.objects.filter(pk__in=counts, ref_count=0)
+        paths = list(unused.filter(chunked=False).values_list('path', flat=True))
+        entries = BlobChunk.objects.filter(blob__in=unused)
+        chunk_ids = list(entries.values_list('chunk_id', flat=True))
+        entries.delete()
+        unused.delete()
+        return paths + ContentChunk.release(chunk_ids)
+
+class BlobChunk(models.Model):
+    """One ContentChunk at a position in a chunked Blob."""
+    blob = models.ForeignKey(
+        Blob,
+        on_delete=models.CASCADE,
+        related_name='chunks'
+    )
+    index = models.PositiveIntegerField()
+    offset = models.BigIntegerField()
+    chunk = models.ForeignKey(
+        ContentChunk,
+        on_delete=models.PROTECT,
+        related_name='+'
+    )
+
+    class Meta:
+        unique_together = ['blob', 'index']
+        ordering = ['index']
+
 class File(models.Model):
     class Status(models.TextChoices):
         PENDING = 'PENDING', _('Pending')
@@ -11,6 +135,15 @@ class File(models.Model):
         COMPLETED = 'COMPLETED', _('Completed')
         FAILED = 'FAILED', _('Failed')
 
+    class ChecksumAlgorithm(models.TextChoices):
+        SHA256 = 'SHA256', _('SHA-256')
+        # SHA-256 over the ordered SHA-256 digests of the upload's chunks,
+        # each checksum_chunk_size bytes but the last
+        SHA256_TREE = 'SHA256_TREE', _('SHA-256 chunk tree')
+        # The same over content-defined chunks, whose boundaries are the
+        # offsets of the blob's BlobChunk rows
+        SHA256_CDC_TREE = 'SHA256_CDC_TREE', _('SHA-256 content-defined chunk tree')
+
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     owner = models.ForeignKey(
         settings.AUTH_USER_MODEL,
@@ -22,9 +155,31 @@ class File(models.Model):
     mime_type = models.CharField(max_length=255)
     size = models.BigIntegerField()
     encrypted_path = models.CharField(max_length=255, unique=True)
-    encryption_key = models.CharField(max_length=64)  # Store encrypted key
-    iv = models.CharField(max_length=32)  # Initialization vector
+    # Empty for client-encrypted files, whose keys the server never sees
+    encryption_key = models.CharField(max_length=64, blank=True)
+    # End-to-end mode: the stored blob is the client's own ciphertext, kept
+    # and served verbatim, and client_key_metadata is whatever the client
+    # needs to recover the key (e.g. the key wrapped under an account key)
+    client_encrypted = models.BooleanField(default=False)
+    client_key_metadata = models.JSONField(default=dict, blank=True)
+    # Shared ciphertext, for copies; its content key is wrapped_key
+    # unwrapped with encryption_key
+    blob = models.ForeignKey(
+        Blob,
+        on_delete=models.PROTECT,
+        null=True,
+        blank=True,
+        related_name='files'
+    )
+    wrapped_key = models.CharField(max_length=64, blank=True)
+    iv = models.CharField(max_length=32, blank=True)  # Initialization vector
     checksum = models.CharField(max_length=64)  # SHA-256 hash
+    checksum_algorithm = models.CharField(
+        max_length=20,
+        choices=ChecksumAlgorithm.choices,
+        default=ChecksumAlgorithm.SHA256
+    )
+    checksum_chunk_size = models.PositiveIntegerField(null=True, blank=True)
     status = models.CharField(
         max_length=20,
         choices=Status.choices,
@@ -54,7 +209,29 @@ class File(models.Model):
 
     def get_file_path(self):
         """Returns the full path to the encrypted file."""
-        return f"files/{self.owner.id}/{self.encrypted_path}"
+        if self.blob_id:
+            return self.blob.path
+        return f"files/{self.owner_id}/{self.encrypted_path}"
+
+    def content_key(self):
+        """The key the file's ciphertext is encrypted under."""
+        if self.wrapped_key:
+            return unwrap_key(self.encryption_key, self.wrapped_key)
+        return self.encryption_key
+
+    def adopt_blob(self):
+        """
+        Move the file's ciphertext onto a Blob so copies can share it. The
+        file's versions stored at the same path move with it.
+        """
+        versions = self.versions.filter(encrypted_path=self.encrypted_path, blob__isnull=True)
+        self.blob = Blob.objects.create(
+            path=self.get_file_path(),
+            ref_count=1 + versions.count()
+        )
+        versions.update(blob=self.blob, wrapped_key=self.wrapped_key)
+        self.save(update_fields=['blob'])
+        return self.blob
 
 class FileChunk(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -83,6 +260,109 @@ class FileChunk(models.Model):
     def __str__(self):
         return f"Chunk {self.chunk_number} of {self.file.name}"
 
+def upload_session_expiry():
+    return timezone.now() + settings.UPLOAD_SESSION_LIFETIME
+
+class UploadSession(models.Model):
+    """
+    Server-side state of an in-progress chunked upload. Chunks are encrypted
+    as they arrive straight into the file's final container, so the session
+    only needs to know where each chunk lands and which have arrived.
+
+    Which chunks have arrived is tracked in the cache by the session's
+    UploadManifest while the upload is in flight, so receiving a chunk does
+    not write to the database. Completing the upload copies the manifest
+    onto the row: the chunks' SHA-256 digests packed back to back, and the
+    whole-file hash if one was built.
+    """
+    file = models.OneToOneField(
+        File,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='upload_session'
+    )
+    chunk_size = models.PositiveIntegerField()
+    total_size = models.BigIntegerField(default=0)
+    # Set from the manifest when the upload is completed
+    digests = models.BinaryField(default=b'')
+    sha256 = models.CharField(max_length=64, blank=True)
+    # Why finalization failed, for the upload status endpoint
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(default=upload_session_expiry)
+
+    class Meta:
+        verbose_name = _('upload session')
+        verbose_name_plural = _('upload sessions')
+
+    def __str__(self):
+        return f"Upload of {self.file.name}"
+
+    def is_expired(self):
+        return timezone.now() >= self.expires_at
+
+    @property
+    def chunk_count(self):
+        return -(-self.total_size // self.chunk_size)
+
+    @cached_property
+    def manifest(self):
+        return UploadManifest(self.file_id, self.chunk_count)
+
+    def expected_chunk_size(self, chunk_number):
+        """Exact size chunk_number must have given the declared layout."""
+        return min(self.chunk_size, self.total_size - chunk_number * self.chunk_size)
+
+    def store_digests(self, digests):
+        """Pack the chunks' hex SHA-256 digests onto the row, in order."""
+        self.digests = b''.join(bytes.fromhex(digest) for digest in digests)
+
+    def chunk_digests(self):
+        """The hex SHA-256 digests stored by store_digests."""
+        digests = bytes(self.digests)
+        return [digests[i:i + 32].hex() for i in range(0, len(digests), 32)]
+
+    def touch(self):
+        """Push the expiry back after activity on the upload."""
+        self.expires_at = upload_session_expiry()
+        self.save(update_fields=['expires_at'])
+        self.manifest.refresh()
+
+    def keep_alive(self):
+        """
+        Touch the session only once half its lifetime has passed, so a
+        steady stream of chunks costs an occasional row update rather
+        than one per chunk.
+        """
+        if self.expires_at - timezone.now() < settings.UPLOAD_SESSION_LIFETIME / 2:
+            self.touch()
+
+class UploadBatch(models.Model):
+    """
+    A group of small files uploaded together, e.g. a dropped folder: one
+    request allocates all the file records, one or more multipart requests
+    carry their content and one request commits them all.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='upload_batches'
+    )
+    files = models.ManyToManyField(File, related_name='upload_batches')
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(default=upload_session_expiry)
+
+    class Meta:
+        verbose_name = _('upload batch')
+        verbose_name_plural = _('upload batches')
+
+    def __str__(self):
+        return f"Upload batch {self.id}"
+
+    def is_expired(self):
+        return timezone.now() >= self.expires_at
+
 class FileVersion(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     file = models.ForeignKey(
@@ -93,8 +373,32 @@ class FileVersion(models.Model):
     version_number = models.PositiveIntegerField()
     encrypted_path = models.CharField(max_length=255, unique=True)
     encryption_key = models.CharField(max_length=64)  # Store encrypted key
+    blob = models.ForeignKey(
+        Blob,
+        on_delete=models.PROTECT,
+        null=True,
+        blank=True,
+        related_name='versions'
+    )
+    wrapped_key = models.CharField(max_length=64, blank=True)
+    # Set when the stored content is a delta against the next version
+    # rather than the version in full; see files.versions
+    base_version = models.ForeignKey(
+        'self',
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name='+'
+    )
     iv = models.CharField(max_length=32)  # Initialization vector
     checksum = models.CharField(max_length=64)  # SHA-256 hash
+    # As on File, which drops them once a later version replaces this one
+    checksum_algorithm = models.CharField(
+        max_length=20,
+        choices=File.ChecksumAlgorithm.choices,
+        default=File.ChecksumAlgorithm.SHA256
+    )
+    checksum_chunk_size = models.PositiveIntegerField(null=True, blank=True)
     size = models.BigIntegerField()
     created_at = models.DateTimeField(auto_now_add=True)
     created_by = models.ForeignKey(
@@ -117,4 +421,97 @@ class FileVersion(models.Model):
 
     def get_file_path(self):
         """Returns the full path to the encrypted version file."""
-        return f"files/{self.file.owner.id}/versions/{self.encrypted_path}"
+        if self.blob_id:
+            return self.blob.path
+        return f"files/{self.file.owner_id}/{self.encrypted_path}"
+
+    @property
+    def client_encrypted(self):
+        return self.file.client_encrypted
+
+    def content_key(self):
+        """The key the version's ciphertext is encrypted under."""
+        if self.wrapped_key:
+            return unwrap_key(self.encryption_key, self.wrapped_key)
+        return self.encryption_key
+
+class BulkJob(models.Model):
+    """
+    A bulk copy, move or delete running in the background. The selection
+    is split into batches that workers process in parallel; each finished
+    batch bumps the progress counters, and per-file outcomes are kept as
+    BulkJobItem rows.
+    """
+    class Operation(models.TextChoices):
+        COPY = 'COPY', _('Copy')
+        MOVE = 'MOVE', _('Move')
+        DELETE = 'DELETE', _('Delete')
+
+    class Status(models.TextChoices):
+        PENDING = 'PENDING', _('Pending')
+        RUNNING = 'RUNNING', _('Running')
+        # Every item processed; individual items may still have failed
+        COMPLETED = 'COMPLETED', _('Completed')
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='bulk_jobs'
+    )
+    operation = models.CharField(max_length=10, choices=Operation.choices)
+    status = models.CharField(
+        max_length=20,
+        choices=Status.choices,
+        default=Status.PENDING
+    )
+    total = models.PositiveIntegerField(default=0)
+    processed = models.PositiveIntegerField(default=0)
+    succeeded = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        verbose_name = _('bulk job')
+        verbose_name_plural = _('bulk jobs')
+
+    def __str__(self):
+        return f"{self.get_operation_display()} of {self.total} files ({self.status})"
+
+class BulkJobItem(models.Model):
+    class Status(models.TextChoices):
+        PENDING = 'PENDING', _('Pending')
+        SUCCEEDED = 'SUCCEEDED', _('Succeeded')
+        FAILED = 'FAILED', _('Failed')
+
+    job = models.ForeignKey(
+        BulkJob,
+        on_delete=models.CASCADE,
+        related_name='items'
+    )
+    file_id = models.UUIDField()
+    # New name, for moves
+    new_name = models.CharField(max_length=255, blank=True)
+    status = models.CharField(
+        max_length=20,
+        choices=Status.choices,
+        default=Status.PENDING
+    )
+    # The copy created, for copies
+    result_file_id = models.UUIDField(null=True, blank=True)
+    error = models.CharField(max_length=255, blank=True)
+
+    class Meta:
+        unique_together = ['job', 'file_id']
+        ordering = ['id']
+        verbose_name = _('bulk job item')
+        verbose_name_plural = _('bulk job items')
+
+    def __str__(self):
+        return f"{self.file_id} ({self.status})"
+
+    def fail(self, error):
+        self.status = self.Status.FAILED
+        self.error = error[:255]
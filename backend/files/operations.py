@@ -0,0 +1,124 @@
+"""
+Operations on many files at once, shared by the single-file views and the
+background bulk jobs.
+"""
+from django.db import transaction
+from django.utils import timezone
+
+from .crypto import wrap_key
+from .models import Blob, BulkJob, File, FileVersion
+from .utils import clean_filename, generate_encrypted_path, generate_encryption_key
+
+def copy_files(source_files, owner):
+    """
+    Copy files for owner without touching their content. Each copy shares
+    its source's ciphertext through a reference-counted Blob and gets a key
+    of its own, under which the content key is wrapped. Only rows are
+    written, so the cost does not depend on file size. Only COMPLETED
+    files are copied; an upload still in progress, or one that failed, has
+    no content to share yet and is skipped. Returns the copies keyed by
+    the primary key of their source, so a skipped source has no entry.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        # Lock the sources so concurrent copies adopt each blob only once
+        sources = File.objects.select_for_update().select_related('blob').filter(
+            status=File.Status.COMPLETED
+        ).in_bulk([f.pk for f in source_files])
+        copies, new_versions = {}, []
+        for source_file in (sources[f.pk] for f in source_files if f.pk in sources):
+            blob = source_file.blob or source_file.adopt_blob()
+            if source_file.client_encrypted:
+                # The client's key metadata already unlocks the content
+                encryption_key = wrapped_key = ''
+            else:
+                encryption_key = generate_encryption_key()
+                wrapped_key = wrap_key(encryption_key, source_file.content_key())
+            new_file = File(
+                owner=owner,
+                name=f"Copy of {source_file.name}",
+                original_name=source_file.original_name,
+                mime_type=source_file.mime_type,
+                size=source_file.size,
+                encryption_key=encryption_key,
+                wrapped_key=wrapped_key,
+                client_encrypted=source_file.client_encrypted,
+                client_key_metadata=source_file.client_key_metadata.copy(),
+                blob=blob,
+                encrypted_path=generate_encrypted_path(source_file.name),
+                iv=source_file.iv,
+                checksum=source_file.checksum,
+                checksum_algorithm=source_file.checksum_algorithm,
+                checksum_chunk_size=source_file.checksum_chunk_size,
+                status=File.Status.COMPLETED,
+                upload_completed_at=now,
+                description=source_file.description,
+                tags=source_file.tags.copy(),
+                metadata=source_file.metadata.copy()
+            )
+            copies[source_file.pk] = new_file
+            new_versions.append(FileVersion(
+                file=new_file,
+                version_number=1,
+                encrypted_path=new_file.encrypted_path,
+                encryption_key=new_file.encryption_key,
+                blob=blob,
+                wrapped_key=new_file.wrapped_key,
+                iv=new_file.iv,
+                checksum=new_file.checksum,
+                checksum_algorithm=new_file.checksum_algorithm,
+                checksum_chunk_size=new_file.checksum_chunk_size,
+                size=new_file.size,
+                created_by=owner,
+                comment=f"Initial version (copied from {source_file.name})"
+            ))
+            # One reference for the copy and one for its initial version
+            Blob.acquire(blob.pk, 2)
+
+        File.objects.bulk_create(copies.values())
+        FileVersion.objects.bulk_create(new_versions)
+    return copies
+
+def apply_bulk_operation(job, items):
+    """
+    Carry out job's operation for a batch of its items, setting each
+    item's status, result and error. Files the job's owner cannot see
+    fail individually; the rest of the batch is applied together.
+    """
+    files = File.objects.filter(owner=job.owner, is_deleted=False).in_bulk(
+        [item.file_id for item in items]
+    )
+    found = []
+    for item in items:
+        if item.file_id not in files:
+            item.fail("File not found")
+        elif job.operation == BulkJob.Operation.COPY and files[item.file_id].status != File.Status.COMPLETED:
+            item.fail("Only completed uploads can be copied")
+        elif job.operation == BulkJob.Operation.MOVE and not clean_filename(item.new_name):
+            item.fail("A new name is required")
+        else:
+            found.append(item)
+
+    if job.operation == BulkJob.Operation.COPY:
+        copies = copy_files([files[item.file_id] for item in found], job.owner)
+        for item in found:
+            if item.file_id in copies:
+                item.result_file_id = copies[item.file_id].id
+            else:
+                # Its upload was no longer complete once locked
+                item.fail("Only completed uploads can be copied")
+        found = [item for item in found if item.file_id in copies]
+    elif job.operation == BulkJob.Operation.MOVE:
+        moved = []
+        for item in found:
+            file = files[item.file_id]
+            file.name = clean_filename(item.new_name)
+            moved.append(file)
+        File.objects.bulk_update(moved, ['name'])
+    elif job.operation == BulkJob.Operation.DELETE:
+        File.objects.filter(pk__in=[item.file_id for item in found]).update(
+            is_deleted=True, deleted_at=timezone.now()
+        )
+
+    for item in found:
+        item.status = item.Status.SUCCEEDED
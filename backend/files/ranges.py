@@ -0,0 +1,175 @@
+import re
+import uuid
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe
+
+from .crypto import PlainReader, open_reader
+
+# Requests asking for more ranges than this are served in full rather than
+# as a multipart response; it keeps pathological headers from turning into
+# thousands of tiny decrypts.
+MAX_RANGES = 16
+
+_RANGE_SPEC = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+def parse_range_header(header, size):
+    """
+    Parse a "bytes=..." Range header against a representation of size bytes.
+    Returns a sorted list of coalesced (start, end) pairs with end exclusive,
+    an empty list when no range is satisfiable, or None when the header
+    should be ignored (wrong unit, bad syntax, too many ranges).
+    """
+    if not header:
+        return None
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not spec:
+        return None
+
+    ranges = []
+    for part in spec.split(','):
+        match = _RANGE_SPEC.match(part)
+        if not match:
+            return None
+        first, last = match.groups()
+        if first:
+            start = int(first)
+            end = int(last) + 1 if last else size
+            if last and end <= start:
+                return None
+        elif last:
+            # Suffix range: the final N bytes
+            start, end = max(size - int(last), 0), size
+            if int(last) == 0:
+                continue
+        else:
+            return None
+        if start < size:
+            ranges.append((start, min(end, size)))
+
+    if len(ranges) > MAX_RANGES:
+        return None
+
+    coalesced = []
+    for start, end in sorted(ranges):
+        if coalesced and start <= coalesced[-1][1]:
+            coalesced[-1] = (coalesced[-1][0], max(end, coalesced[-1][1]))
+        else:
+            coalesced.append((start, end))
+    return coalesced
+
+def _last_modified(file):
+    # Versions have no upload_completed_at of their own
+    return getattr(file, 'upload_completed_at', None) or getattr(file, 'created_at', None)
+
+def file_etag(file):
+    """Strong validator for a file's content."""
+    return f'"{file.checksum}"' if file.checksum else None
+
+def if_range_matches(request, file):
+    """
+    True when the request has no If-Range precondition, or when the
+    precondition still matches the current content.
+    """
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        # Only strong comparison is allowed for If-Range
+        return not if_range.startswith('W/') and if_range == file_etag(file)
+    timestamp = parse_http_date_safe(if_range)
+    modified = _last_modified(file)
+    return bool(timestamp and modified and int(modified.timestamp()) <= timestamp)
+
+def set_range_headers(response, file):
+    """Advertise range support and the validators used by If-Range."""
+    response['Accept-Ranges'] = 'bytes'
+    etag = file_etag(file)
+    if etag:
+        response['ETag'] = etag
+    modified = _last_modified(file)
+    if modified:
+        response['Last-Modified'] = http_date(modified.timestamp())
+    return response
+
+def _part_header(boundary, content_type, start, end, size):
+    return (
+        f'\r\n--{boundary}\r\n'
+        f'Content-Type: {content_type}\r\n'
+        f'Content-Range: bytes {start}-{end - 1}/{size}\r\n\r\n'
+    ).encode('latin-1')
+
+def _stream_ranges(f, reader, ranges, boundary=None, content_type=None):
+    """Yield the plaintext of each range, framed as multipart when asked to."""
+    try:
+        for start, end in ranges:
+            if boundary:
+                yield _part_header(boundary, content_type, start, end, reader.size)
+            yield from reader.iter_range(start, end)
+        if boundary:
+            yield f'\r\n--{boundary}--\r\n'.encode('latin-1')
+    finally:
+        f.close()
+
+def stream_response(request, f, file, content_type=None, reader=None):
+    """
+    Stream file's decrypted content straight from its ciphertext, block by
+    block, with no plaintext temp file. Client-encrypted files are streamed
+    as stored. Range requests get a 206 (or 416)
+    and only the covering bytes are decrypted; anything else, including a
+    stale If-Range validator or a Range header we do not understand, gets
+    the whole body with a 200. f is an open binary handle on the
+    ciphertext; the response takes ownership of it and closes it once
+    consumed. Content not held in a single object, such as an old version,
+    is passed as reader, with f being whatever closes it.
+    """
+    content_type = content_type or getattr(file, 'mime_type', '') or 'application/octet-stream'
+    try:
+        if reader is None and file.client_encrypted:
+            reader = PlainReader(f)
+        elif reader is None:
+            reader = open_reader(f, file.content_key(), file.iv)
+        ranges = None
+        header = request.META.get('HTTP_RANGE')
+        if header and request.method in ('GET', 'HEAD') and if_range_matches(request, file):
+            ranges = parse_range_header(header, reader.size)
+    except Exception:
+        f.close()
+        raise
+
+    if ranges is None:
+        response = StreamingHttpResponse(
+            _stream_ranges(f, reader, [(0, reader.size)]),
+            content_type=content_type
+        )
+        response['Content-Length'] = str(reader.size)
+        return set_range_headers(response, file)
+
+    if not ranges:
+        f.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{reader.size}'
+        return set_range_headers(response, file)
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        response = StreamingHttpResponse(
+            _stream_ranges(f, reader, ranges),
+            status=206,
+            content_type=content_type
+        )
+        response['Content-Range'] = f'bytes {start}-{end - 1}/{reader.size}'
+        response['Content-Length'] = str(end - start)
+        return set_range_headers(response, file)
+
+    boundary = uuid.uuid4().hex
+    length = len(f'\r\n--{boundary}--\r\n')
+    for start, end in ranges:
+        length += len(_part_header(boundary, content_type, start, end, reader.size)) + end - start
+    response = StreamingHttpResponse(
+        _stream_ranges(f, reader, ranges, boundary, content_type),
+        status=206,
+        content_type=f'multipart/byteranges; boundary={boundary}'
+    )
+    response['Content-Length'] = str(length)
+    return set_range_headers(response, file)
@@ -1,5 +1,7 @@
 from rest_framework import serializers
-from .models import File, FileVersion, FileChunk
+from .models import (
+    File, FileVersion, FileChunk, UploadSession, UploadBatch, BulkJob, BulkJobItem
+)
 from django.contrib.auth import get_user_model
 from authentication.serializers import UserSerializer
 
@@ -22,6 +24,32 @@ class FileChunkSerializer(serializers.ModelSerializer):
         ]
         read_only_fields = ['id', 'created_at', 'updated_at']
 
+class UploadSessionSerializer(serializers.ModelSerializer):
+    """Resume state of a chunked upload: the chunks already received."""
+    chunk_count = serializers.IntegerField(read_only=True)
+    received_chunks = serializers.SerializerMethodField()
+    received_bytes = serializers.SerializerMethodField()
+    received_bitmap = serializers.SerializerMethodField()
+
+    class Meta:
+        model = UploadSession
+        fields = [
+            'file', 'chunk_size', 'total_size', 'chunk_count',
+            'received_chunks', 'received_bytes', 'received_bitmap',
+            'created_at', 'expires_at'
+        ]
+        read_only_fields = fields
+
+    def get_received_chunks(self, obj):
+        return obj.manifest.received_chunks()
+
+    def get_received_bytes(self, obj):
+        return sum(obj.expected_chunk_size(n) for n in obj.manifest.received_chunks())
+
+    def get_received_bitmap(self, obj):
+        """Base64 bitmap, bit n (least significant first) set for chunk n."""
+        return obj.manifest.bitmap()
+
 class FileVersionSerializer(serializers.ModelSerializer):
     created_by = UserSerializer(read_only=True)
 
@@ -29,8 +57,8 @@ class FileVersionSerializer(serializers.ModelSerializer):
         model = FileVersion
         fields = [
             'id', 'file', 'version_number', 'size',
-            'checksum', 'created_at', 'created_by',
-            'comment', 'metadata'
+            'checksum', 'checksum_algorithm', 'checksum_chunk_size',
+            'created_at', 'created_by', 'comment', 'metadata'
         ]
         read_only_fields = [
             'id', 'created_at', 'created_by',
@@ -44,6 +72,7 @@ class FileInitializeSerializer(serializers.ModelSerializer):
         fields = [
             'name', 'original_name', 'mime_type', 'size',
             'encrypted_path', 'encryption_key', 'iv',
+            'client_encrypted', 'client_key_metadata',
             'status', 'description', 'tags', 'metadata'
         ]
         extra_kwargs = {
@@ -61,15 +90,18 @@ class FileSerializer(serializers.ModelSerializer):
         model = File
         fields = [
             'id', 'owner', 'name', 'original_name',
-            'mime_type', 'size', 'formatted_size', 'checksum', 'status',
+            'mime_type', 'size', 'formatted_size', 'checksum',
+            'checksum_algorithm', 'checksum_chunk_size', 'status',
             'upload_started_at', 'upload_completed_at',
             'last_accessed_at', 'is_deleted', 'deleted_at',
-            'description', 'tags', 'metadata', 'latest_version'
+            'description', 'tags', 'metadata', 'latest_version',
+            'client_encrypted', 'client_key_metadata'
         ]
         read_only_fields = [
-            'id', 'owner', 'upload_started_at',
+            'id', 'owner', 'upload_started_at', 'client_encrypted', 'client_key_metadata',
             'upload_completed_at', 'last_accessed_at',
-            'deleted_at', 'checksum', 'encryption_key',
+            'deleted_at', 'checksum', 'checksum_algorithm',
+            'checksum_chunk_size', 'encryption_key',
             'iv', 'encrypted_path'
         ]
 
@@ -91,4 +123,42 @@ class FileListSerializer(FileSerializer):
             'id', 'name', 'mime_type', 'size', 'owner',
             'formatted_size', 'status', 'upload_completed_at',
             'last_accessed_at', 'is_deleted'
-        ] 
\ No newline at end of file
+        ] 
+
+class UploadBatchSerializer(serializers.ModelSerializer):
+    """A batch upload with its files, listed in the order they were declared."""
+    files = serializers.SerializerMethodField()
+
+    class Meta:
+        model = UploadBatch
+        fields = ['id', 'files', 'created_at', 'expires_at']
+        read_only_fields = fields
+
+    def get_files(self, obj):
+        files = self.context.get('files', obj.files.all())
+        return FileListSerializer(files, many=True).data
+
+class BulkJobItemSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = BulkJobItem
+        fields = ['file_id', 'status', 'result_file_id', 'error']
+        read_only_fields = fields
+
+class BulkJobSerializer(serializers.ModelSerializer):
+    """Progress of a bulk job: its counters only, cheap enough to poll."""
+
+    class Meta:
+        model = BulkJob
+        fields = [
+            'id', 'operation', 'status', 'total', 'processed', 'succeeded',
+            'failed', 'created_at', 'completed_at'
+        ]
+        read_only_fields = fields
+
+class BulkJobDetailSerializer(BulkJobSerializer):
+    """Progress of a bulk job, with the outcome for each file so far."""
+    items = BulkJobItemSerializer(many=True, read_only=True)
+
+    class Meta(BulkJobSerializer.Meta):
+        fields = BulkJobSerializer.Meta.fields + ['items']
+        read_only_fields = fields
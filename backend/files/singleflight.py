@@ -0,0 +1,120 @@
+"""
+Coalescing of concurrent identical downloads.
+
+A link posted somewhere busy brings many requests for the same file at
+once. Rather than each opening and decrypting it, deliveries read content
+in DELIVERY_SEGMENT_SIZE segments through a SingleFlight: the first
+request to need a segment decrypts it, and every request asking for the
+same segment meanwhile waits for that result instead of repeating the
+work. A herd arriving together therefore costs one decryption per
+segment. Results are not kept once the flight lands; that is what the
+content cache (files.content_cache) is for.
+"""
+import threading
+
+from django.conf import settings
+
+class _Flight:
+    def __init__(self):
+        self.landed = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """Runs a function at most once at a time per key."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def do(self, key, fn):
+        """
+        Call fn and return its result, unless a call for key is already
+        in progress, in which case wait for it and share its result (or
+        exception).
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            flight.landed.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fn()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.landed.set()
+        return flight.result
+
+flights = SingleFlight()
+
+class SegmentReader:
+    """
+    Random-access reader (exposing .size and .iter_range()) over file's
+    current content, decrypted a segment at a time through the shared
+    flights. open_content returns a closeable handle and a reader on the
+    content; it is only called if this reader has to lead a flight. Close
+    it once done.
+    """
+
+    def __init__(self, file, open_content):
+        self._prefix = self._key_prefix(file)
+        self._open_content = open_content
+        self._opened = None
+        self.segment_size = settings.DELIVERY_SEGMENT_SIZE
+        self.size = int(self._fetch('size', lambda: str(self._source().size).encode()))
+
+    def _key_prefix(self, file):
+        return (str(file.pk), file.checksum)
+
+    def _source(self):
+        if self._opened is None:
+            self._opened = self._open_content()
+        return self._opened[1]
+
+    def _lookup(self, key):
+        """Hook for a store of finished segments; returns None on a miss."""
+        return None
+
+    def _keep(self, key, data):
+        pass
+
+    def _fetch(self, part, produce):
+        key = self._prefix + (part,)
+        data = self._lookup(key)
+        if data is None:
+            data = flights.do(key, lambda: self._lookup(key) or self._produce(key, produce))
+        return data
+
+    def _produce(self, key, produce):
+        data = produce()
+        self._keep(key, data)
+        return data
+
+    def _read_segment(self, index):
+        start = index * self.segment_size
+        return b''.join(self._source().iter_range(start, min(start + self.segment_size, self.size)))
+
+    def iter_range(self, start=0, end=None):
+        end = self.size if end is None else min(end, self.size)
+        while start < end:
+            index, offset = divmod(start, self.segment_size)
+            data = self._fetch(index, lambda: self._read_segment(index))[offset:offset + end - start]
+            if not data:
+                raise ValueError("Truncated content")
+            yield data
+            start += len(data)
+
+    def close(self):
+        if self._opened is not None:
+            self._opened[0].close()
+            self._opened = None
@@ -0,0 +1,317 @@
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from celery import group, shared_task
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import (
+    Blob, BulkJob, BulkJobItem, ContentChunk, File, FileChunk, FileVersion, UploadSession, UploadBatch
+)
+from .manifest import UploadManifest
+from .operations import apply_bulk_operation
+from .crypto import ContainerWriter
+from .dedup import unreferenced_chunks
+from .exceptions import ChunkMissingError
+from .utils import combine_chunk_hashes, open_container
+
+logger = logging.getLogger(__name__)
+
+def verify_chunk_manifest(session):
+    """
+    Check that every chunk the declared size calls for has arrived.
+    Returns the chunks' hex SHA-256 digests in order, or raises
+    ChunkMissingError.
+    """
+    digests = session.manifest.digests()
+    missing = session.chunk_count - len(digests)
+    if missing:
+        raise ChunkMissingError(f"Missing {missing} of {session.chunk_count} chunks")
+    return [digests[n] for n in range(session.chunk_count)]
+
+@shared_task
+def finalize_upload(file_id):
+    """
+    Commit a chunked upload handed over by CompleteUploadView. The chunks
+    are already encrypted in place, so this seals the container, settles
+    the checksum and creates the first FileVersion. On failure the file is
+    marked FAILED and the error is kept on its upload session for the
+    status endpoint.
+    """
+    # Claim the upload, so a duplicate delivery of this task (or a second
+    # complete request) does nothing. The transfer is over, so stamping
+    # its completion time doubles as the claim.
+    if not File.objects.filter(
+        pk=file_id, status=File.Status.PROCESSING, upload_completed_at__isnull=True
+    ).update(upload_completed_at=timezone.now()):
+        return
+    file = File.objects.select_related('owner').get(pk=file_id)
+    session = UploadSession.objects.get(file=file)
+
+    try:
+        digests = session.chunk_digests()
+        if len(digests) != session.chunk_count:
+            raise ChunkMissingError(f"Missing {session.chunk_count - len(digests)} of {session.chunk_count} chunks")
+
+        # Only the last segment needs re-sealing now that the size is known;
+        # client-encrypted content is complete as it stands
+        file_size = session.total_size
+        if not file.client_encrypted:
+            with open_container(file, 'r+b') as f:
+                ContainerWriter(f, file.encryption_key, file.iv).seal(file_size)
+
+        # Use the whole-file hash built while chunks arrived in order; if
+        # they did not, fall back to a hash of the chunk digests
+        if session.sha256:
+            checksum, algorithm = session.sha256, File.ChecksumAlgorithm.SHA256
+            chunk_size = None
+        else:
+            checksum = combine_chunk_hashes(digests)
+            algorithm = File.ChecksumAlgorithm.SHA256_TREE
+            # Kept with the checksum: the session goes once finalized
+            chunk_size = session.chunk_size
+
+        with transaction.atomic():
+            file.status = File.Status.COMPLETED
+            file.size = file_size
+            file.checksum = checksum
+            file.checksum_algorithm = algorithm
+            file.checksum_chunk_size = chunk_size
+            file.save()
+
+            session.delete()
+
+            FileVersion.objects.create(
+                file=file,
+                version_number=1,
+                encrypted_path=file.encrypted_path,
+                encryption_key=file.encryption_key,
+                iv=file.iv,
+                checksum=file.checksum,
+                checksum_algorithm=file.checksum_algorithm,
+                checksum_chunk_size=file.checksum_chunk_size,
+                size=file.size,
+                created_by=file.owner
+            )
+
+    except Exception as e:
+        logger.exception("Finalizing upload %s failed", file_id)
+        # Written by query: the instances may not match what was rolled back
+        File.objects.filter(pk=file_id).update(status=File.Status.FAILED)
+        UploadSession.objects.filter(file_id=file_id).update(error=str(e))
+
+# Directories younger than this are left alone when pruning, so one created
+# for an upload that is about to be written is not removed under it
+EMPTY_DIRECTORY_MIN_AGE = 3600
+
+def stale_uploads(now):
+    """
+    Files whose upload was abandoned, or failed, long enough ago to
+    reclaim, including those whose finalization died with its worker.
+    """
+    started_before = now - settings.UPLOAD_SESSION_LIFETIME
+    # Completing requires a live session, so these were handed over at
+    # least UPLOAD_PROCESSING_TIMEOUT ago
+    handed_over_before = now - settings.UPLOAD_PROCESSING_TIMEOUT
+    return File.objects.filter(
+        Q(status=File.Status.UPLOADING, upload_session__expires_at__lte=now)
+        | Q(status=File.Status.UPLOADING, upload_session__isnull=True,
+            upload_started_at__lte=started_before)
+        | Q(status=File.Status.PROCESSING, upload_session__expires_at__lte=handed_over_before)
+        | Q(status=File.Status.FAILED, upload_started_at__lte=started_before)
+    )
+
+def _delete_blob(path):
+    """Delete a stored blob, returning the bytes reclaimed."""
+    try:
+        size = default_storage.size(path)
+        default_storage.delete(path)
+    except OSError:
+        return 0
+    return size
+
+def _delete_tree(path):
+    """Remove a local directory tree, returning the bytes reclaimed."""
+    reclaimed = 0
+    for root, dirs, files in os.walk(path, topdown=False):
+        for name in files:
+            file_path = os.path.join(root, name)
+            try:
+                reclaimed += os.path.getsize(file_path)
+                os.remove(file_path)
+            except OSError:
+                pass
+        for name in dirs:
+            try:
+                os.rmdir(os.path.join(root, name))
+            except OSError:
+                pass
+    try:
+        os.rmdir(path)
+    except OSError:
+        pass
+    return reclaimed
+
+def prune_empty_directories(root, older_than):
+    """
+    Remove empty directories below root whose modification time is before
+    older_than (a timestamp). Returns how many were removed.
+    """
+    removed = 0
+    if not os.path.isdir(root):
+        return removed
+    for path, dirs, files in os.walk(root, topdown=False):
+        if path == root or files:
+            continue
+        try:
+            if os.stat(path).st_mtime < older_than:
+                os.rmdir(path)
+                removed += 1
+        except OSError:
+            # Not empty after all, or already gone
+            pass
+    return removed
+
+@shared_task
+def sweep_abandoned_uploads():
+    """
+    Reclaim storage held by uploads that will never complete: files left
+    UPLOADING past their session's expiry, stuck PROCESSING long after it,
+    or FAILED, have their rows removed and their content deleted, or their
+    reference to a shared Blob dropped. Work goes in batches of
+    UPLOAD_SWEEP_BATCH_SIZE, with at most UPLOAD_SWEEP_IO_WORKERS blob
+    deletions in flight, and one set-based delete per table per batch.
+
+    Chunk directories left by the old chunks/<file_id>/ upload layout are
+    removed as well, along with deduplicated chunks never committed to a
+    file and empty directories under files/. Runs
+    periodically from celery beat; returns what was reclaimed.
+    """
+    now = timezone.now()
+    report = {'files': 0, 'bytes': 0, 'directories': 0}
+
+    with ThreadPoolExecutor(max_workers=settings.UPLOAD_SWEEP_IO_WORKERS) as pool:
+        while True:
+            batch = list(
+                stale_uploads(now).values_list(
+                    'id', 'owner_id', 'encrypted_path', 'blob_id',
+                    'upload_session__chunk_size', 'upload_session__total_size'
+                )[:settings.UPLOAD_SWEEP_BATCH_SIZE]
+            )
+            if not batch:
+                break
+
+            # Content of its own goes with the file; shared content only
+            # once nothing else references it
+            paths = [
+                File(owner_id=owner_id, encrypted_path=encrypted_path).get_file_path()
+                for _, owner_id, encrypted_path, blob_id, _, _ in batch if not blob_id
+            ]
+            ids = [row[0] for row in batch]
+            with transaction.atomic():
+                blob_ids = [row[3] for row in batch if row[3]] + list(
+                    FileVersion.objects.filter(file_id__in=ids, blob__isnull=False)
+                    .values_list('blob_id', flat=True)
+                )
+                FileChunk.objects.filter(file_id__in=ids).delete()
+                UploadSession.objects.filter(file_id__in=ids).delete()
+                File.objects.filter(pk__in=ids).delete()
+                paths += Blob.release(blob_ids)
+            report['bytes'] += sum(pool.map(_delete_blob, paths))
+
+            for file_id, _, _, _, chunk_size, total_size in batch:
+                if chunk_size:
+                    UploadManifest(file_id, -(-total_size // chunk_size)).delete()
+            report['files'] += len(ids)
+
+        UploadBatch.objects.filter(expires_at__lte=now).delete()
+
+        # Deduplicated chunks that were uploaded but never committed
+        with transaction.atomic():
+            orphans = dict(unreferenced_chunks(now).select_for_update().values_list('pk', 'path'))
+            ContentChunk.objects.filter(pk__in=orphans, ref_count=0).delete()
+            # A commit may have taken a reference since the select (the lock
+            # is advisory on some databases); those rows, and their
+            # content, stay
+            for pk in ContentChunk.objects.filter(pk__in=orphans).values_list('pk', flat=True):
+                del orphans[pk]
+        report['bytes'] += sum(pool.map(_delete_blob, orphans.values()))
+
+        chunks_root = default_storage.path('chunks')
+        if os.path.isdir(chunks_root):
+            chunk_dirs_before = time.time() - settings.UPLOAD_SESSION_LIFETIME.total_seconds()
+            orphans = [
+                entry.path for entry in os.scandir(chunks_root)
+                if entry.is_dir() and entry.stat().st_mtime < chunk_dirs_before
+            ]
+            report['bytes'] += sum(pool.map(_delete_tree, orphans))
+            report['directories'] += len(orphans)
+
+    report['directories'] += prune_empty_directories(
+        default_storage.path('files'), time.time() - EMPTY_DIRECTORY_MIN_AGE
+    )
+    logger.info(
+        "Swept %d abandoned uploads and %d directories, reclaiming %d bytes",
+        report['files'], report['directories'], report['bytes']
+    )
+    return report
+
+@shared_task
+def run_bulk_job(job_id):
+    """
+    Start a bulk job queued by one of the bulk views: split its items into
+    batches of BULK_JOB_BATCH_SIZE and hand them to workers in parallel.
+    """
+    # Claim the job, so a duplicate delivery of this task does nothing
+    if not BulkJob.objects.filter(pk=job_id, status=BulkJob.Status.PENDING).update(
+        status=BulkJob.Status.RUNNING
+    ):
+        return
+    item_ids = list(BulkJobItem.objects.filter(job_id=job_id).values_list('pk', flat=True))
+    if not item_ids:
+        BulkJob.objects.filter(pk=job_id).update(
+            status=BulkJob.Status.COMPLETED, completed_at=timezone.now()
+        )
+        return
+
+    batch_size = settings.BULK_JOB_BATCH_SIZE
+    group(
+        process_bulk_job_batch.s(str(job_id), item_ids[i:i + batch_size])
+        for i in range(0, len(item_ids), batch_size)
+    ).apply_async()
+
+@shared_task
+def process_bulk_job_batch(job_id, item_ids):
+    """
+    Apply a bulk job to one batch of its items. Item outcomes are written
+    with one bulk_update and the job's counters bumped in place, so batches
+    running side by side never overwrite each other's progress. The job
+    completes when the last batch lands.
+    """
+    job = BulkJob.objects.select_related('owner').get(pk=job_id)
+    items = list(BulkJobItem.objects.filter(
+        pk__in=item_ids, status=BulkJobItem.Status.PENDING
+    ))
+    try:
+        apply_bulk_operation(job, items)
+    except Exception as e:
+        logger.exception("Bulk job %s failed on a batch of %d files", job_id, len(items))
+        for item in items:
+            item.result_file_id = None
+            item.fail(str(e))
+
+    succeeded = sum(item.status == BulkJobItem.Status.SUCCEEDED for item in items)
+    with transaction.atomic():
+        BulkJobItem.objects.bulk_update(items, ['status', 'result_file_id', 'error'])
+        BulkJob.objects.filter(pk=job.pk).update(
+            processed=F('processed') + len(items),
+            succeeded=F('succeeded') + succeeded,
+            failed=F('failed') + len(items) - succeeded
+        )
+        BulkJob.objects.filter(pk=job.pk, processed__gte=F('total')).update(
+            status=BulkJob.Status.COMPLETED, completed_at=timezone.now()
+        )
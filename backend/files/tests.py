@@ -2,12 +2,55 @@ from django.test import TestCase
 from django.contrib.auth import get_user_model
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.utils import timezone
+from django.conf import settings
+from django.test import override_settings, RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from django.core.files.storage import default_storage
+from django.core.files.base import ContentFile
 from rest_framework.test import APITestCase
 from rest_framework import status
-from .models import File, FileVersion, FileChunk
+from .models import Blob, BulkJob, BulkJobItem, ContentChunk, File, FileVersion, FileChunk, UploadSession
+from .crypto import (
+    StreamEncryptor, StreamDecryptor, ContainerReader, ContainerWriter, CBCReader, open_reader,
+    iter_file, derive_key,
+    hkdf_key, pack_header, FORMAT_MAGIC, FORMAT_LEGACY, FORMAT_CBC_V1,
+    FORMAT_SEGMENTED_V2, KDF_HKDF_SHA256, CBC_V1_INFO, SEGMENTED_HEADER_SIZE,
+    SEGMENT_SIZE, wrap_key, unwrap_key
+)
+from cryptography.hazmat.primitives.keywrap import InvalidUnwrap
+from .utils import (
+    encrypt_file, decrypt_file, generate_encryption_key, combine_chunk_hashes,
+    ensure_directory_exists
+)
+from .ranges import parse_range_header
+from .delta import (
+    LITERAL, DeltaReader, SignatureBuilder, apply_delta, compute_delta, encode_delta,
+    invert_copies, iter_stored_delta, stored_delta_size
+)
+from .exceptions import ChunkUploadError, FileVersionError
+from .dedup import content_defined_chunks, owner_chunk_digest
+from .singleflight import SegmentReader, SingleFlight, _Flight, flights as shared_flights
+from .content_cache import ContentCache, cache_generation, content_cache, invalidate
+from .operations import copy_files
+from . import archive, delivery
+from .tasks import finalize_upload, sweep_abandoned_uploads
+from .views import write_chunk
+from unittest import mock
+from config.celery import app as celery_app
+from sharing.models import FileShare, ShareLink
 import tempfile
 import os
+import io
+import json
+import random
+import re
+import threading
 import uuid
+import zipfile
+import hashlib
+import time
+from urllib.parse import unquote
 
 User = get_user_model()
 
@@ -58,6 +101,1788 @@ class FileModelTests(TestCase):
         self.assertEqual(version.version_number, 1)
         self.assertEqual(version.file, file)
 
+class StreamingEncryptionTests(TestCase):
+    def setUp(self):
+        self.key = generate_encryption_key()
+        self.data = os.urandom(200 * 1024 + 7)
+
+    def test_stream_round_trip(self):
+        encryptor = StreamEncryptor(self.key)
+        ciphertext = b''.join(encryptor.encrypt_iter(iter_file(io.BytesIO(self.data))))
+        decryptor = StreamDecryptor(self.key, encryptor.iv_b64)
+        # Feed the ciphertext in odd-sized pieces to exercise block buffering
+        pieces = iter_file(io.BytesIO(ciphertext), block_size=1000)
+        self.assertEqual(b''.join(decryptor.decrypt_iter(pieces)), self.data)
+
+    def test_stream_matches_whole_file_format(self):
+        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+            temp_file.write(self.data)
+        try:
+            encrypted_data, iv = encrypt_file(temp_file.name, self.key)
+        finally:
+            os.unlink(temp_file.name)
+        decryptor = StreamDecryptor(self.key, iv)
+        self.assertEqual(b''.join(decryptor.decrypt_iter([encrypted_data])), self.data)
+        self.assertEqual(decrypt_file(encrypted_data, self.key, iv), self.data)
+
+    def test_versioned_header(self):
+        encryptor = StreamEncryptor(self.key)
+        ciphertext = b''.join(encryptor.encrypt_iter([self.data]))
+        self.assertTrue(ciphertext.startswith(FORMAT_MAGIC))
+        decryptor = StreamDecryptor(self.key, encryptor.iv_b64)
+        self.assertEqual(b''.join(decryptor.decrypt_iter([ciphertext])), self.data)
+        self.assertEqual(decryptor.format_version, FORMAT_SEGMENTED_V2)
+
+    def _cbc_encrypt(self, aes_key, iv):
+        from cryptography.hazmat.primitives import padding
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+        padder = padding.PKCS7(128).padder()
+        encryptor = Cipher(algorithms.AES(aes_key), modes.CBC(iv)).encryptor()
+        return encryptor.update(padder.update(self.data) + padder.finalize()) + encryptor.finalize()
+
+    def test_legacy_pbkdf2_blob_still_decrypts(self):
+        from base64 import b64decode, b64encode
+        iv = os.urandom(16)
+        legacy = self._cbc_encrypt(derive_key(b64decode(self.key), iv), iv)
+        decryptor = StreamDecryptor(self.key, b64encode(iv).decode('utf-8'))
+        self.assertEqual(b''.join(decryptor.decrypt_iter(iter_file(io.BytesIO(legacy), 10))), self.data)
+        self.assertEqual(decryptor.format_version, FORMAT_LEGACY)
+
+    def test_cbc_v1_blob_still_decrypts(self):
+        from base64 import b64encode
+        nonce = os.urandom(16)
+        blob = pack_header(FORMAT_CBC_V1, KDF_HKDF_SHA256, nonce) + self._cbc_encrypt(
+            hkdf_key(self.key, nonce, CBC_V1_INFO), nonce
+        )
+        decryptor = StreamDecryptor(self.key, b64encode(nonce).decode('utf-8'))
+        self.assertEqual(b''.join(decryptor.decrypt_iter([blob])), self.data)
+        self.assertEqual(decryptor.format_version, FORMAT_CBC_V1)
+
+    def test_cbc_random_access(self):
+        from base64 import b64decode, b64encode
+        iv = os.urandom(16)
+        legacy = self._cbc_encrypt(derive_key(b64decode(self.key), iv), iv)
+        reader = open_reader(io.BytesIO(legacy), self.key, b64encode(iv).decode('utf-8'))
+        self.assertIsInstance(reader, CBCReader)
+        self.assertEqual(reader.size, len(self.data))
+        for start, end in [(0, 5), (15, 17), (100000, 150001), (len(self.data) - 1, len(self.data))]:
+            self.assertEqual(b''.join(reader.iter_range(start, end)), self.data[start:end])
+
+    def test_container_random_access(self):
+        encryptor = StreamEncryptor(self.key, segment_size=4096)
+        blob = b''.join(encryptor.encrypt_iter(iter_file(io.BytesIO(self.data))))
+        reader = ContainerReader(io.BytesIO(blob), self.key, encryptor.iv_b64)
+        self.assertEqual(reader.size, len(self.data))
+        for start, end in [(0, 1), (4095, 4097), (5000, 70000), (len(self.data) - 3, len(self.data))]:
+            self.assertEqual(b''.join(reader.iter_range(start, end)), self.data[start:end])
+
+    def test_container_detects_tampering_and_truncation(self):
+        encryptor = StreamEncryptor(self.key, segment_size=4096)
+        blob = bytearray(b''.join(encryptor.encrypt_iter([self.data])))
+        tampered = bytes(blob[:SEGMENTED_HEADER_SIZE + 5000]) + b'\x00' + bytes(blob[SEGMENTED_HEADER_SIZE + 5001:])
+        reader = ContainerReader(io.BytesIO(tampered), self.key)
+        self.assertEqual(b''.join(reader.iter_range(0, 4096)), self.data[:4096])
+        with self.assertRaises(ValueError):
+            b''.join(reader.iter_range(4096, 8192))
+        # Dropping whole trailing segments must not go unnoticed either
+        truncated = bytes(blob[:SEGMENTED_HEADER_SIZE + 3 * (4096 + 16)])
+        with self.assertRaises(ValueError):
+            b''.join(StreamDecryptor(self.key).decrypt_iter([truncated]))
+
+    def test_empty_file_round_trip(self):
+        encryptor = StreamEncryptor(self.key)
+        blob = b''.join(encryptor.encrypt_iter([]))
+        self.assertEqual(b''.join(StreamDecryptor(self.key, encryptor.iv_b64).decrypt_iter([blob])), b'')
+
+    def test_wrong_key_fails(self):
+        encryptor = StreamEncryptor(self.key)
+        ciphertext = b''.join(encryptor.encrypt_iter([self.data]))
+        decryptor = StreamDecryptor(generate_encryption_key(), encryptor.iv_b64)
+        with self.assertRaises(ValueError):
+            b''.join(decryptor.decrypt_iter([ciphertext]))
+
+class RangeHeaderTests(TestCase):
+    def test_single_and_suffix_ranges(self):
+        self.assertEqual(parse_range_header('bytes=0-99', 1000), [(0, 100)])
+        self.assertEqual(parse_range_header('bytes=900-', 1000), [(900, 1000)])
+        self.assertEqual(parse_range_header('bytes=-100', 1000), [(900, 1000)])
+        self.assertEqual(parse_range_header('bytes=990-2000', 1000), [(990, 1000)])
+
+    def test_multiple_ranges_are_coalesced(self):
+        self.assertEqual(
+            parse_range_header('bytes=500-599, 0-9, 5-20', 1000),
+            [(0, 21), (500, 600)]
+        )
+
+    def test_unsatisfiable_and_invalid(self):
+        self.assertEqual(parse_range_header('bytes=1000-', 1000), [])
+        self.assertIsNone(parse_range_header('items=0-1', 1000))
+        self.assertIsNone(parse_range_header('bytes=5-1', 1000))
+        self.assertIsNone(parse_range_header('bytes=abc', 1000))
+
+def store_encrypted_file(owner, data, name='test.bin', mime_type='application/octet-stream'):
+    """Create a completed File whose encrypted blob really exists in storage."""
+    file = File.objects.create(
+        owner=owner,
+        name=name,
+        original_name=name,
+        mime_type=mime_type,
+        size=len(data),
+        encryption_key=generate_encryption_key(),
+        encrypted_path=f"{uuid.uuid4()}/{name}",
+        iv='',
+        checksum='',
+        status=File.Status.COMPLETED,
+        upload_completed_at=timezone.now()
+    )
+    encryptor = StreamEncryptor(file.encryption_key, segment_size=4096)
+    default_storage.save(file.get_file_path(), io.BytesIO(b''.join(encryptor.encrypt_iter([data]))))
+    file.iv = encryptor.iv_b64
+    file.checksum = hashlib.sha256(data).hexdigest()
+    file.save()
+    return file
+
+@override_settings(SECURE_SSL_REDIRECT=False, MEDIA_ROOT=tempfile.mkdtemp())
+class FileRangeAPITests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='rangeuser',
+            email='range@example.com',
+            password='testpass123'
+        )
+        self.client.force_authenticate(user=self.user)
+        self.data = os.urandom(50000)
+        self.file = store_encrypted_file(self.user, self.data)
+
+    def read(self, response):
+        return b''.join(response.streaming_content) if response.streaming else response.content
+
+    def test_full_download_advertises_ranges(self):
+        response = self.client.get(f'/api/files/{self.file.id}/download/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(self.read(response), self.data)
+
+    def test_full_download_is_streamed(self):
+        response = self.client.get(f'/api/files/{self.file.id}/content/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Length'], str(len(self.data)))
+        self.assertEqual(self.read(response), self.data)
+
+    def test_single_range(self):
+        response = self.client.get(
+            f'/api/files/{self.file.id}/content/', HTTP_RANGE='bytes=10000-10999'
+        )
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(response['Content-Range'], f'bytes 10000-10999/{len(self.data)}')
+        self.assertEqual(response['Content-Length'], '1000')
+        self.assertEqual(self.read(response), self.data[10000:11000])
+
+    def test_multi_range(self):
+        response = self.client.get(
+            f'/api/files/{self.file.id}/download/', HTTP_RANGE='bytes=0-4,-5'
+        )
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertTrue(response['Content-Type'].startswith('multipart/byteranges'))
+        body = self.read(response)
+        self.assertEqual(len(body), int(response['Content-Length']))
+        self.assertIn(self.data[:5], body)
+        self.assertIn(self.data[-5:], body)
+
+    def test_unsatisfiable_range(self):
+        response = self.client.get(
+            f'/api/files/{self.file.id}/download/', HTTP_RANGE='bytes=60000-'
+        )
+        self.assertEqual(response.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(self.data)}')
+
+    def test_stale_if_range_gets_full_body(self):
+        response = self.client.get(
+            f'/api/files/{self.file.id}/download/',
+            HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.read(response), self.data)
+
+@override_settings(SECURE_SSL_REDIRECT=False, MEDIA_ROOT=tempfile.mkdtemp())
+class FileDeliveryTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='deliveryuser',
+            email='delivery@example.com',
+            password='testpass123'
+        )
+        self.client.force_authenticate(user=self.user)
+        self.data = b'hello, world\n' * 100
+        self.file = store_encrypted_file(self.user, self.data, name='notes.txt', mime_type='')
+
+    def deliver(self, policy, **headers):
+        request = RequestFactory().get('/', **headers)
+        return delivery.deliver_file(request, self.file, policy)
+
+    def test_content_type_falls_back_to_file_name(self):
+        self.assertEqual(delivery.resolve_content_type(self.file), 'text/plain')
+
+    def test_header_policies(self):
+        response = self.deliver(delivery.ATTACHMENT)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="notes.txt"')
+        self.assertEqual(response['X-Content-Type-Options'], 'nosniff')
+        self.assertFalse(response.has_header('X-Download-Options'))
+
+        response = self.deliver(delivery.VIEW_ONLY)
+        self.assertEqual(response['Content-Disposition'], 'inline')
+        self.assertEqual(response['X-Download-Options'], 'noopen')
+        self.assertIn("object-src 'none'", response['Content-Security-Policy'])
+
+    def test_streams_content_with_timing(self):
+        response = self.deliver(delivery.INLINE, HTTP_RANGE='bytes=0-4')
+        self.assertEqual(response.status_code, 206)
+        self.assertTrue(response['Server-Timing'].startswith('open;dur='))
+        with self.assertLogs('files.delivery', level='INFO') as logs:
+            self.assertEqual(b''.join(response.streaming_content), b'hello')
+        self.assertIn('bytes=5', logs.output[0])
+
+    def test_missing_blob(self):
+        default_storage.delete(self.file.get_file_path())
+        with self.assertRaises(delivery.FileNotFoundError):
+            self.deliver(delivery.INLINE)
+        response = self.client.get(f'/api/files/{self.file.id}/download/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+class NginxStandIn:
+    """
+    Just enough of the nginx in deploy/nginx.conf, in front of the test
+    client, to follow X-Accel-Redirect into its internal location (whose
+    alias stands for MEDIA_ROOT) and serve a range of the object.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        with open(settings.BASE_DIR.parent / 'deploy' / 'nginx.conf') as f:
+            self.internal = re.search(r'location (\S+) \{\s*internal;', f.read()).group(1)
+
+    def get(self, url, **headers):
+        """Returns the response the backend gave and the body nginx sends."""
+        response = self.client.get(url, **headers)
+        target = response.get('X-Accel-Redirect')
+        if not target:
+            return response, b''.join(response.streaming_content)
+        assert target.startswith(self.internal), target
+        with open(os.path.join(settings.MEDIA_ROOT, unquote(target[len(self.internal):])), 'rb') as f:
+            data = f.read()
+        ranges = parse_range_header(headers.get('HTTP_RANGE'), len(data))
+        if ranges:
+            return response, b''.join(data[start:end] for start, end in ranges)
+        return response, data
+
+@override_settings(SECURE_SSL_REDIRECT=False, MEDIA_ROOT=tempfile.mkdtemp())
+class DeliveryOffloadTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='offloader',
+            email='offloader@example.com',
+            password='testpass123'
+        )
+        self.client.force_authenticate(user=self.user)
+        self.ciphertext = os.urandom(20000)
+        self.file = File.objects.create(
+            owner=self.user,
+            name='secret.txt',
+            original_name='secret.txt',
+            mime_type='text/plain',
+            size=len(self.ciphertext),
+            encryption_key='',
+            encrypted_path=f"{uuid.uuid4()}/secret.txt",
+            iv='',
+            checksum=hashlib.sha256(self.ciphertext).hexdigest(),
+            client_encrypted=True,
+            client_key_metadata={'wrapped_key': 'a2V5'},
+            status=File.Status.COMPLETED,
+            upload_completed_at=timezone.now()
+        )
+        default_storage.save(self.file.get_file_path(), io.BytesIO(self.ciphertext))
+        self.url = f'/api/files/{self.file.id}/download/'
+
+    @override_settings(FILE_DELIVERY_OFFLOAD=delivery.X_ACCEL_REDIRECT)
+    def test_x_accel_redirect_through_nginx(self):
+        nginx = NginxStandIn(self.client)
+        response, body = nginx.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(body, self.ciphertext)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="secret.txt"')
+        self.assertEqual(response['ETag'], f'"{self.file.checksum}"')
+
+        response, body = nginx.get(self.url, HTTP_RANGE='bytes=100-199')
+        self.assertEqual(body, self.ciphertext[100:200])
+
+        # Content the server decrypts is never handed off
+        other = store_encrypted_file(self.user, b'plaintext' * 100)
+        response, body = nginx.get(f'/api/files/{other.id}/download/')
+        self.assertFalse(response.has_header('X-Accel-Redirect'))
+        self.assertEqual(body, b'plaintext' * 100)
+
+    @override_settings(FILE_DELIVERY_OFFLOAD=delivery.X_SENDFILE)
+    def test_x_sendfile(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response['X-Sendfile'], default_storage.path(self.file.get_file_path()))
+        self.assertEqual(response.content, b'')
+
+    @override_settings(FILE_DELIVERY_OFFLOAD=delivery.SENDFILE)
+    def test_wsgi_file_wrapper(self):
+        # The test client wraps streamed bodies, hiding file_to_stream
+        with self.assertLogs('files.delivery', level='INFO') as logs:
+            response = delivery.deliver_file(RequestFactory().get(self.url), self.file)
+        self.assertIsNotNone(response.file_to_stream)
+        self.assertIn(f'bytes={len(self.ciphertext)}', logs.output[0])
+        self.assertEqual(b''.join(response.streaming_content), self.ciphertext)
+        response.close()
+
+        # Ranges are left to the usual streaming path
+        response = self.client.get(self.url, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(b''.join(response.streaming_content), self.ciphertext[10:20])
+
+class ContentCacheTests(TestCase):
+    def test_entries_are_sealed_and_evicted_to_disk(self):
+        disk_dir = tempfile.mkdtemp()
+        store = ContentCache(memory_size=3100, disk_size=3100, disk_dir=disk_dir)
+        for n in range(4):
+            store.put(('file', n), bytes([n]) * 1000)
+        # The oldest spilled to disk, sealed
+        spilled = [os.path.join(root, name) for root, _, names in os.walk(disk_dir) for name in names]
+        self.assertEqual(len(spilled), 1)
+        with open(spilled[0], 'rb') as f:
+            self.assertNotIn(b'\x00' * 100, f.read())
+
+        self.assertEqual(store.get(('file', 0)), b'\x00' * 1000)
+        self.assertEqual(store.get(('file', 3)), b'\x03' * 1000)
+        self.assertIsNone(store.get(('file', 4)))
+
+        # Another process's key cannot open the entries
+        other = ContentCache(memory_size=3100)
+        with self.assertRaises(Exception):
+            other._open(('file', 3), store._memory[('file', 3)][1])
+
+        store.discard('file')
+        self.assertIsNone(store.get(('file', 3)))
+        self.assertEqual(os.listdir(store._disk_dir), [])
+
+    def test_ttl_and_size_bounds(self):
+        store = ContentCache(memory_size=2500, ttl=60)
+        store.put(('a', 0), b'x' * 1000)
+        store.put(('b', 0), b'y' * 1000)
+        store.get(('a', 0))
+        store.put(('c', 0), b'z' * 1000)
+        # b was the least recently used and there is no disk tier
+        self.assertIsNone(store.get(('b', 0)))
+        self.assertEqual(store.get(('a', 0)), b'x' * 1000)
+
+        with mock.patch('files.content_cache.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertIsNone(store.get(('a', 0)))
+        store.put(('huge', 0), b'x' * 5000)
+        self.assertIsNone(store.get(('huge', 0)))
+
+@override_settings(
+    SECURE_SSL_REDIRECT=False,
+    MEDIA_ROOT=tempfile.mkdtemp(),
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    DELIVERY_SEGMENT_SIZE=4096
+)
+class HotShareLinkTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='publisher',
+            email='publisher@example.com',
+            password='testpass123'
+        )
+        self.client.force_authenticate(user=self.user)
+        self.data = os.urandom(20000)
+        self.file = store_encrypted_file(self.user, self.data, 'brochure.pdf', 'application/pdf')
+        self.link = ShareLink.objects.create(
+            file=self.file,
+            created_by=self.user,
+            token='hot-link',
+            expires_at=timezone.now() + timezone.timedelta(days=1)
+        )
+        self.url = '/api/sharing/public/links/hot-link/view/'
+        content_cache().clear()
+
+    def view(self, **headers):
+        with mock.patch('files.delivery.open_reader', wraps=delivery.open_reader) as opened:
+            response = self.client.get(self.url, **headers)
+            self.assertIn(response.status_code, (status.HTTP_200_OK, status.HTTP_206_PARTIAL_CONTENT))
+            body = b''.join(response.streaming_content)
+        return body, opened.call_count
+
+    def test_repeat_views_skip_decryption(self):
+        self.assertEqual(self.view(), (self.data, 1))
+        self.assertEqual(self.view(), (self.data, 0))
+        self.assertEqual(self.view(HTTP_RANGE='bytes=5000-9999'), (self.data[5000:10000], 0))
+
+    def test_ranges_fill_the_cache_segment_by_segment(self):
+        self.assertEqual(self.view(HTTP_RANGE='bytes=100-199'), (self.data[100:200], 1))
+        self.assertEqual(self.view(HTTP_RANGE='bytes=0-4095'), (self.data[:4096], 0))
+        self.assertEqual(self.view(), (self.data, 1))
+        self.assertEqual(self.view(), (self.data, 0))
+
+    def test_new_version_and_revocation_invalidate(self):
+        self.view()
+        invalidate(self.file.pk)
+        self.assertEqual(self.view(), (self.data, 1))
+
+        # A new version changes the checksum and bumps the generation
+        response = self.client.generic(
+            'PUT', f'/api/files/{self.file.id}/versions/upload/',
+            encode_delta([(LITERAL, b'new content')]),
+            content_type='application/octet-stream', HTTP_X_BASE_VERSION='1'
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.view(), (b'new content', 1))
+
+        generation = cache_generation(self.file.pk)
+        response = self.client.delete(f'/api/sharing/share-links/{self.link.id}/')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(cache_generation(self.file.pk), generation + 1)
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_403_FORBIDDEN)
+
+class JoinCountingEvent(threading.Event):
+    """An Event that counts, on a semaphore, the callers waiting on it."""
+
+    def __init__(self):
+        super().__init__()
+        self.joined = threading.Semaphore(0)
+
+    def wait(self, timeout=None):
+        self.joined.release()
+        return super().wait(timeout)
+
+class JoinCountingFlight(_Flight):
+    def __init__(self):
+        super().__init__()
+        self.landed = JoinCountingEvent()
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), DELIVERY_SEGMENT_SIZE=4096)
+class SingleFlightTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='herd',
+            email='herd@example.com',
+            password='testpass123'
+        )
+        patcher = mock.patch('files.singleflight._Flight', JoinCountingFlight)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def hold_until_joined(self, flights, key, followers):
+        """Keep the flight for key in the air until followers callers wait on it."""
+        joined = flights._flights[key].landed.joined
+        for _ in range(followers):
+            if not joined.acquire(timeout=10):
+                raise AssertionError(f"Callers never joined the flight for {key}")
+
+    def run_together(self, count, fn):
+        """Call fn from count threads released at once; returns results and errors."""
+        barrier = threading.Barrier(count)
+        results, errors = [], []
+
+        def run():
+            barrier.wait()
+            try:
+                results.append(fn())
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results, errors
+
+    def test_concurrent_callers_share_one_call(self):
+        flights = SingleFlight()
+        calls = []
+
+        def work():
+            calls.append(1)
+            self.hold_until_joined(flights, 'key', 7)
+            return b'result'
+
+        results, errors = self.run_together(8, lambda: flights.do('key', work))
+        self.assertEqual(results, [b'result'] * 8)
+        self.assertEqual(len(calls), 1)
+
+        def fail():
+            self.hold_until_joined(flights, 'key', 3)
+            raise ValueError("broken")
+
+        results, errors = self.run_together(4, lambda: flights.do('key', fail))
+        self.assertEqual(len(errors), 4)
+        # Nothing lingers once the flight has landed
+        self.assertEqual(flights.do('key', lambda: b'again'), b'again')
+
+    def test_herd_costs_one_decryption(self):
+        data = os.urandom(4096 * 3 + 10)
+        file = store_encrypted_file(self.user, data)
+        read_segment = SegmentReader._read_segment
+        reads = []
+
+        def slow_read(reader, index):
+            reads.append(index)
+            self.hold_until_joined(shared_flights, reader._prefix + (index,), 7)
+            return read_segment(reader, index)
+
+        def download():
+            response = delivery.deliver_file(RequestFactory().get('/'), file)
+            try:
+                return b''.join(response.streaming_content)
+            finally:
+                response.close()
+
+        with mock.patch.object(SegmentReader, '_read_segment', slow_read):
+            results, errors = self.run_together(8, download)
+        self.assertEqual(errors, [])
+        self.assertEqual(results, [data] * 8)
+        self.assertEqual(sorted(reads), [0, 1, 2, 3])
+
+@override_settings(
+    SECURE_SSL_REDIRECT=False, MEDIA_ROOT=tempfile.mkdtemp(),
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+)
+class ChunkedUploadTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='uploader',
+            email='uploader@example.com',
+            password='testpass123'
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def initialize(self, data, chunk_size=SEGMENT_SIZE):
+        response = self.client.post('/api/files/upload/initialize/', {
+            'name': 'upload.txt',
+            'mime_type': 'text/plain',
+            'size': len(data),
+            'chunk_size': chunk_size
+        })
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response.data['id']
+
+    def upload_chunk(self, file_id, number, data):
+        return self.client.post(
+            f'/api/files/upload/{file_id}/chunk/',
+            {'chunk': SimpleUploadedFile('chunk', data), 'chunk_number': number},
+            format='multipart'
+        )
+
+    def complete(self, file_id):
+        """Complete an upload, running the finalization task as a worker would."""
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post(f'/api/files/upload/{file_id}/complete/')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data['status'], File.Status.PROCESSING)
+        self.assertEqual(len(callbacks), 1)
+        finalize_upload(file_id)
+
+        response = self.client.get(f'/api/files/upload/{file_id}/status/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_chunks_are_encrypted_on_arrival(self):
+        data = os.urandom(SEGMENT_SIZE * 3 + 100)
+        file_id = self.initialize(data)
+        chunks = [data[i:i + SEGMENT_SIZE] for i in range(0, len(data), SEGMENT_SIZE)]
+        # Arrival order does not matter; each chunk has a fixed place
+        for number in (3, 1, 0, 2):
+            response = self.upload_chunk(file_id, number, chunks[number])
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        file = File.objects.get(pk=file_id)
+        with default_storage.open(file.get_file_path(), 'rb') as f:
+            self.assertNotIn(chunks[0][:64], f.read())
+
+        result = self.complete(file_id)
+        self.assertEqual(result['status'], File.Status.COMPLETED)
+        self.assertEqual(result['file']['size'], len(data))
+        self.assertFalse(UploadSession.objects.filter(file_id=file_id).exists())
+        self.assertTrue(FileVersion.objects.filter(file_id=file_id, version_number=1).exists())
+
+        # Out of order, so the checksum falls back to the chunk tree hash
+        self.assertEqual(result['file']['checksum_algorithm'], File.ChecksumAlgorithm.SHA256_TREE)
+        self.assertEqual(result['file']['checksum'], combine_chunk_hashes(
+            hashlib.sha256(chunk).hexdigest() for chunk in chunks
+        ))
+        # The leaf size outlives the session, so the checksum stays checkable
+        file = File.objects.get(pk=file_id)
+        version = file.versions.get()
+        self.assertEqual(file.checksum_chunk_size, SEGMENT_SIZE)
+        self.assertEqual(
+            (version.checksum, version.checksum_algorithm, version.checksum_chunk_size),
+            (file.checksum, file.checksum_algorithm, file.checksum_chunk_size)
+        )
+        size = file.checksum_chunk_size
+        self.assertEqual(file.checksum, combine_chunk_hashes(
+            hashlib.sha256(data[i:i + size]).hexdigest() for i in range(0, len(data), size)
+        ))
+
+        response = self.client.get(f'/api/files/{file_id}/download/')
+        self.assertEqual(b''.join(response.streaming_content), data)
+
+    def test_in_order_upload_gets_whole_file_hash(self):
+        data = os.urandom(SEGMENT_SIZE * 2)
+        file_id = self.initialize(data)
+        for number in range(2):
+            self.upload_chunk(file_id, number, data[number * SEGMENT_SIZE:(number + 1) * SEGMENT_SIZE])
+        self.assertEqual(
+            UploadSession.objects.get(file_id=file_id).manifest.sha256, hashlib.sha256(data).hexdigest()
+        )
+
+        result = self.complete(file_id)
+        self.assertEqual(result['file']['checksum_algorithm'], File.ChecksumAlgorithm.SHA256)
+        self.assertEqual(result['file']['checksum'], hashlib.sha256(data).hexdigest())
+
+    def test_resent_chunks_keep_whole_file_hash(self):
+        data = os.urandom(SEGMENT_SIZE * 3)
+        chunks = [data[i:i + SEGMENT_SIZE] for i in range(0, len(data), SEGMENT_SIZE)]
+        file_id = self.initialize(data)
+        for number in range(3):
+            self.upload_chunk(file_id, number, chunks[number])
+
+        # Re-sending chunk 0 after the hash is finished must not leave a
+        # hash of other content behind
+        self.assertEqual(self.upload_chunk(file_id, 0, chunks[0]).status_code, status.HTTP_200_OK)
+        response = self.upload_chunk(file_id, 0, os.urandom(SEGMENT_SIZE))
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(self.upload_raw_chunk(file_id, 2, chunks[2]).status_code, status.HTTP_200_OK)
+        manifest = UploadSession.objects.get(file_id=file_id).manifest
+        self.assertEqual(manifest.sha256, hashlib.sha256(data).hexdigest())
+
+        # A chunk written twice at once drops the hash for the tree hash
+        with mock.patch('files.manifest.UploadManifest.chunk_digest', return_value=''):
+            response = self.upload_chunk(file_id, 0, chunks[0])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(manifest.sha256, '')
+
+        result = self.complete(file_id)
+        self.assertEqual(result['file']['checksum_algorithm'], File.ChecksumAlgorithm.SHA256_TREE)
+        self.assertEqual(result['file']['checksum'], combine_chunk_hashes(
+            hashlib.sha256(chunk).hexdigest() for chunk in chunks
+        ))
+        response = self.client.get(f'/api/files/{file_id}/download/')
+        self.assertEqual(b''.join(response.streaming_content), data)
+
+    def test_chunks_do_not_write_to_database(self):
+        data = os.urandom(SEGMENT_SIZE * 2)
+        file_id = self.initialize(data)
+        with CaptureQueriesContext(connection) as queries:
+            for number in range(2):
+                self.upload_chunk(file_id, number, data[number * SEGMENT_SIZE:(number + 1) * SEGMENT_SIZE])
+        self.assertFalse([q for q in queries if not q['sql'].startswith('SELECT')])
+
+        # Completing moves the manifest onto the session row
+        with mock.patch.object(finalize_upload, 'delay') as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(f'/api/files/upload/{file_id}/complete/')
+        delay.assert_called_once_with(str(file_id))
+        session = UploadSession.objects.get(file_id=file_id)
+        self.assertEqual(session.chunk_digests(), [
+            hashlib.sha256(data[:SEGMENT_SIZE]).hexdigest(),
+            hashlib.sha256(data[SEGMENT_SIZE:]).hexdigest()
+        ])
+        self.assertEqual(session.manifest.received_chunks(), [])
+
+    def test_empty_upload(self):
+        file_id = self.initialize(b'')
+        self.assertEqual(self.complete(file_id)['status'], File.Status.COMPLETED)
+        response = self.client.get(f'/api/files/{file_id}/download/')
+        self.assertEqual(b''.join(response.streaming_content), b'')
+
+    def test_chunks_must_match_declared_layout(self):
+        file_id = self.initialize(b'x' * (SEGMENT_SIZE + 10))
+        response = self.upload_chunk(file_id, 0, b'x' * 10)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.upload_chunk(file_id, 2, b'x' * 10)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # Contiguous from zero is not enough; the declared total must arrive
+        self.upload_chunk(file_id, 0, b'x' * SEGMENT_SIZE)
+        response = self.client.post(f'/api/files/upload/{file_id}/complete/')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_failed_finalization_is_reported(self):
+        file_id = self.initialize(b'x' * 10)
+        self.upload_chunk(file_id, 0, b'x' * 10)
+        with self.captureOnCommitCallbacks():
+            self.client.post(f'/api/files/upload/{file_id}/complete/')
+        default_storage.delete(File.objects.get(pk=file_id).get_file_path())
+        finalize_upload(file_id)
+
+        response = self.client.get(f'/api/files/upload/{file_id}/status/')
+        self.assertEqual(response.data['status'], File.Status.FAILED)
+        self.assertTrue(response.data['error'])
+
+    def test_finalization_runs_once(self):
+        data = os.urandom(SEGMENT_SIZE + 10)
+        file_id = self.initialize(data)
+        for number in range(2):
+            self.upload_chunk(file_id, number, data[number * SEGMENT_SIZE:(number + 1) * SEGMENT_SIZE])
+        with self.captureOnCommitCallbacks():
+            self.client.post(f'/api/files/upload/{file_id}/complete/')
+
+        # Until a worker is done, clients are told when to ask again
+        response = self.client.get(f'/api/files/upload/{file_id}/status/')
+        self.assertEqual(response.data['status'], File.Status.PROCESSING)
+        self.assertEqual(response['Retry-After'], str(settings.STATUS_POLL_INTERVAL))
+
+        # A duplicate delivery, even one arriving after sealing, is a no-op
+        finalize_upload(file_id)
+        finalize_upload(file_id)
+        file = File.objects.get(pk=file_id)
+        self.assertEqual(file.status, File.Status.COMPLETED)
+        self.assertEqual(FileVersion.objects.filter(file_id=file_id).count(), 1)
+        response = self.client.get(f'/api/files/upload/{file_id}/status/')
+        self.assertNotIn('Retry-After', response)
+
+        # Sealing is idempotent too
+        with default_storage.open(file.get_file_path(), 'rb') as f:
+            sealed = f.read()
+        with default_storage.open(file.get_file_path(), 'r+b') as f:
+            ContainerWriter(f, file.encryption_key, file.iv).seal(len(data))
+        with default_storage.open(file.get_file_path(), 'rb') as f:
+            self.assertEqual(f.read(), sealed)
+        response = self.client.get(f'/api/files/{file_id}/download/')
+        self.assertEqual(b''.join(response.streaming_content), data)
+
+    def test_failure_after_session_delete_is_reported(self):
+        file_id = self.initialize(b'x' * 10)
+        self.upload_chunk(file_id, 0, b'x' * 10)
+        with self.captureOnCommitCallbacks():
+            self.client.post(f'/api/files/upload/{file_id}/complete/')
+        with mock.patch.object(FileVersion.objects, 'create', side_effect=RuntimeError("Version row refused")):
+            finalize_upload(file_id)
+
+        response = self.client.get(f'/api/files/upload/{file_id}/status/')
+        self.assertEqual(response.data['status'], File.Status.FAILED)
+        self.assertEqual(response.data['error'], "Version row refused")
+
+    def test_resume_after_interruption(self):
+        data = os.urandom(SEGMENT_SIZE * 2 + 5)
+        chunks = [data[i:i + SEGMENT_SIZE] for i in range(0, len(data), SEGMENT_SIZE)]
+        file_id = self.initialize(data)
+        self.upload_chunk(file_id, 0, chunks[0])
+        self.upload_chunk(file_id, 2, chunks[2])
+
+        response = self.client.get(f'/api/files/upload/{file_id}/chunks/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['received_chunks'], [0, 2])
+        self.assertEqual(response.data['received_bytes'], SEGMENT_SIZE + 5)
+        self.assertEqual(response.data['received_bitmap'], 'BQ==')
+
+        # Retrying a stored chunk is a no-op, with or without its checksum
+        response = self.upload_chunk(file_id, 0, chunks[0])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.post(
+            f'/api/files/upload/{file_id}/chunk/',
+            {
+                'chunk': SimpleUploadedFile('chunk', chunks[2]),
+                'chunk_number': 2,
+                'checksum': hashlib.sha256(chunks[2]).hexdigest()
+            },
+            format='multipart'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(UploadSession.objects.get(file_id=file_id).manifest.received_chunks(), [0, 2])
+
+        self.upload_chunk(file_id, 1, chunks[1])
+        self.assertEqual(self.complete(file_id)['status'], File.Status.COMPLETED)
+        response = self.client.get(f'/api/files/{file_id}/download/')
+        self.assertEqual(b''.join(response.streaming_content), data)
+
+    def test_changed_chunk_conflicts(self):
+        data = os.urandom(SEGMENT_SIZE * 2)
+        chunks = [data[:SEGMENT_SIZE], data[SEGMENT_SIZE:]]
+        file_id = self.initialize(data)
+        for number in range(2):
+            self.upload_chunk(file_id, number, chunks[number])
+
+        response = self.upload_chunk(file_id, 0, os.urandom(SEGMENT_SIZE))
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        response = self.upload_raw_chunk(file_id, 1, os.urandom(SEGMENT_SIZE))
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        response = self.upload_raw_chunk(file_id, 1, chunks[1])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # A broken retry of a recorded chunk leaves it, and the container, intact
+        file = File.objects.get(pk=file_id)
+        session = UploadSession.objects.get(file_id=file_id)
+        with self.assertRaises(ChunkUploadError):
+            write_chunk(file, session, 0, ContentFile(chunks[0][:-1]))
+        with self.assertRaises(ChunkUploadError):
+            write_chunk(file, session, 0, ContentFile(chunks[0]), '0' * 64)
+        self.assertEqual(session.manifest.received_chunks(), [0, 1])
+
+        self.assertEqual(self.complete(file_id)['status'], File.Status.COMPLETED)
+        response = self.client.get(f'/api/files/{file_id}/download/')
+        self.assertEqual(b''.join(response.streaming_content), data)
+
+    def test_interrupted_chunk_keeps_its_content(self):
+        data = os.urandom(SEGMENT_SIZE * 3)
+        chunks = [data[i:i + SEGMENT_SIZE] for i in range(0, len(data), SEGMENT_SIZE)]
+        file_id = self.initialize(data)
+        self.upload_chunk(file_id, 0, chunks[0])
+
+        # The write dies after sealing the segment
+        write_segments = ContainerWriter.write_segments
+        def dying_write(writer, first_index, blocks):
+            write_segments(writer, first_index, blocks)
+            raise OSError("Disk went away")
+        with mock.patch.object(ContainerWriter, 'write_segments', dying_write):
+            response = self.upload_chunk(file_id, 1, chunks[1])
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        session = UploadSession.objects.get(file_id=file_id)
+        self.assertEqual(session.manifest.received_chunks(), [0])
+
+        # Sealing that segment over anything else would reuse its nonce
+        file = File.objects.get(pk=file_id)
+        with default_storage.open(file.get_file_path(), 'rb') as f:
+            sealed = f.read()
+        response = self.upload_chunk(file_id, 1, os.urandom(SEGMENT_SIZE))
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        with default_storage.open(file.get_file_path(), 'rb') as f:
+            self.assertEqual(f.read(), sealed)
+
+        for number in (1, 2):
+            response = self.upload_chunk(file_id, number, chunks[number])
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.complete(file_id)['status'], File.Status.COMPLETED)
+        response = self.client.get(f'/api/files/{file_id}/download/')
+        self.assertEqual(b''.join(response.streaming_content), data)
+
+    def test_checksum_mismatch_is_rejected(self):
+        file_id = self.initialize(b'x' * 10)
+        response = self.client.post(
+            f'/api/files/upload/{file_id}/chunk/',
+            {'chunk': SimpleUploadedFile('chunk', b'x' * 10), 'chunk_number': 0, 'checksum': '0' * 64},
+            format='multipart'
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(UploadSession.objects.get(file_id=file_id).manifest.received_chunks(), [])
+
+    def test_expired_session(self):
+        file_id = self.initialize(b'x' * 10)
+        UploadSession.objects.filter(file_id=file_id).update(expires_at=timezone.now())
+        response = self.upload_chunk(file_id, 0, b'x' * 10)
+        self.assertEqual(response.status_code, status.HTTP_410_GONE)
+        response = self.client.get(f'/api/files/upload/{file_id}/chunks/')
+        self.assertEqual(response.status_code, status.HTTP_410_GONE)
+
+    def test_small_upload_in_one_request(self):
+        data = b'small document\n' * 100
+        response = self.client.post('/api/files/upload/', {
+            'file': SimpleUploadedFile('notes.txt', data, content_type='text/plain'),
+            'description': 'notes'
+        }, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['status'], File.Status.COMPLETED)
+        self.assertEqual(response.data['name'], 'notes.txt')
+        self.assertEqual(response.data['checksum'], hashlib.sha256(data).hexdigest())
+        self.assertEqual(response.data['latest_version']['version_number'], 1)
+
+        response = self.client.get(f"/api/files/{response.data['id']}/download/")
+        self.assertEqual(b''.join(response.streaming_content), data)
+
+    @override_settings(SMALL_UPLOAD_MAX_SIZE=10)
+    def test_small_upload_threshold(self):
+        response = self.client.post('/api/files/upload/', {
+            'file': SimpleUploadedFile('notes.txt', b'x' * 11, content_type='text/plain')
+        }, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(File.objects.exists())
+
+    def test_batch_upload(self):
+        contents = [f'document {n}\n'.encode() * (n + 1) for n in range(5)]
+        response = self.client.post('/api/files/upload/batch/', {'files': [
+            {'name': f'doc{n}.txt', 'mime_type': 'text/plain', 'size': len(data)}
+            for n, data in enumerate(contents)
+        ]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        batch_id = response.data['id']
+        file_ids = [entry['id'] for entry in response.data['files']]
+        self.assertEqual([entry['name'] for entry in response.data['files']],
+                         [f'doc{n}.txt' for n in range(5)])
+
+        # Bodies can be spread over several multipart requests
+        for part in (slice(0, 3), slice(3, 5)):
+            response = self.client.post(f'/api/files/upload/batch/{batch_id}/content/', {
+                str(file_id): SimpleUploadedFile('blob', data)
+                for file_id, data in zip(file_ids[part], contents[part])
+            }, format='multipart')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        response = self.client.post(f'/api/files/upload/batch/{batch_id}/complete/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            File.objects.filter(id__in=file_ids, status=File.Status.COMPLETED).count(), 5
+        )
+        self.assertEqual(FileVersion.objects.filter(file_id__in=file_ids).count(), 5)
+        response = self.client.get(f'/api/files/{file_ids[4]}/download/')
+        self.assertEqual(b''.join(response.streaming_content), contents[4])
+
+    def test_batch_entries_must_be_objects(self):
+        response = self.client.post('/api/files/upload/batch/', {'files': [
+            {'name': 'a.txt', 'mime_type': 'text/plain', 'size': 1},
+            ['b.txt'],
+        ]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['index'], 1)
+        self.assertFalse(File.objects.exists())
+
+    def test_batch_upload_requires_every_body(self):
+        response = self.client.post('/api/files/upload/batch/', {'files': [
+            {'name': 'a.txt', 'mime_type': 'text/plain', 'size': 1},
+            {'name': 'b.txt', 'mime_type': 'text/plain', 'size': 1},
+        ]}, format='json')
+        batch_id = response.data['id']
+        file_id = response.data['files'][0]['id']
+        self.client.post(f'/api/files/upload/batch/{batch_id}/content/', {
+            str(file_id): SimpleUploadedFile('blob', b'a')
+        }, format='multipart')
+
+        response = self.client.post(f'/api/files/upload/batch/{batch_id}/complete/')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(len(response.data['files']), 1)
+        self.assertFalse(File.objects.filter(status=File.Status.COMPLETED).exists())
+
+    def test_chunk_size_must_align_with_segments(self):
+        response = self.client.post('/api/files/upload/initialize/', {
+            'name': 'upload.txt',
+            'mime_type': 'text/plain',
+            'chunk_size': SEGMENT_SIZE + 1
+        })
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def upload_raw_chunk(self, file_id, number, data, **headers):
+        return self.client.generic(
+            'PUT', f'/api/files/upload/{file_id}/chunk/raw/', data,
+            content_type='application/octet-stream',
+            HTTP_X_CHUNK_INDEX=str(number), **headers
+        )
+
+    def test_raw_chunk_upload(self):
+        data = os.urandom(SEGMENT_SIZE * 2 + 10)
+        file_id = self.initialize(data)
+        for number in range(3):
+            chunk = data[number * SEGMENT_SIZE:(number + 1) * SEGMENT_SIZE]
+            response = self.upload_raw_chunk(
+                file_id, number, chunk,
+                HTTP_X_CHUNK_OFFSET=str(number * SEGMENT_SIZE),
+                HTTP_X_CHUNK_CHECKSUM=hashlib.sha256(chunk).hexdigest()
+            )
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        # A retry carrying the checksum is recognised without the body
+        response = self.upload_raw_chunk(
+            file_id, 0, data[:SEGMENT_SIZE],
+            HTTP_X_CHUNK_CHECKSUM=hashlib.sha256(data[:SEGMENT_SIZE]).hexdigest()
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        result = self.complete(file_id)
+        self.assertEqual(result['file']['checksum_algorithm'], File.ChecksumAlgorithm.SHA256)
+        self.assertEqual(result['file']['checksum'], hashlib.sha256(data).hexdigest())
+        response = self.client.get(f'/api/files/{file_id}/download/')
+        self.assertEqual(b''.join(response.streaming_content), data)
+
+    @override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=1024, MAX_CHUNK_SIZE=SEGMENT_SIZE * 2)
+    def test_raw_chunks_stay_in_memory(self):
+        data = os.urandom(SEGMENT_SIZE * 3)
+        response = self.client.post('/api/files/upload/initialize/', {
+            'name': 'upload.txt', 'mime_type': 'text/plain',
+            'size': len(data), 'chunk_size': SEGMENT_SIZE * 4
+        })
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # Held up to the chunk size rather than Django's upload limit, so
+        # hashing and writing a chunk never read it back from disk
+        file_id = self.initialize(data, chunk_size=SEGMENT_SIZE * 2)
+        with mock.patch(
+            'files.views.tempfile.SpooledTemporaryFile', wraps=tempfile.SpooledTemporaryFile
+        ) as spooled:
+            response = self.upload_raw_chunk(file_id, 0, data[:SEGMENT_SIZE * 2])
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(spooled.call_args.kwargs['max_size'], SEGMENT_SIZE * 2)
+
+    def test_raw_chunk_headers_are_checked(self):
+        data = os.urandom(SEGMENT_SIZE * 2)
+        file_id = self.initialize(data)
+        chunk = data[SEGMENT_SIZE:]
+
+        response = self.upload_raw_chunk(file_id, 1, chunk, HTTP_X_CHUNK_OFFSET='0')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.upload_raw_chunk(file_id, 1, chunk[:-1])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.upload_raw_chunk(file_id, 1, chunk, HTTP_X_CHUNK_CHECKSUM='0' * 64)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(UploadSession.objects.get(file_id=file_id).manifest.has_chunk(1))
+
+        response = self.client.generic(
+            'PUT', f'/api/files/upload/{file_id}/chunk/raw/', chunk,
+            content_type='application/octet-stream'
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.generic(
+            'PUT', f'/api/files/upload/{file_id}/chunk/raw/', chunk,
+            content_type='text/plain', HTTP_X_CHUNK_INDEX='1'
+        )
+        self.assertEqual(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+def run_tasks_eagerly(test):
+    """Make celery run queued tasks in-process for the rest of test."""
+    previous = celery_app.conf.task_always_eager
+    celery_app.conf.task_always_eager = True
+    test.addCleanup(setattr, celery_app.conf, 'task_always_eager', previous)
+
+@override_settings(SECURE_SSL_REDIRECT=False, MEDIA_ROOT=tempfile.mkdtemp())
+class CopyOnWriteTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='copier',
+            email='copier@example.com',
+            password='testpass123'
+        )
+        self.client.force_authenticate(user=self.user)
+        self.data = os.urandom(10000)
+        self.source = store_encrypted_file(self.user, self.data, 'report.txt', 'text/plain')
+
+    def download(self, file_id):
+        response = self.client.get(f'/api/files/{file_id}/download/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return b''.join(response.streaming_content)
+
+    def test_wrapped_key_round_trip(self):
+        kek, key = generate_encryption_key(), generate_encryption_key()
+        wrapped = wrap_key(kek, key)
+        self.assertEqual(unwrap_key(kek, wrapped), key)
+        with self.assertRaises(InvalidUnwrap):
+            unwrap_key(generate_encryption_key(), wrapped)
+
+    def test_copy_shares_ciphertext(self):
+        path = self.source.get_file_path()
+        response = self.client.post(f'/api/files/{self.source.id}/copy/')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        copy = File.objects.get(pk=response.data['id'])
+        self.source.refresh_from_db()
+        self.assertEqual(copy.get_file_path(), path)
+        self.assertEqual(self.source.get_file_path(), path)
+        self.assertNotEqual(copy.encryption_key, self.source.encryption_key)
+        self.assertEqual(copy.content_key(), self.source.encryption_key)
+        # The source, the copy and the copy's initial version
+        self.assertEqual(copy.blob.ref_count, 3)
+        self.assertEqual(self.download(copy.id), self.data)
+        self.assertEqual(self.download(self.source.id), self.data)
+        # Nothing was written for the copy
+        self.assertEqual(len(os.listdir(os.path.dirname(default_storage.path(path)))), 1)
+        self.assertFalse(default_storage.exists(f'files/{self.user.id}/{copy.encrypted_path}'))
+
+    def test_bulk_copy_counts_references(self):
+        run_tasks_eagerly(self)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/files/bulk/copy/', {
+                'file_ids': [str(self.source.id)]
+            }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        response = self.client.post(f'/api/files/{self.source.id}/copy/')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        # The source plus two copies, each with an initial version
+        self.source.refresh_from_db()
+        self.assertEqual(self.source.blob.ref_count, 5)
+        for copy in File.objects.exclude(pk=self.source.pk):
+            self.assertEqual(copy.blob_id, self.source.blob_id)
+            self.assertEqual(copy.versions.get().blob_id, self.source.blob_id)
+            self.assertEqual(self.download(copy.id), self.data)
+
+    def test_only_completed_files_are_copied(self):
+        run_tasks_eagerly(self)
+        for state in (File.Status.UPLOADING, File.Status.PROCESSING, File.Status.FAILED):
+            File.objects.filter(pk=self.source.pk).update(status=state)
+            response = self.client.post(f'/api/files/{self.source.id}/copy/')
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post('/api/files/bulk/copy/', {
+                    'file_ids': [str(self.source.id)]
+                }, format='json')
+            job = BulkJob.objects.get(pk=response.data['id'])
+            self.assertEqual((job.succeeded, job.failed), (0, 1))
+        self.assertEqual(File.objects.count(), 1)
+        self.assertFalse(Blob.objects.exists())
+
+    def test_releasing_last_reference(self):
+        response = self.client.post(f'/api/files/{self.source.id}/copy/')
+        copy = File.objects.get(pk=response.data['id'])
+        blob = copy.blob
+        copy.delete()
+        self.assertEqual(Blob.release([blob.pk, blob.pk]), [])
+        self.source.delete()
+        self.assertEqual(Blob.release([blob.pk]), [blob.path])
+        self.assertFalse(Blob.objects.filter(pk=blob.pk).exists())
+
+@override_settings(
+    MEDIA_ROOT=tempfile.mkdtemp(),
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+)
+class SweepAbandonedUploadsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='sweeper',
+            email='sweeper@example.com',
+            password='testpass123'
+        )
+
+    def make_old(self, path):
+        old = time.time() - 2 * settings.UPLOAD_SESSION_LIFETIME.total_seconds()
+        os.utime(path, (old, old))
+
+    def test_sweep(self):
+        long_ago = timezone.now() - 2 * settings.UPLOAD_SESSION_LIFETIME
+
+        abandoned = store_encrypted_file(self.user, b'a' * 100, 'abandoned.txt')
+        File.objects.filter(pk=abandoned.pk).update(status=File.Status.UPLOADING)
+        UploadSession.objects.create(
+            file=abandoned, chunk_size=SEGMENT_SIZE, total_size=100, expires_at=timezone.now()
+        )
+        failed = store_encrypted_file(self.user, b'f' * 50, 'failed.txt')
+        File.objects.filter(pk=failed.pk).update(
+            status=File.Status.FAILED, upload_started_at=long_ago
+        )
+        stuck = store_encrypted_file(self.user, b's' * 30, 'stuck.txt')
+        File.objects.filter(pk=stuck.pk).update(status=File.Status.PROCESSING)
+        UploadSession.objects.create(
+            file=stuck, chunk_size=SEGMENT_SIZE, total_size=30,
+            expires_at=timezone.now() - settings.UPLOAD_PROCESSING_TIMEOUT
+        )
+        finalizing = store_encrypted_file(self.user, b'p' * 10, 'finalizing.txt')
+        File.objects.filter(pk=finalizing.pk).update(
+            status=File.Status.PROCESSING, upload_started_at=long_ago
+        )
+        UploadSession.objects.create(file=finalizing, chunk_size=SEGMENT_SIZE, total_size=10)
+        active = store_encrypted_file(self.user, b'u' * 10, 'active.txt')
+        File.objects.filter(pk=active.pk).update(status=File.Status.UPLOADING)
+        UploadSession.objects.create(file=active, chunk_size=SEGMENT_SIZE, total_size=10)
+        completed = store_encrypted_file(self.user, b'c' * 10, 'completed.txt')
+        File.objects.filter(pk=completed.pk).update(upload_started_at=long_ago)
+
+        reclaimable = sum(default_storage.size(f.get_file_path()) for f in (abandoned, failed, stuck))
+        legacy_chunks = default_storage.path(f'chunks/{uuid.uuid4()}')
+        os.makedirs(legacy_chunks)
+        with open(os.path.join(legacy_chunks, '0'), 'wb') as f:
+            f.write(b'x' * 10)
+        self.make_old(legacy_chunks)
+        empty = default_storage.path(f'files/{self.user.id}/empty')
+        os.makedirs(empty)
+        self.make_old(empty)
+
+        report = sweep_abandoned_uploads()
+        self.assertEqual(report, {'files': 3, 'bytes': reclaimable + 10, 'directories': 2})
+        self.assertEqual(
+            set(File.objects.values_list('pk', flat=True)), {finalizing.pk, active.pk, completed.pk}
+        )
+        self.assertFalse(default_storage.exists(abandoned.get_file_path()))
+        self.assertFalse(default_storage.exists(stuck.get_file_path()))
+        self.assertTrue(default_storage.exists(active.get_file_path()))
+        self.assertFalse(os.path.exists(legacy_chunks))
+        self.assertFalse(os.path.exists(empty))
+
+        self.assertEqual(sweep_abandoned_uploads(), {'files': 0, 'bytes': 0, 'directories': 0})
+
+    def test_ensure_directory_exists_uses_storage_root(self):
+        ensure_directory_exists(f'files/{self.user.id}/new/blob')
+        self.assertTrue(os.path.isdir(default_storage.path(f'files/{self.user.id}/new')))
+        self.assertFalse(os.path.exists(f'files/{self.user.id}'))
+
+@override_settings(SECURE_SSL_REDIRECT=False, MEDIA_ROOT=tempfile.mkdtemp(), BULK_JOB_BATCH_SIZE=2)
+class BulkJobTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='bulk',
+            email='bulk@example.com',
+            password='testpass123'
+        )
+        self.client.force_authenticate(user=self.user)
+        self.files = [
+            store_encrypted_file(self.user, f'content {i}'.encode(), f'file{i}.txt', 'text/plain')
+            for i in range(5)
+        ]
+        run_tasks_eagerly(self)
+
+    def start(self, operation, data):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(f'/api/files/bulk/{operation}/', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data['total'], len(data['file_ids']))
+
+        job_url = f'/api/files/bulk/jobs/{response.data["id"]}/'
+        response = self.client.get(job_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['status'], BulkJob.Status.COMPLETED)
+        # Polling only costs the counters; outcomes are asked for
+        self.assertNotIn('items', response.data)
+        response = self.client.get(job_url, {'items': 1})
+        self.assertEqual(len(response.data['items']), len(data['file_ids']))
+        return response.data
+
+    def test_bulk_copy(self):
+        other = User.objects.create_user(username='other', email='other@example.com', password='x')
+        foreign = store_encrypted_file(other, b'not yours', 'foreign.txt', 'text/plain')
+        file_ids = [str(f.id) for f in self.files] + [str(foreign.id)]
+
+        job = self.start('copy', {'file_ids': file_ids})
+        self.assertEqual((job['processed'], job['succeeded'], job['failed']), (6, 5, 1))
+        items = {str(item['file_id']): item for item in job['items']}
+        self.assertEqual(items[str(foreign.id)]['status'], BulkJobItem.Status.FAILED)
+        for source in self.files:
+            copy = File.objects.get(pk=items[str(source.id)]['result_file_id'])
+            self.assertEqual(copy.name, f'Copy of {source.name}')
+            response = self.client.get(f'/api/files/{copy.id}/download/')
+            self.assertEqual(b''.join(response.streaming_content), f'content {source.name[4]}'.encode())
+
+    def test_bulk_copy_fails_sources_left_uncopied(self):
+        stopped = self.files[1]
+
+        def copy_after_failure(source_files, owner):
+            # The upload stops being complete before the sources are locked
+            File.objects.filter(pk=stopped.pk).update(status=File.Status.FAILED)
+            return copy_files(source_files, owner)
+
+        with mock.patch('files.operations.copy_files', side_effect=copy_after_failure):
+            job = self.start('copy', {'file_ids': [str(f.id) for f in self.files[:3]]})
+        self.assertEqual((job['succeeded'], job['failed']), (2, 1))
+        items = {str(item['file_id']): item for item in job['items']}
+        self.assertEqual(items[str(stopped.id)]['status'], BulkJobItem.Status.FAILED)
+        self.assertIsNone(items[str(stopped.id)]['result_file_id'])
+        for source in (self.files[0], self.files[2]):
+            copy = File.objects.get(pk=items[str(source.id)]['result_file_id'])
+            self.assertEqual(copy.name, f'Copy of {source.name}')
+
+    def test_bulk_move(self):
+        new_names = {str(f.id): f'renamed{i}.txt' for i, f in enumerate(self.files[:3])}
+        job = self.start('move', {
+            'file_ids': [str(f.id) for f in self.files[:4]],
+            'new_names': new_names
+        })
+        self.assertEqual((job['succeeded'], job['failed']), (3, 1))
+        for file in self.files[:3]:
+            file.refresh_from_db()
+            self.assertEqual(file.name, new_names[str(file.id)])
+
+    def test_bulk_delete(self):
+        job = self.start('delete', {'file_ids': [str(f.id) for f in self.files]})
+        self.assertEqual(job['succeeded'], 5)
+        self.assertEqual(File.objects.filter(is_deleted=True).count(), 5)
+
+    def test_invalid_selection(self):
+        response = self.client.post('/api/files/bulk/delete/', {'file_ids': ['nope']}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['error'], 'file_ids must be a list of IDs')
+        response = self.client.post('/api/files/bulk/delete/', {'file_ids': 'nope'}, format='json')
+        self.assertEqual(response.data['error'], 'file_ids must be a list of IDs')
+        with override_settings(BULK_JOB_MAX_FILES=2):
+            response = self.client.post('/api/files/bulk/delete/', {
+                'file_ids': [str(f.id) for f in self.files]
+            }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_jobs_are_private(self):
+        job = self.start('delete', {'file_ids': []})
+        other = User.objects.create_user(username='other', email='other@example.com', password='x')
+        self.client.force_authenticate(user=other)
+        response = self.client.get(f'/api/files/bulk/jobs/{job["id"]}/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+@override_settings(
+    SECURE_SSL_REDIRECT=False,
+    MEDIA_ROOT=tempfile.mkdtemp(),
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    DELTA_BLOCK_SIZE=1024
+)
+class FileVersionDeltaTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='versioner',
+            email='versioner@example.com',
+            password='testpass123'
+        )
+        self.client.force_authenticate(user=self.user)
+        self.data = os.urandom(100000)
+        self.file = store_encrypted_file(self.user, self.data, 'notes.txt', 'text/plain')
+
+    def edit(self, data):
+        return data[:20000] + b'inserted' + data[20000:60000] + data[61000:] + b'appended'
+
+    def make_delta(self, file_id, data):
+        response = self.client.get(f'/api/files/{file_id}/versions/signature/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        signature = response.data
+        ops = compute_delta(signature['blocks'], signature['block_size'], signature['size'], data)
+        return signature['version'], encode_delta(ops)
+
+    def upload_version(self, file_id, data, **headers):
+        base, delta = self.make_delta(file_id, data)
+        headers.setdefault('HTTP_X_CONTENT_CHECKSUM', hashlib.sha256(data).hexdigest())
+        return self.client.put(
+            f'/api/files/{file_id}/versions/upload/?comment=edited', delta,
+            content_type='application/octet-stream', HTTP_X_BASE_VERSION=str(base), **headers
+        )
+
+    def stored_objects(self):
+        return sum(len(files) for _, _, files in os.walk(default_storage.path(f'files/{self.user.id}')))
+
+    def download(self, url, **headers):
+        response = self.client.get(url, **headers)
+        self.assertIn(response.status_code, (status.HTTP_200_OK, status.HTTP_206_PARTIAL_CONTENT))
+        return b''.join(response.streaming_content)
+
+    def test_delta_round_trip(self):
+        builder = SignatureBuilder(1024)
+        builder.update(self.data[:777])
+        builder.update(self.data[777:])
+        new = self.edit(self.data)
+        ops = compute_delta(builder.finalize(), 1024, len(self.data), new)
+        literal = sum(len(op[1]) for op in ops if op[0] == LITERAL)
+        self.assertLess(literal, 3 * 1024)
+
+        class Reader:
+            def __init__(self, data):
+                self.data, self.size = data, len(data)
+
+            def iter_range(self, start=0, end=None):
+                yield self.data[start:end]
+
+        copies = []
+        applied = b''.join(apply_delta(io.BytesIO(encode_delta(ops)), Reader(self.data), copies, len(new)))
+        self.assertEqual(applied, new)
+        with self.assertRaises(FileVersionError):
+            list(apply_delta(io.BytesIO(encode_delta(ops)), Reader(self.data), [], len(new) - 1))
+
+        inverse = invert_copies(copies, len(self.data))
+        stored = b''.join(iter_stored_delta(inverse, Reader(self.data)))
+        self.assertEqual(len(stored), stored_delta_size(inverse))
+        old = DeltaReader(Reader(stored), Reader(new))
+        self.assertEqual(b''.join(old.iter_range()), self.data)
+        self.assertEqual(b''.join(old.iter_range(19990, 61010)), self.data[19990:61010])
+
+    def test_new_version_uploads_only_changes(self):
+        new = self.edit(self.data)
+        base, delta = self.make_delta(self.file.id, new)
+        self.assertEqual(base, 1)
+        self.assertLess(len(delta), len(new) // 20)
+
+        response = self.upload_version(self.file.id, new)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['version_number'], 2)
+        self.assertEqual(response.data['comment'], 'edited')
+
+        self.file.refresh_from_db()
+        self.assertEqual(self.file.size, len(new))
+        self.assertEqual(self.file.checksum, hashlib.sha256(new).hexdigest())
+        self.assertEqual(self.download(f'/api/files/{self.file.id}/download/'), new)
+
+        # The old version is now a small delta against the new one
+        first = self.file.versions.get(version_number=1)
+        self.assertEqual(first.base_version.version_number, 2)
+        self.assertLess(default_storage.size(first.get_file_path()), len(self.data) // 10)
+        self.assertEqual(self.stored_objects(), 2)
+
+        url = f'/api/files/{self.file.id}/versions/1/download/'
+        self.assertEqual(self.download(url), self.data)
+        self.assertEqual(
+            self.download(url, HTTP_RANGE='bytes=19990-61009'), self.data[19990:61010]
+        )
+        self.assertEqual(self.download(f'/api/files/{self.file.id}/versions/2/download/'), new)
+
+    def test_stale_base_version_conflicts(self):
+        base, delta = self.make_delta(self.file.id, self.edit(self.data))
+        response = self.upload_version(self.file.id, self.data + b'!')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        response = self.client.put(
+            f'/api/files/{self.file.id}/versions/upload/', delta,
+            content_type='application/octet-stream', HTTP_X_BASE_VERSION=str(base)
+        )
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(self.file.versions.count(), 2)
+
+        response = self.upload_version(
+            self.file.id, self.data, HTTP_X_CONTENT_CHECKSUM='0' * 64
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.file.versions.count(), 2)
+        self.assertEqual(self.stored_objects(), 2)
+
+    @override_settings(VERSION_SNAPSHOT_INTERVAL=2)
+    def test_snapshots_bound_delta_chains(self):
+        contents = [self.data]
+        for i in range(4):
+            contents.append(contents[-1][:1000 * i] + b'edit' + contents[-1][1000 * i:])
+            response = self.upload_version(self.file.id, contents[-1])
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        bases = dict(self.file.versions.values_list('version_number', 'base_version__version_number'))
+        self.assertEqual(bases, {1: 2, 2: None, 3: 4, 4: None, 5: None})
+        for number, content in enumerate(contents, 1):
+            self.assertEqual(
+                self.download(f'/api/files/{self.file.id}/versions/{number}/download/'), content
+            )
+
+    def test_copies_diverge(self):
+        response = self.client.post(f'/api/files/{self.file.id}/copy/')
+        copy = File.objects.get(pk=response.data['id'])
+        new = self.edit(self.data)
+        response = self.upload_version(copy.id, new)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        copy.refresh_from_db()
+        self.assertIsNone(copy.blob)
+        self.file.refresh_from_db()
+        # Only the source is left: the copy's old version became a delta
+        self.assertEqual(self.file.blob.ref_count, 1)
+        self.assertEqual(self.download(f'/api/files/{copy.id}/download/'), new)
+        self.assertEqual(self.download(f'/api/files/{copy.id}/versions/1/download/'), self.data)
+        self.assertEqual(self.download(f'/api/files/{self.file.id}/download/'), self.data)
+
+@override_settings(
+    SECURE_SSL_REDIRECT=False,
+    MEDIA_ROOT=tempfile.mkdtemp(),
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+)
+class DedupUploadTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='deduper',
+            email='deduper@example.com',
+            password='testpass123'
+        )
+        self.client.force_authenticate(user=self.user)
+        # Fixed data: the savings asserted below depend on where chunks are cut
+        self.data = random.Random(0).randbytes(300000)
+
+    def hashes(self, chunks):
+        return [hashlib.sha256(chunk).hexdigest() for chunk in chunks]
+
+    def upload(self, data, name='report.pdf'):
+        chunks = content_defined_chunks(data)
+        hashes = self.hashes(chunks)
+        response = self.client.post('/api/files/upload/dedup/query/', {'hashes': hashes}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        have = set(response.data['have'])
+        sent = 0
+        for chunk, checksum in zip(chunks, hashes):
+            if checksum not in have:
+                response = self.client.put(
+                    f'/api/files/upload/dedup/chunks/{checksum}/', chunk,
+                    content_type='application/octet-stream'
+                )
+                self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+                have.add(checksum)
+                sent += len(chunk)
+        response = self.client.post('/api/files/upload/dedup/complete/', {
+            'name': name, 'mime_type': 'application/pdf', 'chunks': hashes
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return File.objects.get(pk=response.data['id']), sent
+
+    def download(self, file_id, **headers):
+        response = self.client.get(f'/api/files/{file_id}/download/', **headers)
+        self.assertIn(response.status_code, (status.HTTP_200_OK, status.HTTP_206_PARTIAL_CONTENT))
+        return b''.join(response.streaming_content)
+
+    def test_boundaries_follow_content(self):
+        chunks = content_defined_chunks(self.data)
+        self.assertEqual(b''.join(chunks), self.data)
+        self.assertTrue(all(len(chunk) <= 256 * 1024 for chunk in chunks))
+        edited = content_defined_chunks(self.data[:1000] + b'inserted' + self.data[1000:])
+        # Only the chunk holding the edit changes
+        self.assertLessEqual(len(set(self.hashes(edited)) - set(self.hashes(chunks))), 1)
+
+    def test_repeated_upload_sends_nothing(self):
+        first, sent = self.upload(self.data)
+        self.assertEqual(sent, len(self.data))
+        self.assertEqual(first.checksum_algorithm, File.ChecksumAlgorithm.SHA256_CDC_TREE)
+        self.assertEqual(self.download(first.id), self.data)
+        self.assertEqual(
+            self.download(first.id, HTTP_RANGE='bytes=70000-200000'), self.data[70000:200001]
+        )
+        stored = ContentChunk.objects.count()
+
+        second, sent = self.upload(self.data, 'again.pdf')
+        self.assertEqual(sent, 0)
+        self.assertEqual(ContentChunk.objects.count(), stored)
+        self.assertEqual(set(ContentChunk.objects.values_list('ref_count', flat=True)), {2})
+        self.assertEqual(self.download(second.id), self.data)
+
+        edited, sent = self.upload(self.data[:1000] + b'inserted' + self.data[1000:], 'edited.pdf')
+        self.assertLess(sent, 300 * 1024 // 2)
+
+    def test_chunks_are_private_to_their_owner(self):
+        self.upload(self.data)
+        hashes = self.hashes(content_defined_chunks(self.data))
+        other = User.objects.create_user(
+            username='other', email='other@example.com', password='testpass123'
+        )
+        self.client.force_authenticate(user=other)
+        response = self.client.post('/api/files/upload/dedup/query/', {'hashes': hashes}, format='json')
+        self.assertEqual(response.data['have'], [])
+        response = self.client.post('/api/files/upload/dedup/complete/', {
+            'name': 'stolen.pdf', 'mime_type': 'application/pdf', 'chunks': hashes
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['missing'], hashes)
+        self.assertNotEqual(owner_chunk_digest(self.user.pk, hashes[0]), owner_chunk_digest(other.pk, hashes[0]))
+        self.assertFalse(ContentChunk.objects.filter(digest=hashes[0]).exists())
+
+    def test_chunk_checksum_is_verified(self):
+        response = self.client.put(
+            f'/api/files/upload/dedup/chunks/{"0" * 64}/', b'data',
+            content_type='application/octet-stream'
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(ContentChunk.objects.exists())
+
+    def test_unused_chunks_are_reclaimed(self):
+        file, _ = self.upload(self.data)
+        copy = copy_files([file], self.user)[file.pk]
+        self.assertEqual(self.download(copy.id), self.data)
+        paths = set(ContentChunk.objects.values_list('path', flat=True))
+
+        # A chunk uploaded but never committed to a file is swept
+        response = self.client.put(
+            f'/api/files/upload/dedup/chunks/{hashlib.sha256(b"orphan").hexdigest()}/', b'orphan',
+            content_type='application/octet-stream'
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        ContentChunk.objects.filter(ref_count=0).update(
+            created_at=timezone.now() - 2 * settings.UPLOAD_SESSION_LIFETIME
+        )
+        self.assertGreater(sweep_abandoned_uploads()['bytes'], 0)
+        self.assertEqual(set(ContentChunk.objects.values_list('path', flat=True)), paths)
+
+        # The file, the copy and their initial versions all hold the blob
+        blob_id = file.blob_id
+        File.objects.filter(blob_id=blob_id).delete()
+        self.assertEqual(set(Blob.release([blob_id] * 4)), paths)
+        self.assertFalse(ContentChunk.objects.exists())
+
+    def test_sweep_keeps_chunks_taken_meanwhile(self):
+        response = self.client.put(
+            f'/api/files/upload/dedup/chunks/{hashlib.sha256(b"orphan").hexdigest()}/', b'orphan',
+            content_type='application/octet-stream'
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        chunk = ContentChunk.objects.get()
+
+        # A commit acquires the chunk between the sweep's select and delete
+        def racing_select(now):
+            selected = [(chunk.pk, chunk.path)]
+            ContentChunk.acquire([chunk.pk])
+            return mock.Mock(**{'select_for_update.return_value.values_list.return_value': selected})
+        with mock.patch('files.tasks.unreferenced_chunks', racing_select):
+            self.assertEqual(sweep_abandoned_uploads()['bytes'], 0)
+        self.assertTrue(ContentChunk.objects.filter(pk=chunk.pk).exists())
+        self.assertTrue(default_storage.exists(chunk.path))
+
+@override_settings(
+    SECURE_SSL_REDIRECT=False,
+    MEDIA_ROOT=tempfile.mkdtemp(),
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+)
+class ClientEncryptionTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='e2e',
+            email='e2e@example.com',
+            password='testpass123'
+        )
+        self.client.force_authenticate(user=self.user)
+        # Stands in for ciphertext the server has no key for
+        self.ciphertext = os.urandom(SEGMENT_SIZE * 2 + 100)
+        self.key_metadata = {'alg': 'AES-GCM', 'wrapped_key': 'd3JhcHBlZA==', 'iv': 'aXY='}
+
+    def read_stored(self, file):
+        with default_storage.open(file.get_file_path(), 'rb') as f:
+            return f.read()
+
+    def download(self, file_id, **headers):
+        response = self.client.get(f'/api/files/{file_id}/download/', **headers)
+        self.assertIn(response.status_code, (status.HTTP_200_OK, status.HTTP_206_PARTIAL_CONTENT))
+        self.assertEqual(response['Content-Type'], 'application/octet-stream')
+        return b''.join(response.streaming_content)
+
+    def test_small_upload_is_stored_verbatim(self):
+        response = self.client.post('/api/files/upload/', {
+            'file': SimpleUploadedFile('secret.txt', self.ciphertext, content_type='text/plain'),
+            'client_encrypted': 'true',
+            'client_key_metadata': json.dumps(self.key_metadata)
+        }, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(response.data['client_encrypted'])
+        self.assertEqual(response.data['client_key_metadata'], self.key_metadata)
+
+        file = File.objects.get(pk=response.data['id'])
+        self.assertEqual(file.encryption_key, '')
+        self.assertEqual(self.read_stored(file), self.ciphertext)
+        self.assertEqual(self.download(file.id), self.ciphertext)
+        self.assertEqual(self.download(file.id, HTTP_RANGE='bytes=100-199'), self.ciphertext[100:200])
+
+    def test_chunked_upload_is_stored_verbatim(self):
+        response = self.client.post('/api/files/upload/initialize/', {
+            'name': 'secret.txt',
+            'mime_type': 'text/plain',
+            'size': len(self.ciphertext),
+            'chunk_size': SEGMENT_SIZE,
+            'client_encrypted': True,
+            'client_key_metadata': self.key_metadata
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        file_id = response.data['id']
+        for number in (2, 0, 1):
+            chunk = self.ciphertext[number * SEGMENT_SIZE:(number + 1) * SEGMENT_SIZE]
+            response = self.client.generic(
+                'PUT', f'/api/files/upload/{file_id}/chunk/raw/', chunk,
+                content_type='application/octet-stream', HTTP_X_CHUNK_INDEX=str(number)
+            )
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        with self.captureOnCommitCallbacks():
+            response = self.client.post(f'/api/files/upload/{file_id}/complete/')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        finalize_upload(file_id)
+
+        file = File.objects.get(pk=file_id)
+        self.assertEqual(file.status, File.Status.COMPLETED)
+        self.assertEqual(self.read_stored(file), self.ciphertext)
+        self.assertEqual(self.download(file_id), self.ciphertext)
+
+    def test_key_metadata_is_required(self):
+        for metadata in ('', '[]', '{"key": "%s"}' % ('x' * 5000)):
+            response = self.client.post('/api/files/upload/', {
+                'file': SimpleUploadedFile('secret.txt', b'data', content_type='text/plain'),
+                'client_encrypted': 'true',
+                'client_key_metadata': metadata
+            }, format='multipart')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(File.objects.exists())
+
+    def test_copies_and_versions(self):
+        response = self.client.post('/api/files/upload/', {
+            'file': SimpleUploadedFile('secret.txt', self.ciphertext, content_type='text/plain'),
+            'client_encrypted': 'true',
+            'client_key_metadata': json.dumps(self.key_metadata)
+        }, format='multipart')
+        file_id = response.data['id']
+
+        response = self.client.post(f'/api/files/{file_id}/copy/')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        copy = File.objects.get(pk=response.data['id'])
+        self.assertTrue(copy.client_encrypted)
+        self.assertEqual(copy.client_key_metadata, self.key_metadata)
+        self.assertEqual(self.download(copy.id), self.ciphertext)
+
+        # The server cannot diff content it cannot read
+        response = self.client.get(f'/api/files/{file_id}/versions/signature/')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+@override_settings(SECURE_SSL_REDIRECT=False, MEDIA_ROOT=tempfile.mkdtemp())
+class ZipDownloadTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='zipper',
+            email='zipper@example.com',
+            password='testpass123'
+        )
+        self.client.force_authenticate(user=self.user)
+        self.contents = {
+            'notes.txt': b'meeting notes\n' * 5000,
+            'photo.jpg': os.urandom(30000),
+        }
+        self.files = [
+            store_encrypted_file(self.user, self.contents['notes.txt'], 'notes.txt', 'text/plain'),
+            store_encrypted_file(self.user, self.contents['photo.jpg'], 'photo.jpg', 'image/jpeg'),
+            store_encrypted_file(self.user, b'second copy', 'notes.txt', 'text/plain'),
+        ]
+
+    def download(self, file_ids):
+        return self.client.post('/api/files/download/zip/', {'file_ids': [str(f) for f in file_ids]}, format='json')
+
+    def test_selection_is_streamed_as_zip(self):
+        response = self.download([f.id for f in self.files])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="files.zip"')
+
+        # The first entry's header goes out before anything else is read
+        body = iter(response.streaming_content)
+        first = next(body)
+        self.assertTrue(first.startswith(b'PK\x03\x04'))
+        zipped = zipfile.ZipFile(io.BytesIO(first + b''.join(body)))
+        self.assertEqual(zipped.namelist(), ['notes.txt', 'photo.jpg', 'notes (1).txt'])
+        self.assertEqual(zipped.read('notes.txt'), self.contents['notes.txt'])
+        self.assertEqual(zipped.read('photo.jpg'), self.contents['photo.jpg'])
+        self.assertEqual(zipped.read('notes (1).txt'), b'second copy')
+        self.assertEqual(zipped.getinfo('notes.txt').compress_type, zipfile.ZIP_DEFLATED)
+        self.assertEqual(zipped.getinfo('photo.jpg').compress_type, zipfile.ZIP_STORED)
+        self.assertIsNone(zipped.testzip())
+
+    def test_large_entries_use_zip64(self):
+        with mock.patch('zipfile.ZIP64_LIMIT', 10000):
+            body = b''.join(archive.iter_zip(self.files[1:2]))
+            self.assertIn(b'PK\x06\x06', body)
+            self.assertEqual(zipfile.ZipFile(io.BytesIO(body)).read('photo.jpg'), self.contents['photo.jpg'])
+
+    def test_entry_times(self):
+        File.objects.filter(pk=self.files[1].pk).update(upload_completed_at=None)
+        file = File.objects.get(pk=self.files[1].pk)
+        zipped = zipfile.ZipFile(io.BytesIO(b''.join(archive.iter_zip([self.files[0], file]))))
+        # Files without a completion time are dated by when they were started
+        self.assertEqual(
+            zipped.getinfo('photo.jpg').date_time[:5],
+            timezone.localtime(file.upload_started_at).timetuple()[:5]
+        )
+        self.assertEqual(zipped.read('photo.jpg'), self.contents['photo.jpg'])
+
+    def test_invalid_selections(self):
+        other = User.objects.create_user(username='other', email='other@example.com', password='testpass123')
+        foreign = store_encrypted_file(other, b'not yours')
+        response = self.download([self.files[0].id, foreign.id])
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(response.data['files'], [str(foreign.id)])
+        self.assertEqual(self.download([]).status_code, status.HTTP_400_BAD_REQUEST)
+
+        File.objects.filter(pk=self.files[0].pk).update(client_encrypted=True)
+        self.assertEqual(self.download([self.files[0].id]).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_shares_download_as_zip(self):
+        owner = User.objects.create_user(username='sharer', email='sharer@example.com', password='testpass123')
+        shared = [store_encrypted_file(owner, data, name) for name, data in self.contents.items()]
+        shares = [
+            FileShare.objects.create(file=file, shared_by=owner, shared_with=self.user, access_level='FULL')
+            for file in shared
+        ]
+        response = self.client.post('/api/sharing/shares/download/zip/', {
+            'share_ids': [str(share.id) for share in shares]
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        body = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+        self.assertEqual({name: body.read(name) for name in body.namelist()}, self.contents)
+
+        FileShare.objects.filter(pk=shares[1].pk).update(access_level='VIEW')
+        response = self.client.post('/api/sharing/shares/download/zip/', {
+            'share_ids': [str(share.id) for share in shares]
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
 class FileAPITests(APITestCase):
     def setUp(self):
         self.user = User.objects.create_user(
@@ -107,9 +1932,9 @@ class FileAPITests(APITestCase):
                 )
                 self.assertEqual(response.status_code, status.HTTP_201_CREATED)
 
-            # Complete upload
+            # Complete upload; finalization continues in the background
             response = self.client.post(f'/api/files/upload/{file_id}/complete/')
-            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
 
             # Clean up
             os.unlink(temp_file.name)
@@ -197,8 +2022,10 @@ class FileAPITests(APITestCase):
 
         # Test bulk delete
         file_ids = [str(f.id) for f in files[:2]]
-        response = self.client.post('/api/files/bulk/delete/', {'file_ids': file_ids})
-        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        run_tasks_eagerly(self)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/files/bulk/delete/', {'file_ids': file_ids})
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
         self.assertEqual(
             File.objects.filter(is_deleted=True).count(),
             2
@@ -207,11 +2034,12 @@ class FileAPITests(APITestCase):
         # Test bulk move
         file_ids = [str(files[2].id)]
         new_names = {str(files[2].id): 'moved.txt'}
-        response = self.client.post('/api/files/bulk/move/', {
-            'file_ids': file_ids,
-            'new_names': new_names
-        })
-        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/files/bulk/move/', {
+                'file_ids': file_ids,
+                'new_names': new_names
+            }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
         files[2].refresh_from_db()
         self.assertEqual(files[2].name, 'moved.txt')
 
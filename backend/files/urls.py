@@ -13,12 +13,25 @@ urlpatterns = [
     
     # File Versions
     path('<uuid:pk>/versions/', views.FileVersionListView.as_view(), name='file-versions'),
+    path('<uuid:pk>/versions/signature/', views.FileVersionSignatureView.as_view(), name='file-version-signature'),
+    path('<uuid:pk>/versions/upload/', views.FileVersionUploadView.as_view(), name='file-version-upload'),
     path('<uuid:file_pk>/versions/<int:version>/', views.FileVersionDetailView.as_view(), name='file-version-detail'),
+    path('<uuid:file_pk>/versions/<int:version>/download/', views.FileVersionDownloadView.as_view(), name='file-version-download'),
     
     # File Upload
+    path('upload/', views.SmallUploadView.as_view(), name='small-upload'),
     path('upload/initialize/', views.InitializeUploadView.as_view(), name='initialize-upload'),
+    path('upload/batch/', views.InitializeBatchUploadView.as_view(), name='initialize-batch-upload'),
+    path('upload/batch/<uuid:batch_id>/content/', views.BatchUploadContentView.as_view(), name='batch-upload-content'),
+    path('upload/batch/<uuid:batch_id>/complete/', views.CompleteBatchUploadView.as_view(), name='complete-batch-upload'),
     path('upload/<uuid:file_id>/chunk/', views.UploadChunkView.as_view(), name='upload-chunk'),
+    path('upload/<uuid:file_id>/chunk/raw/', views.RawUploadChunkView.as_view(), name='upload-chunk-raw'),
+    path('upload/<uuid:file_id>/chunks/', views.UploadChunksView.as_view(), name='upload-chunks'),
     path('upload/<uuid:file_id>/complete/', views.CompleteUploadView.as_view(), name='complete-upload'),
+    path('upload/<uuid:file_id>/status/', views.UploadStatusView.as_view(), name='upload-status'),
+    path('upload/dedup/query/', views.DedupChunkQueryView.as_view(), name='dedup-chunk-query'),
+    path('upload/dedup/chunks/<str:checksum>/', views.DedupChunkUploadView.as_view(), name='dedup-chunk-upload'),
+    path('upload/dedup/complete/', views.DedupCompleteUploadView.as_view(), name='dedup-complete-upload'),
     
     # File Operations
     path('<uuid:pk>/move/', views.FileMoveView.as_view(), name='file-move'),
@@ -26,9 +39,11 @@ urlpatterns = [
     path('<uuid:pk>/restore/', views.FileRestoreView.as_view(), name='file-restore'),
     
     # Bulk Operations
+    path('download/zip/', views.FileArchiveDownloadView.as_view(), name='file-archive-download'),
     path('bulk/delete/', views.BulkDeleteView.as_view(), name='bulk-delete'),
     path('bulk/move/', views.BulkMoveView.as_view(), name='bulk-move'),
     path('bulk/copy/', views.BulkCopyView.as_view(), name='bulk-copy'),
+    path('bulk/jobs/<uuid:job_id>/', views.BulkJobStatusView.as_view(), name='bulk-job-status'),
     
     # Search and Filters
     path('search/', views.FileSearchView.as_view(), name='file-search'),
@@ -2,13 +2,10 @@ import os
 import uuid
 import hashlib
 import logging
-from cryptography.fernet import Fernet
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-from cryptography.hazmat.primitives import padding
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from base64 import b64encode, b64decode
+from base64 import b64encode
 from django.conf import settings
+from django.utils import timezone
+from django.core.files.storage import default_storage
 from rest_framework.views import exception_handler
 from rest_framework.response import Response
 from rest_framework import status
@@ -16,6 +13,7 @@ from django.core.exceptions import ValidationError as DjangoValidationError
 from django.http import Http404
 from rest_framework.exceptions import APIException
 from .exceptions import FileError, AuthenticationError
+from .crypto import iter_file, StreamEncryptor, StreamDecryptor
 
 logger = logging.getLogger(__name__)
 
@@ -80,6 +78,11 @@ def generate_file_path(instance, filename):
     filename = f"{uuid.uuid4()}.{ext}"
     return os.path.join('files', str(instance.owner.id), filename)
 
+def generate_encrypted_path(name):
+    """Generate a unique storage path, relative to the owner's directory, for a file's ciphertext."""
+    timestamp = timezone.now().strftime('%Y%m%d_%H%M%S')
+    return f"{timestamp}_{uuid.uuid4()}/{name}"
+
 def generate_encryption_key():
     """Generate a new encryption key."""
     # Generate a 32-byte (256-bit) random key for AES-256
@@ -87,95 +90,24 @@ def generate_encryption_key():
     # Return base64 encoded key
     return b64encode(key).decode('utf-8')
 
-def derive_key(key, salt):
-    """Derive an encryption key using PBKDF2."""
-    if isinstance(key, str):
-        try:
-            key = b64decode(key)
-        except Exception:
-            key = key.encode('utf-8')
-    
-    kdf = PBKDF2HMAC(
-        algorithm=hashes.SHA256(),
-        length=32,
-        salt=salt,
-        iterations=100000,
-    )
-    return kdf.derive(key)
-
 def encrypt_file(file_path, key):
     """
-    Encrypt a file using AES-256-CBC.
+    Encrypt a file into a segmented AES-256-GCM container (format 2).
     Returns (encrypted_data, iv).
     """
-    iv = os.urandom(16)
-    
-    # Decode base64 key if needed
-    if isinstance(key, str):
-        key = b64decode(key)
-    
-    derived_key = derive_key(key, iv)
-    
-    cipher = Cipher(algorithms.AES(derived_key), modes.CBC(iv))
-    encryptor = cipher.encryptor()
-    
-    padder = padding.PKCS7(128).padder()
-    
+    encryptor = StreamEncryptor(key)
     with open(file_path, 'rb') as f:
-        data = f.read()
-    
-    padded_data = padder.update(data) + padder.finalize()
-    encrypted_data = encryptor.update(padded_data) + encryptor.finalize()
-    
-    return encrypted_data, b64encode(iv).decode('utf-8')
+        encrypted_data = b''.join(encryptor.encrypt_iter(iter_file(f)))
+    return encrypted_data, encryptor.iv_b64
 
 def decrypt_file(encrypted_data, key, iv):
     """
-    Decrypt file data using AES-256-CBC.
+    Decrypt file data: a segmented AES-256-GCM container (format 2), or a
+    legacy AES-256-CBC blob (formats 0 and 1), which is still read.
     Returns decrypted data.
     """
-    try:
-        # Handle base64 decoding for key and iv if they're strings
-        if isinstance(key, str):
-            try:
-                key = b64decode(key)
-            except Exception as e:
-                raise ValueError("Invalid encryption key format")
-                
-        if isinstance(iv, str):
-            try:
-                iv = b64decode(iv)
-            except Exception as e:
-                raise ValueError("Invalid IV format")
-        
-        if len(iv) != 16:
-            raise ValueError(f"Invalid IV length: {len(iv)}, expected 16 bytes")
-            
-        derived_key = derive_key(key, iv)
-        if len(derived_key) != 32:  # AES-256 requires 32-byte key
-            raise ValueError(f"Invalid derived key length: {len(derived_key)}, expected 32 bytes")
-        
-        cipher = Cipher(algorithms.AES(derived_key), modes.CBC(iv))
-        decryptor = cipher.decryptor()
-        
-        # First decrypt the data
-        try:
-            decrypted_padded = decryptor.update(encrypted_data) + decryptor.finalize()
-        except Exception as e:
-            raise ValueError("Decryption failed - invalid key or corrupted data")
-        
-        # Then remove padding
-        try:
-            unpadder = padding.PKCS7(128).unpadder()
-            decrypted = unpadder.update(decrypted_padded) + unpadder.finalize()
-            return decrypted
-        except Exception as e:
-            raise ValueError("Invalid padding - decryption failed")
-            
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        raise
+    decryptor = StreamDecryptor(key, iv)
+    return b''.join(decryptor.decrypt_iter([encrypted_data]))
 
 def calculate_file_hash(file_path):
     """Calculate SHA-256 hash of a file."""
@@ -185,13 +117,34 @@ def calculate_file_hash(file_path):
             sha256_hash.update(byte_block)
     return sha256_hash.hexdigest()
 
+def combine_chunk_hashes(chunk_hashes):
+    """
+    Checksum of a chunked upload: SHA-256 over the concatenated SHA-256
+    digests of its chunks, in order. Computed from the chunk manifest
+    alone, without reading the file back.
+    """
+    sha256_hash = hashlib.sha256()
+    for chunk_hash in chunk_hashes:
+        sha256_hash.update(bytes.fromhex(chunk_hash))
+    return sha256_hash.hexdigest()
+
 def get_file_size(file_path):
     """Get file size in bytes."""
     return os.path.getsize(file_path)
 
 def ensure_directory_exists(path):
-    """Ensure that a directory exists, create if it doesn't."""
-    os.makedirs(os.path.dirname(path), exist_ok=True)
+    """Ensure the directory that will hold storage path exists under MEDIA_ROOT."""
+    os.makedirs(os.path.dirname(default_storage.path(path)), exist_ok=True)
+
+def open_container(file, mode):
+    """
+    Open file's container directly on local storage. Upload chunks are
+    written into it in place, which needs a real seekable file rather than
+    the write-once files the storage API hands out.
+    """
+    path = file.get_file_path()
+    ensure_directory_exists(path)
+    return open(default_storage.path(path), mode)
 
 def clean_filename(filename):
     """Clean and sanitize filename."""
@@ -199,6 +152,20 @@ def clean_filename(filename):
     filename = "".join(c for c in filename if c.isalnum() or c in "._- ")
     return filename.strip()
 
+def parse_id_list(data, field):
+    """
+    The distinct UUIDs listed under field in request data (a JSON list or
+    a repeated form field), in order. Raises ValueError, with a message
+    fit for the client, otherwise.
+    """
+    values = data.getlist(field) if hasattr(data, 'getlist') else data.get(field, [])
+    try:
+        if not isinstance(values, list):
+            raise ValueError
+        return list(dict.fromkeys(uuid.UUID(str(value)) for value in values))
+    except ValueError:
+        raise ValueError(f"{field} must be a list of IDs")
+
 def get_mime_type(file_path):
     """Get MIME type of a file."""
     import magic
@@ -0,0 +1,243 @@
+"""
+Version history stored as reverse deltas.
+
+A file's current content is always stored in full, since that is what
+downloads, copies and shares read. New versions are uploaded as deltas
+against it (see files.delta), and once the new content is stored the
+previous version is rewritten as a delta against the new one. The COPY
+ranges the client sent already say which parts of the old content the new
+one reuses, so the server never searches for matches itself.
+
+Every VERSION_SNAPSHOT_INTERVAL-th version is left whole, as is any
+version whose delta would not be smaller, so reading an old version never
+goes through more than that many deltas.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+
+from .content_cache import invalidate
+from .crypto import PlainReader, StreamEncryptor, StreamingContent, open_reader
+from .dedup import ChunkedReader
+from .delta import (
+    DeltaReader, SignatureBuilder, apply_delta, invert_copies,
+    iter_stored_delta, stored_delta_size
+)
+from .exceptions import FileNotFoundError, FileVersionConflictError, FileVersionError
+from .models import Blob, File, FileVersion
+from .utils import generate_encrypted_path, generate_encryption_key
+
+class VersionReader:
+    """
+    Random-access reader (exposing .size and .iter_range()) over a
+    version's content, or a file's, resolving any chain of deltas and
+    chunked blobs. Holds the stored objects open until close().
+    """
+
+    def __init__(self, version):
+        self._files = []
+        try:
+            self._reader = self._open(version)
+        except Exception:
+            self.close()
+            raise
+        self.size = self._reader.size
+
+    def _open(self, version):
+        if version.blob_id and version.blob.chunked:
+            reader = ChunkedReader(version.blob)
+            self._files.append(reader)
+            return reader
+        path = version.get_file_path()
+        if not default_storage.exists(path):
+            raise FileNotFoundError()
+        f = default_storage.open(path, 'rb')
+        self._files.append(f)
+        if version.client_encrypted:
+            return PlainReader(f)
+        reader = open_reader(f, version.content_key(), version.iv)
+        if getattr(version, 'base_version_id', None):
+            return DeltaReader(reader, self._open(version.base_version))
+        return reader
+
+    def iter_range(self, start=0, end=None):
+        return self._reader.iter_range(start, end)
+
+    def close(self):
+        for f in self._files:
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def latest_version(file):
+    """
+    The newest version of file, which always matches its current content.
+    Files stored before versions were kept get their first one here.
+    """
+    version = file.versions.select_related('blob').first()
+    if version is None:
+        version = FileVersion.objects.create(
+            file=file,
+            version_number=1,
+            encrypted_path=file.encrypted_path,
+            encryption_key=file.encryption_key,
+            blob=file.blob,
+            wrapped_key=file.wrapped_key,
+            iv=file.iv,
+            checksum=file.checksum,
+            checksum_algorithm=file.checksum_algorithm,
+            checksum_chunk_size=file.checksum_chunk_size,
+            size=file.size,
+            created_by=file.owner
+        )
+        if file.blob_id:
+            Blob.acquire(file.blob_id)
+    return version
+
+def version_signature(file, block_size):
+    """
+    Block signature of file's current content, for a client preparing a
+    delta upload. Cached per content, so repeated uploads against the same
+    version only pay for it once.
+    """
+    if file.client_encrypted:
+        raise FileVersionError("Delta versions are not available for end-to-end encrypted files")
+    version = latest_version(file)
+    key = f'version-signature:{file.pk}:{version.version_number}:{block_size}'
+    signature = cache.get(key)
+    if signature is None:
+        builder = SignatureBuilder(block_size)
+        with VersionReader(version) as reader:
+            for block in reader.iter_range():
+                builder.update(block)
+        signature = {
+            'version': version.version_number,
+            'size': version.size,
+            'checksum': version.checksum,
+            'block_size': block_size,
+            'blocks': builder.finalize(),
+        }
+        cache.set(key, signature, 24 * 3600)
+    return signature
+
+def _store(owner_id, name, key, blocks):
+    """Encrypt blocks into a new object; returns its encrypted_path and IV."""
+    encrypted_path = generate_encrypted_path(name)
+    encryptor = StreamEncryptor(key)
+    default_storage.save(
+        f"files/{owner_id}/{encrypted_path}",
+        StreamingContent(encryptor.encrypt_iter(blocks))
+    )
+    return encrypted_path, encryptor.iv_b64
+
+def create_version(file, stream, base_version, user, comment='', expected_checksum=''):
+    """
+    Make the delta read from stream, taken against version number
+    base_version, the new current content of file. Raises
+    FileVersionConflictError if file has moved past base_version, and
+    FileVersionError if the delta is malformed or the result does not
+    match expected_checksum. Returns the new FileVersion.
+    """
+    if file.client_encrypted:
+        raise FileVersionError("Delta versions are not available for end-to-end encrypted files")
+    previous = latest_version(file)
+    if previous.version_number != base_version:
+        raise FileVersionConflictError()
+
+    written = []
+    copies = []
+    hasher = hashlib.sha256()
+    size = 0
+
+    def content(base):
+        nonlocal size
+        for block in apply_delta(stream, base, copies, settings.MAX_UPLOAD_SIZE):
+            hasher.update(block)
+            size += len(block)
+            yield block
+
+    try:
+        with VersionReader(previous) as base:
+            encrypted_path, iv = _store(file.owner_id, file.name, file.encryption_key, content(base))
+            written.append(f"files/{file.owner_id}/{encrypted_path}")
+            checksum = hasher.hexdigest()
+            if expected_checksum and expected_checksum != checksum:
+                raise FileVersionError("Version checksum mismatch")
+
+            delta = None
+            if previous.version_number % settings.VERSION_SNAPSHOT_INTERVAL:
+                ops = invert_copies(copies, base.size)
+                if stored_delta_size(ops) < base.size:
+                    delta_key = generate_encryption_key()
+                    delta_path, delta_iv = _store(
+                        file.owner_id, f"{file.name}.delta", delta_key,
+                        iter_stored_delta(ops, base)
+                    )
+                    written.append(f"files/{file.owner_id}/{delta_path}")
+                    delta = (delta_path, delta_key, delta_iv)
+
+        with transaction.atomic():
+            file = File.objects.select_for_update().select_related('blob').get(pk=file.pk)
+            previous = file.versions.select_related('blob').first()
+            if previous.version_number != base_version:
+                raise FileVersionConflictError()
+
+            released, stale_paths = [], set()
+            if file.blob_id:
+                released.append(file.blob_id)
+            else:
+                stale_paths.add(file.get_file_path())
+            file.encrypted_path = encrypted_path
+            file.blob = None
+            file.wrapped_key = ''
+            file.iv = iv
+            file.size = size
+            file.checksum = checksum
+            file.checksum_algorithm = File.ChecksumAlgorithm.SHA256
+            file.checksum_chunk_size = None
+            file.upload_completed_at = timezone.now()
+            file.save()
+
+            version = FileVersion.objects.create(
+                file=file,
+                version_number=previous.version_number + 1,
+                encrypted_path=encrypted_path,
+                encryption_key=file.encryption_key,
+                iv=iv,
+                checksum=checksum,
+                size=size,
+                created_by=user,
+                comment=comment
+            )
+
+            if delta:
+                if previous.blob_id:
+                    released.append(previous.blob_id)
+                else:
+                    stale_paths.add(previous.get_file_path())
+                previous.encrypted_path, previous.encryption_key, previous.iv = delta
+                previous.blob = None
+                previous.wrapped_key = ''
+                previous.base_version = version
+                previous.save()
+            elif not previous.blob_id:
+                # Kept whole, where it already was
+                stale_paths.discard(previous.get_file_path())
+            stale_paths.update(Blob.release(released))
+    except Exception:
+        for path in written:
+            default_storage.delete(path)
+        raise
+
+    for path in stale_paths:
+        default_storage.delete(path)
+    invalidate(file.pk)
+    return version
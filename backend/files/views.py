@@ -6,22 +6,37 @@ from rest_framework.parsers import MultiPartParser
 from rest_framework.permissions import IsAuthenticated
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
-from django.http import FileResponse, HttpResponse
 from django.core.files.storage import default_storage
+from django.core.files import File as DjangoFile
 from django.core.files.base import ContentFile
-import os
+from django.db import transaction
+from django.conf import settings
+import hashlib
+import json
 import tempfile
-from .models import File, FileVersion, FileChunk
+from .models import (
+    File, FileVersion, UploadSession, UploadBatch, BulkJob, BulkJobItem
+)
 from .serializers import (
     FileSerializer, FileListSerializer,
-    FileVersionSerializer, FileChunkSerializer,
-    FileInitializeSerializer
+    FileVersionSerializer,
+    FileInitializeSerializer, UploadSessionSerializer, UploadBatchSerializer,
+    BulkJobSerializer, BulkJobDetailSerializer
 )
 from .utils import (
-    encrypt_file, decrypt_file, calculate_file_hash,
-    get_file_size, ensure_directory_exists, clean_filename,
+    clean_filename,
     get_mime_type, is_valid_file_type, generate_encryption_key,
-    generate_iv
+    generate_iv, generate_encrypted_path, open_container, parse_id_list
+)
+from .crypto import StreamEncryptor, ContainerWriter, SEGMENT_SIZE
+from . import archive, delivery
+from .hashing import claim_running_hash, release_running_hash
+from .operations import copy_files
+from .tasks import finalize_upload, run_bulk_job, verify_chunk_manifest
+from .dedup import commit_chunked_file, held_chunks, is_checksum, store_chunk
+from .versions import create_version, version_signature
+from .exceptions import (
+    ChunkConflictError, ChunkMissingError, ChunkUploadError, FileSizeError, FileVersionError
 )
 import uuid
 from rest_framework_simplejwt.tokens import AccessToken
@@ -29,6 +44,190 @@ from rest_framework_simplejwt.exceptions import TokenError
 from django.contrib.auth import get_user_model
 from functools import wraps
 
+def chunk_receipt(session, chunk_number, checksum):
+    """Response body acknowledging a stored upload chunk."""
+    return {
+        'file': session.file_id,
+        'chunk_number': chunk_number,
+        'size': session.expected_chunk_size(chunk_number),
+        'checksum': checksum,
+        'status': File.Status.COMPLETED
+    }
+
+def store_small_file(file, data):
+    """
+    Encrypt a small file's content in memory and write it to storage,
+    replacing any earlier attempt; client-encrypted content is stored as
+    it is. Sets the file's iv, size and checksum and returns the storage
+    path.
+    """
+    if file.client_encrypted:
+        ciphertext = data
+    else:
+        encryptor = StreamEncryptor(file.encryption_key)
+        ciphertext = encryptor.update(data) + encryptor.finalize()
+        file.iv = encryptor.iv_b64
+    file.size = len(data)
+    file.checksum = hashlib.sha256(data).hexdigest()
+    file.checksum_algorithm = File.ChecksumAlgorithm.SHA256
+
+    file_path = file.get_file_path()
+    if default_storage.exists(file_path):
+        default_storage.delete(file_path)
+    return default_storage.save(file_path, ContentFile(ciphertext))
+
+def chunk_layout_error(session, chunk_number, size):
+    """Why a chunk does not fit the session's declared layout, or None."""
+    if not 0 <= chunk_number < session.chunk_count:
+        return f"Chunk number must be between 0 and {session.chunk_count - 1}"
+    if size != session.expected_chunk_size(chunk_number):
+        return f"Chunk {chunk_number} must be {session.expected_chunk_size(chunk_number)} bytes"
+    return None
+
+def read_request_body(stream, size, block_size=SEGMENT_SIZE):
+    """Yield a raw request body in blocks, stopping after size bytes."""
+    remaining = size
+    while remaining > 0:
+        block = stream.read(min(block_size, remaining))
+        if not block:
+            break
+        remaining -= len(block)
+        yield block
+
+def write_at(f, offset, blocks):
+    """Write blocks verbatim from offset on; returns the length written."""
+    f.seek(offset)
+    written = 0
+    for block in blocks:
+        f.write(block)
+        written += len(block)
+    return written
+
+def client_encryption_fields(data):
+    """
+    The client_encrypted flag and client_key_metadata of an upload request
+    (form fields or JSON). Files in end-to-end mode must come with key
+    metadata, a JSON object of at most 4 KiB; raises ValueError otherwise.
+    """
+    client_encrypted = str(data.get('client_encrypted', '')).lower() in ('true', '1')
+    if not client_encrypted:
+        return False, {}
+    metadata = data.get('client_key_metadata') or {}
+    if isinstance(metadata, str):
+        metadata = json.loads(metadata)
+    if not isinstance(metadata, dict) or not metadata or len(json.dumps(metadata)) > 4096:
+        raise ValueError("End-to-end encrypted files need client_key_metadata, a JSON object of at most 4 KiB")
+    return True, metadata
+
+def spool_request_body(stream, size, max_size=None):
+    """
+    The first size bytes of a raw request body, spooled to a temporary
+    file past max_size (FILE_UPLOAD_MAX_MEMORY_SIZE by default) the way
+    Django spools uploads.
+    """
+    spooled = tempfile.SpooledTemporaryFile(
+        max_size=max_size or settings.FILE_UPLOAD_MAX_MEMORY_SIZE
+    )
+    for block in read_request_body(stream, size):
+        spooled.write(block)
+    return DjangoFile(spooled)
+
+def write_chunk(file, session, chunk_number, chunk, expected_checksum=''):
+    """
+    Store one chunk of an upload, given as a file with chunks() (an
+    uploaded file or a spooled request body). The chunk is hashed and
+    checked first, so nothing reaches the container unless its size and
+    digest are right; then its plaintext is encrypted into its segments of
+    the final container (or, for a client-encrypted file, copied to the
+    chunk's offset) and only after that recorded in the session's
+    manifest. While chunks keep arriving in order the writing pass also
+    extends the whole-file hash. Re-sending a recorded chunk unchanged is
+    a no-op. Returns the chunk's hex SHA-256 and whether it was written;
+    raises ChunkUploadError if the chunk is short or does not match
+    expected_checksum, leaving it as it was, and ChunkConflictError if
+    other content was already accepted for it.
+    """
+    manifest = session.manifest
+    stored_checksum = manifest.chunk_digest(chunk_number)
+    # Clients may send the chunk's SHA-256 to skip even hashing a retry
+    if stored_checksum and expected_checksum == stored_checksum:
+        session.keep_alive()
+        return stored_checksum, False
+
+    hasher = hashlib.sha256()
+    size = 0
+    for block in chunk.chunks():
+        hasher.update(block)
+        size += len(block)
+    checksum = hasher.hexdigest()
+    if size != session.expected_chunk_size(chunk_number):
+        raise ChunkUploadError(f"Chunk {chunk_number} body is incomplete")
+    if expected_checksum and expected_checksum != checksum:
+        raise ChunkUploadError("Chunk checksum mismatch")
+    if stored_checksum:
+        if checksum != stored_checksum:
+            raise ChunkConflictError(f"Chunk {chunk_number} was already uploaded with different content")
+        session.keep_alive()
+        return checksum, False
+
+    # Segment nonces follow from the segment index, so sealing a segment
+    # again over other plaintext would reuse its nonce; a chunk number
+    # only ever takes the first content verified for it
+    if not manifest.pin_chunk(chunk_number, checksum):
+        raise ChunkConflictError(f"Chunk {chunk_number} was already uploaded with different content")
+
+    file_hasher = claim_running_hash(file.id, chunk_number)
+
+    def plaintext_blocks():
+        for block in chunk.chunks():
+            if file_hasher:
+                file_hasher.update(block)
+            yield block
+
+    # Chunks cover disjoint parts of the container, so concurrent
+    # requests for the same file can write without coordination
+    with open_container(file, 'r+b') as f:
+        if file.client_encrypted:
+            write_at(f, chunk_number * session.chunk_size, plaintext_blocks())
+        else:
+            writer = ContainerWriter(f, file.encryption_key, file.iv)
+            first_segment = chunk_number * session.chunk_size // writer.cipher.segment_size
+            writer.write_segments(first_segment, plaintext_blocks())
+
+    # Record the chunk in the manifest; the database is left alone
+    created = manifest.mark_chunk(chunk_number, checksum)
+    in_order = file_hasher is not None and created
+    if in_order and chunk_number == session.chunk_count - 1:
+        # Last chunk: keep the finished hash where any worker
+        # handling completion can find it
+        manifest.sha256 = file_hasher.hexdigest()
+    elif not in_order:
+        # Out of order, or written twice at once: whatever hash was
+        # finished may not cover the content now held, so completion
+        # falls back to the chunk tree hash
+        manifest.sha256 = ''
+    session.keep_alive()
+
+    if in_order and chunk_number < session.chunk_count - 1:
+        release_running_hash(file.id, chunk_number + 1, file_hasher)
+    return checksum, created
+
+def get_upload_session(request, file_id):
+    """The caller's open upload session for file_id, 404 if there is none."""
+    file = get_object_or_404(
+        File,
+        pk=file_id,
+        owner=request.user,
+        status=File.Status.UPLOADING
+    )
+    return file, get_object_or_404(UploadSession, file=file)
+
+def upload_session_gone():
+    return Response(
+        {"error": "This upload session has expired"},
+        status=status.HTTP_410_GONE
+    )
+
 def admin_required(view_func):
     @wraps(view_func)
     def _wrapped_view(view_instance, request, *args, **kwargs):
@@ -98,49 +297,21 @@ class FileContentView(APIView):
             file = get_object_or_404(File, pk=pk, owner=request.user)
         
         try:
-            file_path = file.get_file_path()
-            if not default_storage.exists(file_path):
-                return Response(
-                    {"error": "File not found"},
-                    status=status.HTTP_404_NOT_FOUND
-                )
-
-            # Read encrypted data
-            with default_storage.open(file_path, 'rb') as f:
-                encrypted_data = f.read()
-
-            # Decrypt the data using base64-encoded values
-            decrypted_data = decrypt_file(
-                encrypted_data,
-                file.encryption_key,
-                file.iv
-            )
-
-            # Create temporary file for serving
-            with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-                temp_file.write(decrypted_data)
-                temp_file.flush()
-
-            response = FileResponse(
-                open(temp_file.name, 'rb'),
-                content_type=file.mime_type
+            response = delivery.deliver_file(
+                request, file, delivery.INLINE, filename=file.original_name
             )
-            response['Content-Disposition'] = f'inline; filename="{file.original_name}"'
-            
-            # Add security headers
-            response['Content-Security-Policy'] = "default-src 'self'"
-            response['X-Content-Type-Options'] = 'nosniff'
-            response['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
-            response['Pragma'] = 'no-cache'
 
             # Update last accessed time
             file.last_accessed_at = timezone.now()
             file.save()
 
-            # Clean up temp file after response is sent
-            os.unlink(temp_file.name)
             return response
 
+        except delivery.FileNotFoundError:
+            return Response(
+                {"error": "File not found"},
+                status=status.HTTP_404_NOT_FOUND
+            )
         except Exception as e:
             return Response(
                 {"error": str(e)},
@@ -158,49 +329,21 @@ class FileDownloadView(APIView):
             file = get_object_or_404(File, pk=pk, owner=request.user)
 
         try:
-            file_path = file.get_file_path()
-            if not default_storage.exists(file_path):
-                return Response(
-                    {"error": "File not found"},
-                    status=status.HTTP_404_NOT_FOUND
-                )
-
-            # Read encrypted data
-            with default_storage.open(file_path, 'rb') as f:
-                encrypted_data = f.read()
-
-            # Decrypt the data using base64-encoded values
-            decrypted_data = decrypt_file(
-                encrypted_data,
-                file.encryption_key,
-                file.iv
+            response = delivery.deliver_file(
+                request, file, delivery.ATTACHMENT, filename=file.original_name
             )
 
-            # Create temporary file for serving
-            with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-                temp_file.write(decrypted_data)
-                temp_file.flush()
-
-            response = FileResponse(
-                open(temp_file.name, 'rb'),
-                content_type=file.mime_type
-            )
-            response['Content-Disposition'] = f'attachment; filename="{file.original_name}"'
-            
-            # Add security headers
-            response['Content-Security-Policy'] = "default-src 'self'"
-            response['X-Content-Type-Options'] = 'nosniff'
-            response['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
-            response['Pragma'] = 'no-cache'
-
             # Update last accessed time
             file.last_accessed_at = timezone.now()
             file.save()
 
-            # Clean up temp file after response is sent
-            os.unlink(temp_file.name)
             return response
 
+        except delivery.FileNotFoundError:
+            return Response(
+                {"error": "File not found"},
+                status=status.HTTP_404_NOT_FOUND
+            )
         except Exception as e:
             return Response(
                 {"error": str(e)},
@@ -228,6 +371,104 @@ class FileVersionDetailView(generics.RetrieveAPIView):
             version_number=self.kwargs['version']
         )
 
+class FileVersionSignatureView(APIView):
+    """
+    Block signature of a file's current content, the first step of
+    uploading a new version as a delta (see files.delta).
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, pk):
+        file = get_object_or_404(
+            File, pk=pk, owner=request.user, status=File.Status.COMPLETED, is_deleted=False
+        )
+        try:
+            block_size = int(request.query_params.get('block_size', settings.DELTA_BLOCK_SIZE))
+        except ValueError:
+            block_size = 0
+        if not 512 <= block_size <= SEGMENT_SIZE * 16:
+            return Response(
+                {"error": f"block_size must be between 512 and {SEGMENT_SIZE * 16}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        try:
+            return Response(version_signature(file, block_size))
+        except FileVersionError as e:
+            return Response({"error": e.detail}, status=e.status_code)
+        except delivery.FileNotFoundError:
+            return Response(
+                {"error": "File not found"},
+                status=status.HTTP_404_NOT_FOUND
+            )
+
+class FileVersionUploadView(APIView):
+    """
+    Upload a new version of a file as a raw application/octet-stream delta
+    against its current version:
+
+        X-Base-Version        version number the delta was computed against
+        X-Content-Checksum    hex SHA-256 of the new content, optional
+
+    with an optional comment query parameter. Answers 409 if another
+    version landed first; the client should fetch a fresh signature and
+    try again.
+    """
+    permission_classes = [IsAuthenticated]
+    parser_classes = []
+
+    def put(self, request, pk):
+        file = get_object_or_404(
+            File, pk=pk, owner=request.user, status=File.Status.COMPLETED, is_deleted=False
+        )
+        if request.content_type != 'application/octet-stream':
+            return Response(
+                {"error": "Delta body must be application/octet-stream"},
+                status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE
+            )
+        try:
+            base_version = int(request.headers['X-Base-Version'])
+        except (KeyError, ValueError):
+            return Response(
+                {"error": "A numeric X-Base-Version header is required"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            version = create_version(
+                file, request.stream, base_version, request.user,
+                comment=request.query_params.get('comment', ''),
+                expected_checksum=request.headers.get('X-Content-Checksum', '').lower()
+            )
+        except FileVersionError as e:
+            return Response({"error": e.detail}, status=e.status_code)
+        return Response(
+            FileVersionSerializer(version).data,
+            status=status.HTTP_201_CREATED
+        )
+
+class FileVersionDownloadView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, file_pk, version):
+        version = get_object_or_404(
+            FileVersion.objects.select_related('file', 'blob'),
+            file_id=file_pk,
+            file__owner=request.user,
+            version_number=version
+        )
+        file = version.file
+        try:
+            return delivery.deliver_file(
+                request, file, delivery.ATTACHMENT,
+                filename=f"v{version.version_number}_{file.original_name}",
+                version=version
+            )
+        except delivery.FileNotFoundError:
+            return Response(
+                {"error": "File not found"},
+                status=status.HTTP_404_NOT_FOUND
+            )
+
 class InitializeUploadView(APIView):
     permission_classes = [IsAuthenticated]
 
@@ -248,15 +489,46 @@ class InitializeUploadView(APIView):
                     status=status.HTTP_400_BAD_REQUEST
                 )
 
-            # Generate encryption key and unique path
-            encryption_key = generate_encryption_key()
+            try:
+                client_encrypted, client_key_metadata = client_encryption_fields(request.data)
+            except ValueError as e:
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+            # Chunks are encrypted straight into whole container segments,
+            # so every chunk but the last must cover a whole number of them
+            chunk_size = int(request.data.get('chunk_size', settings.CHUNK_SIZE))
+            if chunk_size <= 0 or chunk_size % SEGMENT_SIZE:
+                return Response(
+                    {"error": f"Chunk size must be a positive multiple of {SEGMENT_SIZE} bytes"},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            if chunk_size > settings.MAX_CHUNK_SIZE:
+                return Response(
+                    {"error": f"Chunk size cannot exceed {settings.MAX_CHUNK_SIZE} bytes"},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+            # The declared size fixes the chunk layout up front, so chunks
+            # can arrive in parallel and in any order
+            total_size = request.data.get('size')
+            if total_size is None or int(total_size) < 0:
+                return Response(
+                    {"error": "Total file size is required"},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            total_size = int(total_size)
+            if total_size > settings.MAX_UPLOAD_SIZE:
+                return Response(
+                    {"error": f"File size exceeds the limit of {settings.MAX_UPLOAD_SIZE} bytes"},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+            # Generate encryption key and unique path; the server holds no
+            # key for end-to-end encrypted files
+            encryption_key = '' if client_encrypted else generate_encryption_key()
             timestamp = timezone.now().strftime('%Y%m%d_%H%M%S')
             unique_id = str(uuid.uuid4())
-            
-            # Create base directory path
-            base_path = f"files/{request.user.id}/{timestamp}_{unique_id}"
-            ensure_directory_exists(base_path)
-            
+
             # Set encrypted path relative to base storage
             encrypted_path = f"{timestamp}_{unique_id}/{name}"
 
@@ -264,10 +536,12 @@ class InitializeUploadView(APIView):
                 'name': name,
                 'original_name': name,
                 'mime_type': mime_type,
-                'size': request.data.get('size', 0),
+                'size': total_size,
                 'encryption_key': encryption_key,  # Already base64 encoded from generate_encryption_key()
                 'encrypted_path': encrypted_path,
-                'iv': generate_iv(),  # New utility function to generate and encode IV
+                'iv': '' if client_encrypted else generate_iv(),  # New utility function to generate and encode IV
+                'client_encrypted': client_encrypted,
+                'client_key_metadata': client_key_metadata,
                 'status': File.Status.UPLOADING,
                 'description': request.data.get('description', ''),
                 'tags': request.data.get('tags', []),
@@ -277,7 +551,17 @@ class InitializeUploadView(APIView):
             # Use the FileInitializeSerializer for creation
             serializer = FileInitializeSerializer(data=file_data)
             if serializer.is_valid():
-                file = serializer.save(owner=request.user)
+                with transaction.atomic():
+                    file = serializer.save(owner=request.user)
+                    UploadSession.objects.create(
+                        file=file, chunk_size=chunk_size, total_size=total_size
+                    )
+
+                # Lay down the container header; chunks fill in the segments
+                with open_container(file, 'wb') as f:
+                    if not file.client_encrypted:
+                        ContainerWriter(f, file.encryption_key, file.iv).write_header()
+
                 # Return the response using the main FileSerializer
                 return Response(
                     FileSerializer(file).data,
@@ -297,18 +581,270 @@ class InitializeUploadView(APIView):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
-class UploadChunkView(APIView):
+class SmallUploadView(APIView):
+    """
+    One-shot upload for files up to SMALL_UPLOAD_MAX_SIZE: the content and
+    metadata arrive in a single request, are encrypted in memory and the
+    File and FileVersion rows are committed together.
+    """
     permission_classes = [IsAuthenticated]
     parser_classes = [MultiPartParser]
 
-    def post(self, request, file_id):
-        file = get_object_or_404(
-            File,
-            pk=file_id,
+    def post(self, request):
+        upload = request.FILES.get('file')
+        if not upload:
+            return Response(
+                {"error": "File data is required"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if upload.size > settings.SMALL_UPLOAD_MAX_SIZE:
+            return Response(
+                {"error": f"Files over {settings.SMALL_UPLOAD_MAX_SIZE} bytes must use a chunked upload"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        name = clean_filename(request.data.get('name', '') or upload.name)
+        if not name:
+            return Response(
+                {"error": "File name is required"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        mime_type = request.data.get('mime_type', '') or upload.content_type
+        if not is_valid_file_type(mime_type):
+            return Response(
+                {"error": "Invalid file type"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        try:
+            client_encrypted, client_key_metadata = client_encryption_fields(request.data)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        file = File(
             owner=request.user,
-            status=File.Status.UPLOADING
+            name=name,
+            original_name=name,
+            mime_type=mime_type,
+            encryption_key='' if client_encrypted else generate_encryption_key(),
+            client_encrypted=client_encrypted,
+            client_key_metadata=client_key_metadata,
+            encrypted_path=generate_encrypted_path(name),
+            status=File.Status.COMPLETED,
+            description=request.data.get('description', ''),
+            tags=request.data.getlist('tags'),
+        )
+
+        try:
+            file_path = store_small_file(file, upload.read())
+            file.upload_completed_at = timezone.now()
+            try:
+                with transaction.atomic():
+                    file.save()
+                    FileVersion.objects.create(
+                        file=file,
+                        version_number=1,
+                        encrypted_path=file.encrypted_path,
+                        encryption_key=file.encryption_key,
+                        iv=file.iv,
+                        checksum=file.checksum,
+                        size=file.size,
+                        created_by=request.user
+                    )
+            except Exception:
+                default_storage.delete(file_path)
+                raise
+
+            return Response(
+                FileSerializer(file).data,
+                status=status.HTTP_201_CREATED
+            )
+
+        except Exception as e:
+            return Response(
+                {"error": str(e)},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+class InitializeBatchUploadView(APIView):
+    """
+    Start a batch upload of many small files: validates every entry of
+    "files" (name, mime_type, size) and allocates all the file records at
+    once.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        entries = request.data.get('files')
+        if not isinstance(entries, list) or not entries:
+            return Response(
+                {"error": "A list of files is required"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if len(entries) > settings.UPLOAD_BATCH_MAX_FILES:
+            return Response(
+                {"error": f"A batch may hold at most {settings.UPLOAD_BATCH_MAX_FILES} files"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        files = []
+        for index, entry in enumerate(entries):
+            if not isinstance(entry, dict):
+                return Response(
+                    {"error": "Each file must be an object", "index": index},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            name = clean_filename(str(entry.get('name', '')))
+            mime_type = entry.get('mime_type', '')
+            try:
+                size = int(entry.get('size'))
+            except (TypeError, ValueError):
+                size = -1
+            try:
+                client_encrypted, client_key_metadata = client_encryption_fields(entry)
+            except ValueError as e:
+                client_encrypted, error = False, str(e)
+            else:
+                error = None
+            if not name or not is_valid_file_type(mime_type):
+                error = "Invalid file name or type"
+            elif not 0 <= size <= settings.SMALL_UPLOAD_MAX_SIZE:
+                error = f"Size must be between 0 and {settings.SMALL_UPLOAD_MAX_SIZE} bytes"
+            if error:
+                return Response(
+                    {"error": error, "index": index},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            files.append(File(
+                owner=request.user,
+                name=name,
+                original_name=name,
+                mime_type=mime_type,
+                size=size,
+                encryption_key='' if client_encrypted else generate_encryption_key(),
+                encrypted_path=generate_encrypted_path(name),
+                client_encrypted=client_encrypted,
+                client_key_metadata=client_key_metadata,
+                iv='',
+                checksum='',
+                status=File.Status.UPLOADING,
+                description=entry.get('description', ''),
+                tags=entry.get('tags', [])
+            ))
+
+        with transaction.atomic():
+            File.objects.bulk_create(files)
+            batch = UploadBatch.objects.create(owner=request.user)
+            batch.files.add(*files)
+
+        return Response(
+            UploadBatchSerializer(batch, context={'files': files}).data,
+            status=status.HTTP_201_CREATED
+        )
+
+class BatchUploadContentView(APIView):
+    """
+    Receive file bodies for a batch upload as one multipart request, each
+    part named by its file id. A batch's files may be spread over several
+    such requests; re-sending a file replaces it.
+    """
+    permission_classes = [IsAuthenticated]
+    parser_classes = [MultiPartParser]
+
+    def post(self, request, batch_id):
+        batch = get_object_or_404(UploadBatch, pk=batch_id, owner=request.user)
+        if batch.is_expired():
+            return Response(
+                {"error": "This upload batch has expired"},
+                status=status.HTTP_410_GONE
+            )
+
+        files = {
+            str(file.id): file
+            for file in batch.files.select_related('owner').filter(status=File.Status.UPLOADING)
+        }
+        unknown = [key for key in request.FILES if key not in files]
+        if unknown:
+            return Response(
+                {"error": "Files not pending in this batch", "files": unknown},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        for key, upload in request.FILES.items():
+            if upload.size != files[key].size:
+                return Response(
+                    {"error": f"File {key} must be {files[key].size} bytes"},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+        try:
+            received = []
+            for key, upload in request.FILES.items():
+                store_small_file(files[key], upload.read())
+                received.append(files[key])
+            File.objects.bulk_update(received, ['iv', 'checksum', 'checksum_algorithm'])
+        except Exception as e:
+            return Response(
+                {"error": str(e)},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+        return Response({"received": [file.id for file in received]})
+
+class CompleteBatchUploadView(APIView):
+    """Commit every file of a batch upload in one transaction."""
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, batch_id):
+        batch = get_object_or_404(UploadBatch, pk=batch_id, owner=request.user)
+        if batch.is_expired():
+            return Response(
+                {"error": "This upload batch has expired"},
+                status=status.HTTP_410_GONE
+            )
+
+        with transaction.atomic():
+            files = list(batch.files.select_for_update().filter(status=File.Status.UPLOADING))
+            missing = [file.id for file in files if not file.checksum]
+            if missing:
+                return Response(
+                    {"error": "Some files have no content yet", "files": missing},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+            now = timezone.now()
+            for file in files:
+                file.status = File.Status.COMPLETED
+                file.upload_completed_at = now
+            File.objects.bulk_update(files, ['status', 'upload_completed_at'])
+            FileVersion.objects.bulk_create([
+                FileVersion(
+                    file=file,
+                    version_number=1,
+                    encrypted_path=file.encrypted_path,
+                    encryption_key=file.encryption_key,
+                    iv=file.iv,
+                    checksum=file.checksum,
+                    size=file.size,
+                    created_by=request.user
+                )
+                for file in files
+            ])
+            batch.delete()
+
+        return Response(
+            FileListSerializer(files, many=True).data,
+            status=status.HTTP_200_OK
         )
 
+class UploadChunkView(APIView):
+    permission_classes = [IsAuthenticated]
+    parser_classes = [MultiPartParser]
+
+    def post(self, request, file_id):
+        file, session = get_upload_session(request, file_id)
+        if session.is_expired():
+            return upload_session_gone()
+
         try:
             chunk_number = int(request.data.get('chunk_number', 0))
             chunk_data = request.FILES.get('chunk')
@@ -319,44 +855,241 @@ class UploadChunkView(APIView):
                     status=status.HTTP_400_BAD_REQUEST
                 )
 
-            # Create a temporary file for the chunk data
-            with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-                for chunk in chunk_data.chunks():
-                    temp_file.write(chunk)
-                temp_file.flush()
-                
-                # Calculate chunk hash from the temporary file
-                chunk_hash = calculate_file_hash(temp_file.name)
-            
-            # Create chunk record
-            chunk = FileChunk.objects.create(
-                file=file,
-                chunk_number=chunk_number,
-                size=chunk_data.size,
-                checksum=chunk_hash,
-                status=File.Status.COMPLETED
-            )
-
-            # Store chunk data
-            chunk_path = f"chunks/{file.id}/{chunk_number}"
-            ensure_directory_exists(chunk_path)
-            with open(temp_file.name, 'rb') as f:
-                default_storage.save(chunk_path, ContentFile(f.read()))
-            
-            # Clean up the temporary file
-            os.unlink(temp_file.name)
+            error = chunk_layout_error(session, chunk_number, chunk_data.size)
+            if error:
+                return Response({"error": error}, status=status.HTTP_400_BAD_REQUEST)
 
+            checksum, created = write_chunk(
+                file, session, chunk_number, chunk_data,
+                request.data.get('checksum', '').lower()
+            )
             return Response(
-                FileChunkSerializer(chunk).data,
-                status=status.HTTP_201_CREATED
+                chunk_receipt(session, chunk_number, checksum),
+                status=status.HTTP_201_CREATED if created else status.HTTP_200_OK
             )
 
+        except ChunkUploadError as e:
+            return Response({"error": e.detail}, status=e.status_code)
         except Exception as e:
             return Response(
                 {"error": str(e)},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+class RawUploadChunkView(APIView):
+    """
+    Chunk upload taking the chunk as a raw application/octet-stream body,
+    described by headers instead of multipart fields:
+
+        X-Chunk-Index     chunk number (required)
+        X-Chunk-Offset    byte offset of the chunk, checked if present
+        X-Chunk-Checksum  hex SHA-256 of the chunk, optional
+
+    The body is not parsed, only held like an uploaded file so that it
+    can be checked before any of it reaches the container. Unlike Django's
+    uploads it stays in memory up to the session's chunk size. A retry
+    carrying its checksum is recognised without reading the body; one
+    without is hashed and compared with the recorded chunk.
+    """
+    permission_classes = [IsAuthenticated]
+    parser_classes = []
+
+    def put(self, request, file_id):
+        file, session = get_upload_session(request, file_id)
+        if session.is_expired():
+            return upload_session_gone()
+
+        if request.content_type != 'application/octet-stream':
+            return Response(
+                {"error": "Chunk body must be application/octet-stream"},
+                status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE
+            )
+
+        try:
+            chunk_number = int(request.headers['X-Chunk-Index'])
+            size = int(request.headers.get('Content-Length') or 0)
+            offset = request.headers.get('X-Chunk-Offset')
+            offset = int(offset) if offset is not None else None
+        except (KeyError, ValueError):
+            return Response(
+                {"error": "A numeric X-Chunk-Index header is required"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        error = chunk_layout_error(session, chunk_number, size)
+        if error:
+            return Response({"error": error}, status=status.HTTP_400_BAD_REQUEST)
+        if offset is not None and offset != chunk_number * session.chunk_size:
+            return Response(
+                {"error": f"Chunk {chunk_number} starts at offset {chunk_number * session.chunk_size}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        # A retry carrying its checksum does not need its body spooled
+        expected_checksum = request.headers.get('X-Chunk-Checksum', '').lower()
+        if expected_checksum and expected_checksum == session.manifest.chunk_digest(chunk_number):
+            session.keep_alive()
+            return Response(
+                chunk_receipt(session, chunk_number, expected_checksum),
+                status=status.HTTP_200_OK
+            )
+
+        try:
+            # Chunks are hashed before they are written, so one spilled to
+            # disk would be read back twice; MAX_CHUNK_SIZE bounds the memory
+            with spool_request_body(request.stream, size, max_size=session.chunk_size) as chunk:
+                checksum, created = write_chunk(file, session, chunk_number, chunk, expected_checksum)
+        except ChunkUploadError as e:
+            return Response({"error": e.detail}, status=e.status_code)
+        return Response(
+            chunk_receipt(session, chunk_number, checksum),
+            status=status.HTTP_201_CREATED if created else status.HTTP_200_OK
+        )
+
+def parse_checksums(value):
+    """A list of lowercase hex SHA-256 checksums, or None if value is not one."""
+    if not isinstance(value, list):
+        return None
+    checksums = [str(checksum).lower() for checksum in value]
+    return checksums if all(is_checksum(checksum) for checksum in checksums) else None
+
+class DedupChunkQueryView(APIView):
+    """
+    Which of the listed chunk checksums ("hashes") the caller already has
+    stored, so a deduplicated upload only sends the rest.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        checksums = parse_checksums(request.data.get('hashes'))
+        if checksums is None:
+            return Response(
+                {"error": "A list of hex SHA-256 hashes is required"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if len(checksums) > settings.DEDUP_QUERY_MAX_HASHES:
+            return Response(
+                {"error": f"At most {settings.DEDUP_QUERY_MAX_HASHES} hashes may be queried at once"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        held = held_chunks(request.user, checksums)
+        return Response({
+            'have': [checksum for checksum in dict.fromkeys(checksums) if checksum in held]
+        })
+
+class DedupChunkUploadView(APIView):
+    """
+    Store one content-defined chunk, sent as a raw application/octet-stream
+    body and named by its hex SHA-256. Storing a chunk the caller already
+    has is a no-op.
+    """
+    permission_classes = [IsAuthenticated]
+    parser_classes = []
+
+    def put(self, request, checksum):
+        checksum = checksum.lower()
+        if not is_checksum(checksum):
+            return Response(
+                {"error": "Chunks are named by their hex SHA-256"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if request.content_type != 'application/octet-stream':
+            return Response(
+                {"error": "Chunk body must be application/octet-stream"},
+                status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE
+            )
+        size = int(request.headers.get('Content-Length') or 0)
+        if not 0 < size <= settings.DEDUP_CHUNK_MAX_SIZE:
+            return Response(
+                {"error": f"Chunks must be between 1 and {settings.DEDUP_CHUNK_MAX_SIZE} bytes"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            chunk, created = store_chunk(
+                request.user, checksum, read_request_body(request.stream, size)
+            )
+        except ChunkUploadError as e:
+            return Response({"error": e.detail}, status=e.status_code)
+        return Response(
+            {'hash': checksum, 'size': chunk.size},
+            status=status.HTTP_201_CREATED if created else status.HTTP_200_OK
+        )
+
+class DedupCompleteUploadView(APIView):
+    """
+    Commit a deduplicated upload: the file's content is the caller's
+    stored chunks listed in "chunks", in order.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        checksums = parse_checksums(request.data.get('chunks'))
+        if checksums is None:
+            return Response(
+                {"error": "A list of chunk hashes is required"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        name = clean_filename(request.data.get('name', ''))
+        if not name:
+            return Response(
+                {"error": "File name is required"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        mime_type = request.data.get('mime_type', '')
+        if not is_valid_file_type(mime_type):
+            return Response(
+                {"error": "Invalid file type"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        held = held_chunks(request.user, checksums)
+        missing = [checksum for checksum in dict.fromkeys(checksums) if checksum not in held]
+        if missing:
+            return Response(
+                {"error": "Some chunks have not been uploaded", "missing": missing},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        try:
+            file = commit_chunked_file(
+                request.user, checksums, name, mime_type,
+                description=request.data.get('description', ''),
+                tags=request.data.get('tags', [])
+            )
+        except (ChunkMissingError, FileSizeError) as e:
+            return Response({"error": e.detail}, status=e.status_code)
+        return Response(
+            FileSerializer(file).data,
+            status=status.HTTP_201_CREATED
+        )
+
+class UploadChunksView(APIView):
+    """
+    Which chunks of an upload the server already holds, so an interrupted
+    client can resume by sending only the rest.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, file_id):
+        file = get_object_or_404(
+            File,
+            pk=file_id,
+            owner=request.user,
+            status=File.Status.UPLOADING
+        )
+        session = get_object_or_404(UploadSession, file=file)
+        if session.is_expired():
+            return Response(
+                {"error": "This upload session has expired"},
+                status=status.HTTP_410_GONE
+            )
+        return Response(UploadSessionSerializer(session).data)
+
+def hand_over(file_id, manifest):
+    """Queue finalization once its inputs are safely on the session row."""
+    manifest.delete()
+    finalize_upload.delay(str(file_id))
+
 class CompleteUploadView(APIView):
     permission_classes = [IsAuthenticated]
 
@@ -368,80 +1101,61 @@ class CompleteUploadView(APIView):
             status=File.Status.UPLOADING
         )
 
+        session = get_object_or_404(UploadSession, file=file)
+        if session.is_expired():
+            return Response(
+                {"error": "This upload session has expired"},
+                status=status.HTTP_410_GONE
+            )
+
+        # Reject an incomplete manifest straight away; the rest of the
+        # work happens in the finalization task
+        manifest = session.manifest
         try:
-            # Verify all chunks are present
-            chunks = FileChunk.objects.filter(file=file).order_by('chunk_number')
-            expected_chunks = range(chunks.count())
-            if not all(c.chunk_number == n for c, n in zip(chunks, expected_chunks)):
-                return Response(
-                    {"error": "Missing chunks"},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
+            digests = verify_chunk_manifest(session)
+        except ChunkMissingError as e:
+            return Response(
+                {"error": str(e.detail)},
+                status=status.HTTP_400_BAD_REQUEST
+            )
 
-            # Combine chunks and encrypt
-            with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-                for chunk in chunks:
-                    chunk_path = f"chunks/{file.id}/{chunk.chunk_number}"
-                    with default_storage.open(chunk_path, 'rb') as chunk_file:
-                        temp_file.write(chunk_file.read())
-                temp_file.flush()
-
-                # Calculate final file hash and size
-                file_hash = calculate_file_hash(temp_file.name)
-                file_size = get_file_size(temp_file.name)
-
-                # Encrypt the complete file
-                encrypted_data, iv = encrypt_file(
-                    temp_file.name,
-                    file.encryption_key  # Pass the key directly, encrypt_file handles base64 decoding
-                )
+        # Move the manifest onto the session row for the worker, along with
+        # any whole-file hash
+        session.store_digests(digests)
+        session.sha256 = manifest.sha256
 
-            # Save encrypted file
-            file_path = file.get_file_path()
-            ensure_directory_exists(file_path)
-            default_storage.save(file_path, ContentFile(encrypted_data))
+        with transaction.atomic():
+            session.save(update_fields=['digests', 'sha256'])
+            file.status = File.Status.PROCESSING
+            file.save(update_fields=['status'])
+            transaction.on_commit(lambda: hand_over(file.id, manifest))
 
-            # Update file record
-            file.status = File.Status.COMPLETED
-            file.upload_completed_at = timezone.now()
-            file.size = file_size
-            file.checksum = file_hash
-            file.iv = iv  # IV is already base64 encoded by encrypt_file
-            file.save()
-
-            # Clean up chunks
-            for chunk in chunks:
-                chunk_path = f"chunks/{file.id}/{chunk.chunk_number}"
-                default_storage.delete(chunk_path)
-            chunks.delete()
+        return Response(
+            FileSerializer(file).data,
+            status=status.HTTP_202_ACCEPTED
+        )
 
-            # Create initial version
-            FileVersion.objects.create(
-                file=file,
-                version_number=1,
-                encrypted_path=file.encrypted_path,
-                encryption_key=file.encryption_key,
-                iv=file.iv,
-                checksum=file.checksum,
-                size=file.size,
-                created_by=request.user
-            )
+class UploadStatusView(APIView):
+    """
+    Report the progress of an upload being finalized. The answer is
+    immediate; while the file is still PROCESSING a Retry-After header says
+    when to ask again, so no web worker is held waiting on the task.
+    """
+    permission_classes = [IsAuthenticated]
 
-            return Response(
-                FileSerializer(file).data,
-                status=status.HTTP_200_OK
-            )
+    def get(self, request, file_id):
+        file = get_object_or_404(File, pk=file_id, owner=request.user)
 
-        except Exception as e:
-            file.status = File.Status.FAILED
-            file.save()
-            print("Error in CompleteUploadView:", str(e))
-            import traceback
-            traceback.print_exc()
-            return Response(
-                {"error": str(e)},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
-            )
+        data = {"id": file.id, "status": file.status}
+        if file.status == File.Status.COMPLETED:
+            data["file"] = FileSerializer(file).data
+        elif file.status == File.Status.FAILED:
+            session = UploadSession.objects.filter(file=file).first()
+            data["error"] = session.error if session else ""
+        response = Response(data)
+        if file.status == File.Status.PROCESSING:
+            response['Retry-After'] = settings.STATUS_POLL_INTERVAL
+        return response
 
 class FileMoveView(APIView):
     permission_classes = [IsAuthenticated]
@@ -470,85 +1184,24 @@ class FileCopyView(APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request, pk):
-        source_file = get_object_or_404(File, pk=pk, owner=request.user)
+        source_file = get_object_or_404(
+            File, pk=pk, owner=request.user, status=File.Status.COMPLETED
+        )
         try:
-            # Generate new encryption key for the copy
-            encryption_key = generate_encryption_key()
-            
-            # Create new file record
-            new_file = File.objects.create(
-                owner=request.user,
-                name=f"Copy of {source_file.name}",
-                original_name=source_file.original_name,
-                mime_type=source_file.mime_type,
-                size=source_file.size,
-                encryption_key=encryption_key,  # Already base64 encoded from generate_encryption_key()
-                status=File.Status.PROCESSING,
-                description=source_file.description,
-                tags=source_file.tags.copy(),
-                metadata=source_file.metadata.copy()
-            )
-
-            # Read source file
-            source_path = source_file.get_file_path()
-            with default_storage.open(source_path, 'rb') as f:
-                encrypted_data = f.read()
-
-            # Decrypt with source key and re-encrypt with new key
-            decrypted_data = decrypt_file(
-                encrypted_data,
-                source_file.encryption_key,
-                source_file.iv
-            )
-
-            # Create temporary file for re-encryption
-            with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-                temp_file.write(decrypted_data)
-                temp_file.flush()
-
-                # Re-encrypt with new key
-                encrypted_data, iv = encrypt_file(
-                    temp_file.name,
-                    new_file.encryption_key  # Pass key directly, encrypt_file handles base64 decoding
+            copies = copy_files([source_file], request.user)
+            if source_file.pk not in copies:
+                # The upload stopped being complete before it was locked
+                return Response(
+                    {"error": "Only completed uploads can be copied"},
+                    status=status.HTTP_409_CONFLICT
                 )
-
-            # Save new encrypted file
-            new_file_path = new_file.get_file_path()
-            ensure_directory_exists(new_file_path)
-            default_storage.save(new_file_path, ContentFile(encrypted_data))
-
-            # Update new file record
-            new_file.status = File.Status.COMPLETED
-            new_file.iv = iv  # IV is already base64 encoded by encrypt_file
-            new_file.checksum = calculate_file_hash(temp_file.name)
-            new_file.upload_completed_at = timezone.now()
-            new_file.save()
-
-            # Clean up
-            os.unlink(temp_file.name)
-
-            # Create initial version
-            FileVersion.objects.create(
-                file=new_file,
-                version_number=1,
-                encrypted_path=new_file.encrypted_path,
-                encryption_key=new_file.encryption_key,
-                iv=new_file.iv,
-                checksum=new_file.checksum,
-                size=new_file.size,
-                created_by=request.user,
-                comment=f"Initial version (copied from {source_file.name})"
-            )
-
+            new_file = copies[source_file.pk]
             return Response(
                 FileSerializer(new_file).data,
                 status=status.HTTP_201_CREATED
             )
 
         except Exception as e:
-            print("Error in FileCopyView:", str(e))
-            import traceback
-            traceback.print_exc()
             return Response(
                 {"error": str(e)},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -567,145 +1220,111 @@ class FileRestoreView(APIView):
             status=status.HTTP_200_OK
         )
 
+def start_bulk_job(request, operation):
+    """
+    Queue a bulk job over request.data['file_ids'] and respond straight
+    away with its id; the work happens in run_bulk_job. Moves take the new
+    names from request.data['new_names'], keyed by file id.
+    """
+    try:
+        file_ids = parse_id_list(request.data, 'file_ids')
+    except ValueError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    new_names = request.data.get('new_names', {})
+    if not isinstance(new_names, dict):
+        return Response(
+            {"error": "new_names must be an object"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    if len(file_ids) > settings.BULK_JOB_MAX_FILES:
+        return Response(
+            {"error": f"At most {settings.BULK_JOB_MAX_FILES} files can be processed at once"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    with transaction.atomic():
+        job = BulkJob.objects.create(
+            owner=request.user, operation=operation, total=len(file_ids)
+        )
+        BulkJobItem.objects.bulk_create([
+            BulkJobItem(
+                job=job,
+                file_id=file_id,
+                new_name=str(new_names.get(str(file_id), ''))[:255]
+            )
+            for file_id in file_ids
+        ])
+        transaction.on_commit(lambda: run_bulk_job.delay(str(job.id)))
+
+    return Response(
+        BulkJobSerializer(job).data,
+        status=status.HTTP_202_ACCEPTED
+    )
+
 class BulkDeleteView(APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request):
-        file_ids = request.data.get('file_ids', [])
-        files = File.objects.filter(
-            id__in=file_ids,
-            owner=request.user,
-            is_deleted=False
-        )
-        now = timezone.now()
-        files.update(is_deleted=True, deleted_at=now)
-        return Response(status=status.HTTP_200_OK)
+        return start_bulk_job(request, BulkJob.Operation.DELETE)
 
 class BulkMoveView(APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request):
-        file_ids = request.data.get('file_ids', [])
-        new_names = request.data.get('new_names', {})
-        
-        try:
-            files = File.objects.filter(
-                id__in=file_ids,
-                owner=request.user,
-                is_deleted=False
-            )
-
-            updated_files = []
-            for file in files:
-                if str(file.id) in new_names:
-                    file.name = clean_filename(new_names[str(file.id)])
-                    file.save()
-                    updated_files.append(file)
-
-            return Response(
-                FileListSerializer(updated_files, many=True).data,
-                status=status.HTTP_200_OK
-            )
-
-        except Exception as e:
-            return Response(
-                {"error": str(e)},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
-            )
+        return start_bulk_job(request, BulkJob.Operation.MOVE)
 
 class BulkCopyView(APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request):
-        file_ids = request.data.get('file_ids', [])
-        
-        try:
-            source_files = File.objects.filter(
-                id__in=file_ids,
-                owner=request.user,
-                is_deleted=False
-            )
-
-            copied_files = []
-            for source_file in source_files:
-                # Generate new encryption key
-                encryption_key = generate_encryption_key()
-                
-                # Create new file record
-                new_file = File.objects.create(
-                    owner=request.user,
-                    name=f"Copy of {source_file.name}",
-                    original_name=source_file.original_name,
-                    mime_type=source_file.mime_type,
-                    size=source_file.size,
-                    encryption_key=encryption_key,  # Already base64 encoded from generate_encryption_key()
-                    status=File.Status.PROCESSING,
-                    description=source_file.description,
-                    tags=source_file.tags.copy(),
-                    metadata=source_file.metadata.copy()
-                )
-
-                # Read and decrypt source file
-                source_path = source_file.get_file_path()
-                with default_storage.open(source_path, 'rb') as f:
-                    encrypted_data = f.read()
+        return start_bulk_job(request, BulkJob.Operation.COPY)
 
-                decrypted_data = decrypt_file(
-                    encrypted_data,
-                    source_file.encryption_key,
-                    source_file.iv
-                )
-
-                # Re-encrypt with new key
-                with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-                    temp_file.write(decrypted_data)
-                    temp_file.flush()
-
-                    encrypted_data, iv = encrypt_file(
-                        temp_file.name,
-                        new_file.encryption_key  # Pass key directly, encrypt_file handles base64 decoding
-                    )
-
-                # Save new encrypted file
-                new_file_path = new_file.get_file_path()
-                ensure_directory_exists(new_file_path)
-                default_storage.save(new_file_path, ContentFile(encrypted_data))
-
-                # Update new file record
-                new_file.status = File.Status.COMPLETED
-                new_file.iv = iv  # IV is already base64 encoded by encrypt_file
-                new_file.checksum = calculate_file_hash(temp_file.name)
-                new_file.upload_completed_at = timezone.now()
-                new_file.save()
-
-                # Clean up
-                os.unlink(temp_file.name)
-
-                # Create initial version
-                FileVersion.objects.create(
-                    file=new_file,
-                    version_number=1,
-                    encrypted_path=new_file.encrypted_path,
-                    encryption_key=new_file.encryption_key,
-                    iv=new_file.iv,
-                    checksum=new_file.checksum,
-                    size=new_file.size,
-                    created_by=request.user,
-                    comment=f"Initial version (copied from {source_file.name})"
-                )
-
-                copied_files.append(new_file)
+class FileArchiveDownloadView(APIView):
+    """
+    Download the files in request.data['file_ids'] as one ZIP, streamed
+    while it is built.
+    """
+    permission_classes = [IsAuthenticated]
 
+    def post(self, request):
+        try:
+            file_ids = parse_id_list(request.data, 'file_ids')
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if not 0 < len(file_ids) <= settings.ZIP_DOWNLOAD_MAX_FILES:
             return Response(
-                FileListSerializer(copied_files, many=True).data,
-                status=status.HTTP_201_CREATED
+                {"error": f"Select between 1 and {settings.ZIP_DOWNLOAD_MAX_FILES} files"},
+                status=status.HTTP_400_BAD_REQUEST
             )
 
-        except Exception as e:
+        files = File.objects.filter(
+            owner=request.user, is_deleted=False, status=File.Status.COMPLETED
+        ).select_related('blob').in_bulk(file_ids)
+        if len(files) != len(file_ids):
             return Response(
-                {"error": str(e)},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+                {"error": "File not found", "files": [str(pk) for pk in file_ids if pk not in files]},
+                status=status.HTTP_404_NOT_FOUND
             )
+        return archive.zip_download([files[pk] for pk in file_ids], 'files.zip')
+
+class BulkJobStatusView(APIView):
+    """
+    Report the progress of a bulk job. The answer is immediate; until the
+    job completes a Retry-After header says when to ask again. Only the
+    counters are sent unless ?items=1 asks for each file's outcome too.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, job_id):
+        job = get_object_or_404(BulkJob, pk=job_id, owner=request.user)
+        if request.query_params.get('items') in ('1', 'true'):
+            job = BulkJob.objects.prefetch_related('items').get(pk=job.pk)
+            response = Response(BulkJobDetailSerializer(job).data)
+        else:
+            response = Response(BulkJobSerializer(job).data)
+        if job.status != BulkJob.Status.COMPLETED:
+            response['Retry-After'] = settings.STATUS_POLL_INTERVAL
+        return response
 
 class FileSearchView(generics.ListAPIView):
     permission_classes = [IsAuthenticated]
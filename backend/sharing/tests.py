@@ -1,5 +1,7 @@
-from django.test import TestCase
+from datetime import timedelta
+from django.test import TestCase, override_settings
 from django.contrib.auth import get_user_model
+from django.utils import timezone
 from rest_framework.test import APITestCase
 from rest_framework import status
 from .models import FileShare, ShareLink
@@ -105,3 +107,47 @@ class FileShareTests(APITestCase):
         self.client.force_authenticate(user=unauthorized_user)
         response = self.client.get(f'/api/shares/{share.id}/download/')
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class EndToEndShareTests(APITestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(
+            username='owner',
+            email='owner@example.com',
+            password='ownerpass123'
+        )
+        self.recipient = User.objects.create_user(
+            username='recipient',
+            email='recipient@example.com',
+            password='recipientpass123'
+        )
+        self.file = File.objects.create(
+            owner=self.owner,
+            name='secret.txt',
+            original_name='secret.txt',
+            mime_type='text/plain',
+            size=100,
+            encrypted_path='secret-path',
+            client_encrypted=True,
+            client_key_metadata={'wrapped_key': 'opaque'},
+            checksum='test_checksum'
+        )
+        self.client.force_authenticate(user=self.owner)
+
+    def test_cannot_share_with_user(self):
+        response = self.client.post(f'/api/sharing/files/{self.file.id}/shares/', {
+            'shared_with_email': self.recipient.email,
+            'access_level': 'VIEW'
+        })
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('cannot be shared', str(response.data))
+        self.assertFalse(FileShare.objects.exists())
+
+    def test_cannot_create_share_link(self):
+        response = self.client.post(f'/api/sharing/files/{self.file.id}/share-links/', {
+            'access_level': 'VIEW',
+            'expires_at': (timezone.now() + timedelta(days=1)).isoformat()
+        })
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('cannot be shared', str(response.data))
+        self.assertFalse(ShareLink.objects.exists())
@@ -5,6 +5,7 @@ urlpatterns = [
     # File sharing endpoints
     path('files/<uuid:file_id>/shares/', views.CreateShareView.as_view(), name='create-share'),
     path('files/<uuid:file_id>/shares/list/', views.FileShareListView.as_view(), name='list-shares'),
+    path('shares/download/zip/', views.ShareArchiveDownloadView.as_view(), name='share-archive-download'),
     path('shares/<uuid:pk>/', views.ShareDetailView.as_view(), name='share-detail'),
     path('shares/<uuid:pk>/download/', views.ShareDownloadView.as_view(), name='share-download'),
     path('shares/<uuid:pk>/view/', views.ShareViewView.as_view(), name='share-view'),
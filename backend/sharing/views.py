@@ -3,30 +3,38 @@ from rest_framework import generics, status
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.exceptions import ValidationError
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
 from django.utils.crypto import get_random_string
-from django.http import FileResponse, HttpResponse
 from django.conf import settings
 from django.contrib.auth import get_user_model
-import os
 from .models import FileShare, ShareLink, ShareLinkAccess
 from files.models import File
 from .serializers import FileShareSerializer, ShareLinkSerializer, ShareLinkAccessSerializer
 import secrets
 import hashlib
-import mimetypes
-import tempfile
-from files.utils import decrypt_file
+from files import archive, delivery
+from files.content_cache import invalidate
+from files.utils import parse_id_list
 
 User = get_user_model()
 
+# The key of an end-to-end encrypted file stays in its owner's browser, so
+# nobody the file is shared with could decrypt it
+END_TO_END_SHARE_ERROR = "End-to-end encrypted files cannot be shared"
+
 class CreateShareView(APIView):
     permission_classes = [IsAuthenticated]
     serializer_class = FileShareSerializer
 
     def post(self, request, file_id):
         file = get_object_or_404(File, id=file_id, owner=request.user)
+        if file.client_encrypted:
+            return Response(
+                {"error": END_TO_END_SHARE_ERROR},
+                status=status.HTTP_400_BAD_REQUEST
+            )
         serializer = self.serializer_class(data=request.data)
         
         if not serializer.is_valid():
@@ -101,6 +109,7 @@ class ShareDetailView(generics.RetrieveUpdateDestroyAPIView):
         instance.revoked_at = timezone.now()
         instance.revoked_by = self.request.user
         instance.save()
+        invalidate(instance.file_id)
 
 class ShareLinkListView(generics.ListCreateAPIView):
     permission_classes = [IsAuthenticated]
@@ -120,6 +129,8 @@ class ShareLinkListView(generics.ListCreateAPIView):
 
     def perform_create(self, serializer):
         file = get_object_or_404(File, id=self.kwargs['file_id'], owner=self.request.user)
+        if file.client_encrypted:
+            raise ValidationError({"error": END_TO_END_SHARE_ERROR})
         token = get_random_string(32)
         
         # Hash password if provided
@@ -150,6 +161,7 @@ class ShareLinkDetailView(generics.RetrieveDestroyAPIView):
         instance.revoked_at = timezone.now()
         instance.revoked_by = self.request.user
         instance.save()
+        invalidate(instance.file_id)
 
 class PublicShareLinkView(APIView):
     permission_classes = [AllowAny]
@@ -211,40 +223,13 @@ class PublicShareDownloadView(APIView):
                 status=status.HTTP_403_FORBIDDEN
             )
 
-        # Handle file download logic here
-        relative_path = share_link.file.get_file_path()
-        file_path = os.path.join(settings.MEDIA_ROOT, relative_path)
-        
-        if not os.path.exists(file_path):
+        try:
+            return delivery.deliver_file(request, share_link.file, delivery.ATTACHMENT, cached=True)
+        except delivery.FileNotFoundError:
             return Response(
                 {"error": "File not found"},
                 status=status.HTTP_404_NOT_FOUND
             )
-            
-        try:
-            # Read and decrypt the file
-            with open(file_path, 'rb') as f:
-                encrypted_data = f.read()
-                
-            decrypted_data = decrypt_file(
-                encrypted_data,
-                share_link.file.encryption_key,
-                share_link.file.iv
-            )
-            
-            # Create a temporary file for the decrypted content
-            with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-                temp_file.write(decrypted_data)
-                temp_file_path = temp_file.name
-            
-            try:
-                response = FileResponse(open(temp_file_path, 'rb'))
-                response['Content-Disposition'] = f'attachment; filename="{share_link.file.name}"'
-                return response
-            finally:
-                # Clean up the temporary file
-                os.unlink(temp_file_path)
-                
         except Exception as e:
             return Response(
                 {"error": "Failed to process file"},
@@ -325,51 +310,13 @@ class PublicShareViewView(APIView):
                     status=status.HTTP_403_FORBIDDEN
                 )
 
-        # Handle file viewing logic here
-        relative_path = share_link.file.get_file_path()
-        file_path = os.path.join(settings.MEDIA_ROOT, relative_path)
-        
-        if not os.path.exists(file_path):
+        try:
+            return delivery.deliver_file(request, share_link.file, delivery.INLINE, cached=True)
+        except delivery.FileNotFoundError:
             return Response(
                 {"error": "File not found"},
                 status=status.HTTP_404_NOT_FOUND
             )
-            
-        try:
-            # Read and decrypt the file
-            with open(file_path, 'rb') as f:
-                encrypted_data = f.read()
-            
-            decrypted_data = decrypt_file(
-                encrypted_data,
-                share_link.file.encryption_key,
-                share_link.file.iv
-            )
-            
-            # Create a temporary file for the decrypted content
-            with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-                temp_file.write(decrypted_data)
-                temp_file_path = temp_file.name
-            
-            try:
-                content_type, _ = mimetypes.guess_type(share_link.file.name)
-                if not content_type:
-                    content_type = 'application/octet-stream'
-                    
-                response = FileResponse(
-                    open(temp_file_path, 'rb'),
-                    content_type=content_type
-                )
-
-
-                response['Content-Disposition'] = f'inline; filename="{share_link.file.name}"'
-
-                return response
-            finally:
-                # Clean up the temporary file
-                if os.path.exists(temp_file_path):
-                    os.unlink(temp_file_path)
-                
         except Exception as e:
             print(f"Error in PublicShareViewView: {str(e)}")
             return Response(
@@ -397,55 +344,13 @@ class PublicShareViewOnlyView(APIView):
                     status=status.HTTP_403_FORBIDDEN
                 )
 
-        # Get the file
-        relative_path = share_link.file.get_file_path()
-        file_path = os.path.join(settings.MEDIA_ROOT, relative_path)
-        
-        if not os.path.exists(file_path):
+        try:
+            return delivery.deliver_file(request, share_link.file, delivery.VIEW_ONLY, cached=True)
+        except delivery.FileNotFoundError:
             return Response(
                 {"error": "File not found"},
                 status=status.HTTP_404_NOT_FOUND
             )
-            
-        try:
-            # Read and decrypt the file
-            with open(file_path, 'rb') as f:
-                encrypted_data = f.read()
-                
-            decrypted_data = decrypt_file(
-                encrypted_data,
-                share_link.file.encryption_key,
-                share_link.file.iv
-            )
-            
-            # Create a temporary file for the decrypted content
-            with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-                temp_file.write(decrypted_data)
-                temp_file_path = temp_file.name
-            
-            try:
-                response = FileResponse(
-                    open(temp_file_path, 'rb'),
-                    content_type=share_link.file.mime_type
-                )
-                
-                # Set headers to prevent download
-                response['Content-Disposition'] = 'inline'
-                response['Content-Security-Policy'] = "default-src 'self'; object-src 'none'"
-                response['X-Content-Type-Options'] = 'nosniff'
-                response['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
-                response['Pragma'] = 'no-cache'
-                response['X-Frame-Options'] = 'SAMEORIGIN'
-                
-                # Additional headers to prevent download
-                response['X-Download-Options'] = 'noopen'
-                response['X-Permitted-Cross-Domain-Policies'] = 'none'
-                
-                return response
-            finally:
-                # Clean up the temporary file
-                os.unlink(temp_file_path)
-                
         except Exception as e:
             return Response(
                 {"error": "Failed to process file"},
@@ -467,19 +372,10 @@ class ShareDownloadView(APIView):
         if share.is_expired():
             return Response({"detail": "This share has expired"}, status=status.HTTP_403_FORBIDDEN)
 
-        # Get the file and decrypt it
-        file_obj = share.file
-        relative_path = file_obj.get_file_path()
-        file_path = os.path.join(settings.MEDIA_ROOT, relative_path)
-        
-        if not os.path.exists(file_path):
-            return Response({"detail": "File not found"}, status=status.HTTP_404_NOT_FOUND)
-
-        # Decrypt the file
         try:
-            with open(file_path, 'rb') as f:
-                encrypted_data = f.read()
-            decrypted_data = decrypt_file(encrypted_data, file_obj.encryption_key, file_obj.iv)
+            response = delivery.deliver_file(request, share.file, delivery.ATTACHMENT)
+        except delivery.FileNotFoundError:
+            return Response({"detail": "File not found"}, status=status.HTTP_404_NOT_FOUND)
         except Exception as e:
             return Response({"detail": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -487,12 +383,37 @@ class ShareDownloadView(APIView):
         share.last_accessed = timezone.now()
         share.save()
 
-        # Prepare the response
-        content_type = mimetypes.guess_type(file_obj.name)[0]
-        if not content_type:
-            content_type = 'application/octet-stream'
-        response = HttpResponse(decrypted_data, content_type=content_type)
-        response['Content-Disposition'] = f'attachment; filename="{file_obj.name}"'
+        return response
+
+class ShareArchiveDownloadView(APIView):
+    """
+    Download the files of several shares made to the user, listed in
+    request.data['share_ids'], as one streamed ZIP.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        try:
+            share_ids = parse_id_list(request.data, 'share_ids')
+        except ValueError as e:
+            return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if not 0 < len(share_ids) <= settings.ZIP_DOWNLOAD_MAX_FILES:
+            return Response(
+                {"detail": f"Select between 1 and {settings.ZIP_DOWNLOAD_MAX_FILES} shares"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        shares = FileShare.objects.filter(
+            shared_with=request.user, is_revoked=False, file__is_deleted=False
+        ).select_related('file', 'file__blob').in_bulk(share_ids)
+        if len(shares) != len(share_ids) or any(share.is_expired() for share in shares.values()):
+            return Response({"detail": "You don't have access to these shares"}, status=status.HTTP_403_FORBIDDEN)
+        if any(share.access_level != 'FULL' for share in shares.values()):
+            return Response({"detail": "You don't have download permission"}, status=status.HTTP_403_FORBIDDEN)
+
+        response = archive.zip_download([shares[pk].file for pk in share_ids], 'shared-files.zip')
+        if response.status_code == status.HTTP_200_OK:
+            FileShare.objects.filter(pk__in=share_ids).update(last_accessed_at=timezone.now())
         return response
 
 class ShareViewView(APIView):
@@ -507,19 +428,10 @@ class ShareViewView(APIView):
         if share.is_expired():
             return Response({"detail": "This share has expired"}, status=status.HTTP_403_FORBIDDEN)
 
-        # Get the file and decrypt it
-        file_obj = share.file
-        relative_path = file_obj.get_file_path()
-        file_path = os.path.join(settings.MEDIA_ROOT, relative_path)
-        
-        if not os.path.exists(file_path):
-            return Response({"detail": "File not found"}, status=status.HTTP_404_NOT_FOUND)
-
-        # Decrypt the file
         try:
-            with open(file_path, 'rb') as f:
-                encrypted_data = f.read()
-            decrypted_data = decrypt_file(encrypted_data, file_obj.encryption_key, file_obj.iv)
+            response = delivery.deliver_file(request, share.file, delivery.INLINE)
+        except delivery.FileNotFoundError:
+            return Response({"detail": "File not found"}, status=status.HTTP_404_NOT_FOUND)
         except Exception as e:
             return Response({"detail": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -527,17 +439,6 @@ class ShareViewView(APIView):
         share.last_accessed = timezone.now()
         share.save()
 
-        # Prepare the response
-        content_type = mimetypes.guess_type(file_obj.name)[0]
-        if not content_type:
-            content_type = 'application/octet-stream'
-        response = HttpResponse(decrypted_data, content_type=content_type)
-        response['Content-Disposition'] = f'inline; filename="{file_obj.name}"'
-        
-        # Add security headers for full access
-        response['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
-        response['Pragma'] = 'no-cache'
-        response['X-Content-Type-Options'] = 'nosniff'
         return response
 
 class ShareViewOnlyView(APIView):
@@ -552,19 +453,10 @@ class ShareViewOnlyView(APIView):
         if share.is_expired():
             return Response({"detail": "This share has expired"}, status=status.HTTP_403_FORBIDDEN)
 
-        # Get the file and decrypt it
-        file_obj = share.file
-        relative_path = file_obj.get_file_path()
-        file_path = os.path.join(settings.MEDIA_ROOT, relative_path)
-        
-        if not os.path.exists(file_path):
-            return Response({"detail": "File not found"}, status=status.HTTP_404_NOT_FOUND)
-
-        # Decrypt the file
         try:
-            with open(file_path, 'rb') as f:
-                encrypted_data = f.read()
-            decrypted_data = decrypt_file(encrypted_data, file_obj.encryption_key, file_obj.iv)
+            response = delivery.deliver_file(request, share.file, delivery.VIEW_ONLY)
+        except delivery.FileNotFoundError:
+            return Response({"detail": "File not found"}, status=status.HTTP_404_NOT_FOUND)
         except Exception as e:
             return Response({"detail": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -572,19 +464,4 @@ class ShareViewOnlyView(APIView):
         share.last_accessed = timezone.now()
         share.save()
 
-        # Prepare the response
-        content_type = mimetypes.guess_type(file_obj.name)[0]
-        if not content_type:
-            content_type = 'application/octet-stream'
-        response = HttpResponse(decrypted_data, content_type=content_type)
-        response['Content-Disposition'] = f'inline; filename="{file_obj.name}"'
-        
-        # Add security headers for view-only access
-        response['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
-        response['Pragma'] = 'no-cache'
-        response['X-Content-Type-Options'] = 'nosniff'
-        response['Content-Security-Policy'] = "default-src 'self'; object-src 'none'"
-        response['X-Frame-Options'] = 'SAMEORIGIN'
-        response['X-Download-Options'] = 'noopen'
-        response['X-Permitted-Cross-Domain-Policies'] = 'none'
         return response
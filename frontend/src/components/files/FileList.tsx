@@ -222,14 +222,25 @@ export const FileList = ({ files: propFiles, showUploadButton = true }: FileList
                         <Download className="mr-2 h-4 w-4" />
                         Download
                       </DropdownMenuItem>
-                      <DropdownMenuItem onClick={() => handleShare(file.id)}>
+                      <DropdownMenuItem
+                        onClick={() => handleShare(file.id)}
+                        disabled={file.client_encrypted}
+                      >
                         <Share2 className="mr-2 h-4 w-4" />
                         Share with User
                       </DropdownMenuItem>
-                      <DropdownMenuItem onClick={() => handleCreateShareLink(file.id)}>
+                      <DropdownMenuItem
+                        onClick={() => handleCreateShareLink(file.id)}
+                        disabled={file.client_encrypted}
+                      >
                         <LinkIcon className="mr-2 h-4 w-4" />
                         Create Share Link
                       </DropdownMenuItem>
+                      {file.client_encrypted && (
+                        <p className="px-2 py-1.5 text-xs text-muted-foreground">
+                          End-to-end encrypted files cannot be shared
+                        </p>
+                      )}
                       <DropdownMenuSeparator />
                       <DropdownMenuItem onClick={() => handleDelete(file.id)} className="text-red-600">
                         <Trash className="mr-2 h-4 w-4" />
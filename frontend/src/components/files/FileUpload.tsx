@@ -1,8 +1,10 @@
 import { useState, useCallback } from "react";
 import { useNavigate } from "react-router-dom";
 import { useDropzone } from "react-dropzone";
-import { useFiles } from "@/hooks/useFiles";
+import { useFiles, END_TO_END_ENCRYPTION } from "@/hooks/useFiles";
 import { Button } from "@/components/ui/button";
+import { Checkbox } from "@/components/ui/checkbox";
+import { Label } from "@/components/ui/label";
 import { Progress } from "@/components/ui/progress";
 import { Upload, X, Info } from "lucide-react";
 import { useToast } from "@/hooks/use-toast";
@@ -28,6 +30,7 @@ export const FileUpload = () => {
   const [uploadProgress, setUploadProgress] = useState(0);
   const [selectedFile, setSelectedFile] = useState<File | null>(null);
   const [isUploading, setIsUploading] = useState(false);
+  const [endToEnd, setEndToEnd] = useState(false);
   const { uploadFile, listFiles } = useFiles({
     onError: (error) => {
       toast({
@@ -58,7 +61,7 @@ export const FileUpload = () => {
       setIsUploading(true);
       const result = await uploadFile(selectedFile, (progress) => {
         setUploadProgress(progress);
-      });
+      }, { endToEnd });
 
       if (result) {
         await listFiles();
@@ -127,6 +130,24 @@ export const FileUpload = () => {
         )}
       </div>
 
+      {END_TO_END_ENCRYPTION && (
+        <div className="space-y-1">
+          <div className="flex items-center space-x-2">
+            <Checkbox
+              id="end-to-end"
+              checked={endToEnd}
+              onCheckedChange={(checked) => setEndToEnd(checked === true)}
+              disabled={isUploading}
+            />
+            <Label htmlFor="end-to-end">Encrypt end-to-end</Label>
+          </div>
+          <p className="text-sm text-muted-foreground">
+            The key stays in this browser: the file can only be downloaded
+            here and cannot be shared.
+          </p>
+        </div>
+      )}
+
       <div className="flex items-center space-x-4">
         <Popover>
           <PopoverTrigger asChild>
@@ -66,9 +66,9 @@ export const FileVersion = ({ fileId, fileName }: FileVersionProps) => {
     loadVersions();
   }, [fileId, isOpen, getFileVersions]);
 
-  const handleDownloadVersion = async (versionId: string) => {
+  const handleDownloadVersion = async (versionNumber: number) => {
     try {
-      await downloadVersion(fileId, versionId);
+      await downloadVersion(fileId, versionNumber);
       toast({
         title: "Success",
         description: "Version downloaded successfully",
@@ -133,7 +133,7 @@ export const FileVersion = ({ fileId, fileName }: FileVersionProps) => {
                   <Button
                     variant="ghost"
                     size="sm"
-                    onClick={() => handleDownloadVersion(version.id)}
+                    onClick={() => handleDownloadVersion(version.version_number)}
                   >
                     <Download className="h-4 w-4" />
                   </Button>
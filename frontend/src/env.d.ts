@@ -6,6 +6,7 @@ interface ImportMetaEnv {
   readonly VITE_MAX_FILE_SIZE: string
   readonly VITE_ENABLE_MFA: string
   readonly VITE_ENABLE_FILE_ENCRYPTION: string
+  readonly VITE_ENABLE_E2E_ENCRYPTION: string
   readonly VITE_ENCRYPTION_ALGORITHM: string
   readonly VITE_KEY_LENGTH: string
   readonly VITE_IV_LENGTH: string
@@ -1,9 +1,24 @@
 import { useState, useCallback } from 'react';
 import api from '@/utils/api';
+import { contentDefinedChunks } from '@/utils/dedup';
+import { computeDelta, VersionSignature } from '@/utils/delta';
+import { ClientKeyMetadata, decryptDownload, encryptForUpload } from '@/utils/encryption';
 import { useAppDispatch } from './useAppDispatch';
 import { useAppSelector } from './useAppSelector';
 
 const API_BASE_URL = '/api/files/';
+const MAX_CHUNK_ATTEMPTS = 3;
+const PARALLEL_CHUNK_UPLOADS = 4;
+const SMALL_UPLOAD_MAX_SIZE = 4 * 1024 * 1024; // Matches the server's SMALL_UPLOAD_MAX_SIZE
+// End-to-end encryption is offered per upload only where this is enabled;
+// the key lives in the browser, so such files cannot be shared
+export const END_TO_END_ENCRYPTION = import.meta.env.VITE_ENABLE_E2E_ENCRYPTION === 'true';
+
+// Status endpoints answer at once and send Retry-After while work is pending
+const waitBeforeRetry = (headers: Record<string, unknown>) => {
+  const seconds = Number(headers['retry-after']) || 1;
+  return new Promise(resolve => setTimeout(resolve, seconds * 1000));
+};
 
 export interface FileMetadata {
   id: string;
@@ -22,6 +37,8 @@ export interface FileMetadata {
   description: string;
   tags: string[];
   metadata: Record<string, any>;
+  client_encrypted: boolean;
+  client_key_metadata: ClientKeyMetadata | Record<string, never>;
   modified_at: string | null;
   owner?: {
     id: string;
@@ -46,6 +63,13 @@ export interface FileMetadata {
   };
 }
 
+export interface UploadStatusResponse {
+  id: string;
+  status: FileMetadata['status'];
+  file?: FileMetadata;
+  error?: string;
+}
+
 export interface UploadChunkResponse {
   id: string;
   chunk_number: number;
@@ -54,6 +78,25 @@ export interface UploadChunkResponse {
   status: string;
 }
 
+export interface BulkJob {
+  id: string;
+  operation: 'COPY' | 'MOVE' | 'DELETE';
+  status: 'PENDING' | 'RUNNING' | 'COMPLETED';
+  total: number;
+  processed: number;
+  succeeded: number;
+  failed: number;
+  // Only sent when asked for with ?items=1
+  items?: Array<{
+    file_id: string;
+    status: 'PENDING' | 'SUCCEEDED' | 'FAILED';
+    result_file_id: string | null;
+    error: string;
+  }>;
+  created_at: string;
+  completed_at: string | null;
+}
+
 interface UseFilesOptions {
   onError?: (error: Error) => void;
 }
@@ -153,19 +196,59 @@ export const useFiles = (options: UseFilesOptions = {}) => {
     }
   }, [handleError]);
 
-  const uploadFile = useCallback(async (file: File, onProgress?: (progress: number) => void) => {
+  const uploadFile = useCallback(async (
+    plainFile: File,
+    onProgress?: (progress: number) => void,
+    { endToEnd = false }: { endToEnd?: boolean } = {}
+  ) => {
     try {
       setLoading(true);
       // Validate file before starting upload
-      validateFileType(file);
-      validateFileSize(file);
+      validateFileType(plainFile);
+      validateFileSize(plainFile);
+
+      // An end-to-end upload sends the server only ciphertext and the
+      // wrapped file key
+      let file = plainFile;
+      let keyMetadata: ClientKeyMetadata | null = null;
+      if (END_TO_END_ENCRYPTION && endToEnd) {
+        const encrypted = await encryptForUpload(plainFile);
+        file = new File([encrypted.encryptedBlob], plainFile.name, { type: plainFile.type });
+        keyMetadata = encrypted.keyMetadata;
+      }
+
+      // Small files go up in a single request
+      if (file.size <= SMALL_UPLOAD_MAX_SIZE) {
+        const formData = new FormData();
+        formData.append('file', file);
+        formData.append('mime_type', file.type);
+        if (keyMetadata) {
+          formData.append('client_encrypted', 'true');
+          formData.append('client_key_metadata', JSON.stringify(keyMetadata));
+        }
+        const uploadResponse = await api.post<FileMetadata>(
+          `${API_BASE_URL}/upload/`,
+          formData,
+          {
+            headers: {
+              'Content-Type': 'multipart/form-data'
+            }
+          }
+        );
+        onProgress?.(100);
+        console.log('Upload completed successfully:', uploadResponse.data);
+        return uploadResponse.data;
+      }
 
       // Initialize upload
       console.log('Initializing upload...');
+      const chunkSize = 1024 * 1024; // 1MB chunks
       const initResponse = await api.post<FileMetadata>(`${API_BASE_URL}/upload/initialize/`, {
         name: file.name,
         mime_type: file.type,
-        size: file.size
+        size: file.size,
+        chunk_size: chunkSize,
+        ...(keyMetadata && { client_encrypted: true, client_key_metadata: keyMetadata })
       });
 
       if (!initResponse.data?.id) {
@@ -173,48 +256,82 @@ export const useFiles = (options: UseFilesOptions = {}) => {
       }
 
       const fileId = initResponse.data.id;
-      const chunkSize = 1024 * 1024; // 1MB chunks
       const totalChunks = Math.ceil(file.size / chunkSize);
       console.log('Upload details:', { chunkSize, totalChunks });
 
-      // Upload chunks
-      for (let chunk = 0; chunk < totalChunks; chunk++) {
+      const uploadChunk = async (chunk: number) => {
         const start = chunk * chunkSize;
         const end = Math.min(start + chunkSize, file.size);
         const chunkBlob = file.slice(start, end);
 
-        const formData = new FormData();
-        formData.append('chunk', chunkBlob);
-        formData.append('chunk_number', chunk.toString());
-
         console.log(`Uploading chunk ${chunk + 1}/${totalChunks}`);
-        const chunkResponse = await api.post<UploadChunkResponse>(
-          `${API_BASE_URL}/upload/${fileId}/chunk/`,
-          formData,
-          {
-            headers: {
-              'Content-Type': 'multipart/form-data'
+        // Send the chunk as a raw body so the server can stream it to
+        // storage without parsing multipart. Re-sending a chunk the server
+        // already has is harmless, so a dropped request can simply be retried
+        for (let attempt = 1; ; attempt++) {
+          try {
+            const chunkResponse = await api.put<UploadChunkResponse>(
+              `${API_BASE_URL}/upload/${fileId}/chunk/raw/`,
+              chunkBlob,
+              {
+                headers: {
+                  'Content-Type': 'application/octet-stream',
+                  'X-Chunk-Index': chunk.toString(),
+                  'X-Chunk-Offset': start.toString()
+                }
+              }
+            );
+            console.log(`Chunk ${chunk + 1} uploaded:`, chunkResponse.data);
+            return;
+          } catch (chunkError) {
+            if (attempt >= MAX_CHUNK_ATTEMPTS) {
+              throw chunkError;
             }
+            console.warn(`Chunk ${chunk + 1} failed, retrying (attempt ${attempt + 1})`);
+            await new Promise(resolve => setTimeout(resolve, 1000 * attempt));
           }
-        );
-
-        console.log(`Chunk ${chunk + 1} uploaded:`, chunkResponse.data);
-
-        if (onProgress) {
-          const progress = ((chunk + 1) / totalChunks) * 100;
-          console.log(`Upload progress: ${progress.toFixed(1)}%`);
-          onProgress(progress);
         }
-      }
+      };
+
+      // Upload chunks over several parallel streams; the server accepts
+      // them in any order
+      let nextChunk = 0;
+      let uploadedChunks = 0;
+      const uploadWorker = async () => {
+        while (nextChunk < totalChunks) {
+          const chunk = nextChunk++;
+          await uploadChunk(chunk);
+          uploadedChunks++;
+
+          if (onProgress) {
+            const progress = (uploadedChunks / totalChunks) * 100;
+            console.log(`Upload progress: ${progress.toFixed(1)}%`);
+            onProgress(progress);
+          }
+        }
+      };
+      await Promise.all(
+        Array.from({ length: Math.min(PARALLEL_CHUNK_UPLOADS, totalChunks) }, uploadWorker)
+      );
 
-      // Complete upload
+      // Complete upload; the server finalizes it in the background
       console.log('Completing upload...');
-      const completeResponse = await api.post<FileMetadata>(
-        `${API_BASE_URL}/upload/${fileId}/complete/`
-      );
+      await api.post<FileMetadata>(`${API_BASE_URL}/upload/${fileId}/complete/`);
 
-      console.log('Upload completed successfully:', completeResponse.data);
-      return completeResponse.data;
+      // Poll until finalization finishes
+      for (;;) {
+        const statusResponse = await api.get<UploadStatusResponse>(
+          `${API_BASE_URL}/upload/${fileId}/status/`
+        );
+        if (statusResponse.data.status === 'COMPLETED' && statusResponse.data.file) {
+          console.log('Upload completed successfully:', statusResponse.data.file);
+          return statusResponse.data.file;
+        }
+        if (statusResponse.data.status === 'FAILED') {
+          throw new Error(statusResponse.data.error || 'Failed to finalize file upload');
+        }
+        await waitBeforeRetry(statusResponse.headers);
+      }
     } catch (err) {
       console.error('File upload error:', err);
       const error = err as Error;
@@ -231,6 +348,75 @@ export const useFiles = (options: UseFilesOptions = {}) => {
     }
   }, [handleError]);
 
+  // Upload a file as content-defined chunks, sending only the chunks the
+  // server does not already hold for this account. Uploading the same
+  // document again, or a lightly edited one, sends little or nothing
+  const uploadFileDeduplicated = useCallback(async (file: File, onProgress?: (progress: number) => void) => {
+    try {
+      setLoading(true);
+      validateFileType(file);
+      validateFileSize(file);
+
+      const chunks = await contentDefinedChunks(file);
+      const hashes = chunks.map(chunk => chunk.hash);
+      const { data: query } = await api.post<{ have: string[] }>(
+        `${API_BASE_URL}upload/dedup/query/`,
+        { hashes }
+      );
+      // Send each missing chunk once, even if it repeats within the file
+      const have = new Set(query.have);
+      const missing = chunks.filter(chunk => {
+        if (have.has(chunk.hash)) {
+          return false;
+        }
+        have.add(chunk.hash);
+        return true;
+      });
+      console.log(`Deduplicated upload: sending ${missing.length} of ${chunks.length} chunks`);
+
+      let nextChunk = 0;
+      let sent = 0;
+      const uploadWorker = async () => {
+        while (nextChunk < missing.length) {
+          const chunk = missing[nextChunk++];
+          for (let attempt = 1; ; attempt++) {
+            try {
+              await api.put(
+                `${API_BASE_URL}upload/dedup/chunks/${chunk.hash}/`,
+                file.slice(chunk.start, chunk.end),
+                { headers: { 'Content-Type': 'application/octet-stream' } }
+              );
+              break;
+            } catch (chunkError) {
+              if (attempt >= MAX_CHUNK_ATTEMPTS) {
+                throw chunkError;
+              }
+              await new Promise(resolve => setTimeout(resolve, 1000 * attempt));
+            }
+          }
+          sent++;
+          onProgress?.((sent / missing.length) * 100);
+        }
+      };
+      await Promise.all(
+        Array.from({ length: Math.min(PARALLEL_CHUNK_UPLOADS, missing.length) }, uploadWorker)
+      );
+
+      const response = await api.post<FileMetadata>(`${API_BASE_URL}upload/dedup/complete/`, {
+        name: file.name,
+        mime_type: file.type,
+        chunks: hashes
+      });
+      onProgress?.(100);
+      return response.data;
+    } catch (err) {
+      handleError(err as Error);
+      return null;
+    } finally {
+      setLoading(false);
+    }
+  }, [handleError]);
+
   const downloadFile = useCallback(async (fileId: string) => {
     try {
       setLoading(true);
@@ -243,8 +429,17 @@ export const useFiles = (options: UseFilesOptions = {}) => {
       const filenameMatch = contentDisposition?.match(/filename="(.+)"/);
       const filename = filenameMatch ? filenameMatch[1] : 'download';
 
+      // End-to-end encrypted files arrive exactly as uploaded
+      let content = new Blob([response.data]);
+      if (END_TO_END_ENCRYPTION) {
+        const { data: metadata } = await api.get<FileMetadata>(`${API_BASE_URL}/${fileId}/`);
+        if (metadata.client_encrypted) {
+          content = await decryptDownload(content, metadata.client_key_metadata as ClientKeyMetadata);
+        }
+      }
+
       // Create download link
-      const url = window.URL.createObjectURL(new Blob([response.data]));
+      const url = window.URL.createObjectURL(content);
       const link = document.createElement('a');
       link.href = url;
       link.setAttribute('download', filename);
@@ -319,18 +514,32 @@ export const useFiles = (options: UseFilesOptions = {}) => {
     }
   }, [handleError]);
 
+  // Bulk operations run as background jobs; poll until the job finishes
+  const runBulkJob = useCallback(async (operation: string, body: Record<string, unknown>) => {
+    const response = await api.post<BulkJob>(`${API_BASE_URL}/bulk/${operation}/`, body);
+    let job = response.data;
+    let headers: Record<string, unknown> = response.headers;
+    while (job.status !== 'COMPLETED') {
+      await waitBeforeRetry(headers);
+      const statusResponse = await api.get<BulkJob>(`${API_BASE_URL}/bulk/jobs/${job.id}/`);
+      job = statusResponse.data;
+      headers = statusResponse.headers;
+    }
+    return job;
+  }, []);
+
   const bulkDelete = useCallback(async (fileIds: string[]) => {
     try {
       setLoading(true);
-      await api.post(`${API_BASE_URL}/bulk/delete/`, { file_ids: fileIds });
-      return true;
+      const job = await runBulkJob('delete', { file_ids: fileIds });
+      return job.failed === 0;
     } catch (err) {
       handleError(err as Error);
       return false;
     } finally {
       setLoading(false);
     }
-  }, [handleError]);
+  }, [handleError, runBulkJob]);
 
   const bulkMove = useCallback(async (
     files: { id: string; newName: string }[]
@@ -341,33 +550,54 @@ export const useFiles = (options: UseFilesOptions = {}) => {
       const newNames = Object.fromEntries(
         files.map(f => [f.id, f.newName])
       );
-      const response = await api.post<FileMetadata[]>(
-        `${API_BASE_URL}/bulk/move/`,
-        { file_ids: fileIds, new_names: newNames }
-      );
-      return response.data;
+      return await runBulkJob('move', { file_ids: fileIds, new_names: newNames });
     } catch (err) {
       handleError(err as Error);
       return null;
     } finally {
       setLoading(false);
     }
-  }, [handleError]);
+  }, [handleError, runBulkJob]);
 
   const bulkCopy = useCallback(async (fileIds: string[]) => {
     try {
       setLoading(true);
-      const response = await api.post<FileMetadata[]>(
-        `${API_BASE_URL}/bulk/copy/`,
-        { file_ids: fileIds }
-      );
-      return response.data;
+      return await runBulkJob('copy', { file_ids: fileIds });
     } catch (err) {
       handleError(err as Error);
       return null;
     } finally {
       setLoading(false);
     }
+  }, [handleError, runBulkJob]);
+
+  // Download several files as one ZIP, which the server builds as it
+  // streams it
+  const downloadFilesAsZip = useCallback(async (fileIds: string[]) => {
+    try {
+      setLoading(true);
+      const response = await api.post<Blob>(
+        `${API_BASE_URL}/download/zip/`,
+        { file_ids: fileIds },
+        { responseType: 'blob' }
+      );
+
+      const url = window.URL.createObjectURL(new Blob([response.data], { type: 'application/zip' }));
+      const link = document.createElement('a');
+      link.href = url;
+      link.setAttribute('download', 'files.zip');
+      document.body.appendChild(link);
+      link.click();
+      link.remove();
+      window.URL.revokeObjectURL(url);
+
+      return true;
+    } catch (err) {
+      handleError(err instanceof Error ? err : new Error('Download failed'));
+      return false;
+    } finally {
+      setLoading(false);
+    }
   }, [handleError]);
 
   const searchFiles = useCallback(async (query: string) => {
@@ -432,9 +662,9 @@ export const useFiles = (options: UseFilesOptions = {}) => {
     }
   };
 
-  const downloadVersion = async (fileId: string, versionId: string): Promise<void> => {
+  const downloadVersion = async (fileId: string, versionNumber: number): Promise<void> => {
     try {
-      const response = await api.get<Blob>(`/files/${fileId}/versions/${versionId}/download`, {
+      const response = await api.get<Blob>(`${API_BASE_URL}${fileId}/versions/${versionNumber}/download/`, {
         responseType: 'blob'
       });
       
@@ -452,6 +682,39 @@ export const useFiles = (options: UseFilesOptions = {}) => {
     }
   };
 
+  // Upload new content for an existing file, sending only the blocks the
+  // server does not already have. If another version lands in between,
+  // the server answers 409 and we retry against the fresh signature
+  const uploadNewVersion = async (fileId: string, file: File, comment = ''): Promise<FileVersionData> => {
+    const data = new Uint8Array(await file.arrayBuffer());
+    for (let attempt = 1; ; attempt++) {
+      try {
+        const { data: signature } = await api.get<VersionSignature>(
+          `${API_BASE_URL}${fileId}/versions/signature/`
+        );
+        const delta = new Blob(await computeDelta(signature, data));
+        const response = await api.put<FileVersionData>(
+          `${API_BASE_URL}${fileId}/versions/upload/`,
+          delta,
+          {
+            params: { comment },
+            headers: {
+              'Content-Type': 'application/octet-stream',
+              'X-Base-Version': signature.version.toString()
+            }
+          }
+        );
+        return response.data;
+      } catch (error) {
+        if (attempt < MAX_CHUNK_ATTEMPTS && (error as { response?: { status?: number } }).response?.status === 409) {
+          continue;
+        }
+        handleError(error instanceof Error ? error : new Error('Failed to upload new version'));
+        throw error;
+      }
+    }
+  };
+
   const viewFile = useCallback(async (fileId: string) => {
     try {
       const response = await api.get<Blob>(`${API_BASE_URL}${fileId}/content/`, {
@@ -471,10 +734,15 @@ export const useFiles = (options: UseFilesOptions = {}) => {
     viewFile,
     getFile,
     uploadFile,
+    uploadFileDeduplicated,
     downloadFile,
+    downloadFilesAsZip,
     deleteFile,
     getTrash,
     restoreFile,
+    getFileVersions,
+    downloadVersion,
+    uploadNewVersion,
     loading,
     error,
   };
@@ -0,0 +1,81 @@
+/**
+ * Content-defined chunking for deduplicated uploads (see files/dedup.py on
+ * the server, whose reference chunker this matches). Boundaries fall where
+ * a rolling gear hash of the content has its low bits all zero, so the
+ * same data is cut into the same chunks wherever it appears.
+ */
+
+const CHUNK_MIN_SIZE = 16 * 1024;
+const CHUNK_AVG_SIZE = 64 * 1024;
+const CHUNK_MAX_SIZE = 256 * 1024;
+const READ_SIZE = 4 * 1024 * 1024;
+
+export interface ContentChunk {
+  start: number;
+  end: number;
+  hash: string;
+}
+
+const toHex = (digest: ArrayBuffer): string =>
+  Array.from(new Uint8Array(digest))
+    .map(byte => byte.toString(16).padStart(2, '0'))
+    .join('');
+
+export const sha256Hex = async (data: BufferSource): Promise<string> =>
+  toHex(await window.crypto.subtle.digest('SHA-256', data));
+
+let gearTable: Promise<Uint32Array> | null = null;
+
+const gear = (): Promise<Uint32Array> => {
+  gearTable ??= (async () => {
+    const table = new Uint32Array(256);
+    for (let i = 0; i < 256; i++) {
+      const digest = await window.crypto.subtle.digest('SHA-256', new Uint8Array([i]));
+      table[i] = new DataView(digest).getUint32(0);
+    }
+    return table;
+  })();
+  return gearTable;
+};
+
+/**
+ * Cut a file into content-defined chunks, hashing each with SHA-256.
+ * The file is read a few megabytes at a time.
+ */
+export const contentDefinedChunks = async (file: Blob): Promise<ContentChunk[]> => {
+  const table = await gear();
+  const mask = CHUNK_AVG_SIZE - 1;
+  const chunks: ContentChunk[] = [];
+  let buffer = new Uint8Array(0);
+  let bufferStart = 0;
+  let readOffset = 0;
+
+  while (readOffset < file.size || buffer.length) {
+    // Keep at least one maximum-size chunk buffered until the end
+    while (buffer.length < CHUNK_MAX_SIZE && readOffset < file.size) {
+      const next = new Uint8Array(await file.slice(readOffset, readOffset + READ_SIZE).arrayBuffer());
+      const joined = new Uint8Array(buffer.length + next.length);
+      joined.set(buffer);
+      joined.set(next, buffer.length);
+      buffer = joined;
+      readOffset += next.length;
+    }
+
+    const end = Math.min(CHUNK_MAX_SIZE, buffer.length);
+    let position = Math.min(CHUNK_MIN_SIZE, end);
+    let h = 0;
+    while (position < end) {
+      h = ((h << 1) + table[buffer[position]]) >>> 0;
+      position++;
+      if (!(h & mask)) {
+        break;
+      }
+    }
+
+    const chunk = buffer.subarray(0, position);
+    chunks.push({ start: bufferStart, end: bufferStart + position, hash: await sha256Hex(chunk) });
+    buffer = buffer.slice(position);
+    bufferStart += position;
+  }
+  return chunks;
+};
@@ -0,0 +1,148 @@
+/**
+ * Client side of delta version uploads (see files/delta.py on the server).
+ *
+ * The server sends a signature of the file's current version: a weak
+ * rolling checksum and a strong hash per block. We slide a window over the
+ * new content and refer to any block the server already has instead of
+ * sending it. The result is a stream of operations:
+ *
+ *   COPY     0x00 | offset (u64) | length (u64)
+ *   LITERAL  0x01 | length (u64) | data
+ */
+
+export interface VersionSignature {
+  version: number;
+  size: number;
+  checksum: string;
+  block_size: number;
+  blocks: [number, string][];
+}
+
+const COPY = 0;
+const LITERAL = 1;
+const MOD = 1 << 16;
+
+const strongHash = async (block: Uint8Array): Promise<string> => {
+  const digest = await window.crypto.subtle.digest('SHA-256', block);
+  return Array.from(new Uint8Array(digest).slice(0, 16))
+    .map(byte => byte.toString(16).padStart(2, '0'))
+    .join('');
+};
+
+const weakParts = (block: Uint8Array): [number, number] => {
+  let a = 0;
+  let b = 0;
+  for (let i = 0; i < block.length; i++) {
+    a += block[i];
+    b += (block.length - i) * block[i];
+  }
+  return [a % MOD, b % MOD];
+};
+
+const weakChecksum = (block: Uint8Array): number => {
+  const [a, b] = weakParts(block);
+  return (a + b * MOD) >>> 0;
+};
+
+const header = (op: number, first: number, second?: number): Uint8Array => {
+  const out = new Uint8Array(second === undefined ? 9 : 17);
+  const view = new DataView(out.buffer);
+  out[0] = op;
+  view.setBigUint64(1, BigInt(first));
+  if (second !== undefined) {
+    view.setBigUint64(9, BigInt(second));
+  }
+  return out;
+};
+
+/**
+ * Compute the delta from the content a signature describes to data.
+ * Returns the parts of the request body, ready to wrap in a Blob.
+ */
+export const computeDelta = async (
+  signature: VersionSignature,
+  data: Uint8Array
+): Promise<BlobPart[]> => {
+  const blockSize = signature.block_size;
+  const fullBlocks = Math.floor(signature.size / blockSize);
+  const index = new Map<number, [string, number][]>();
+  signature.blocks.slice(0, fullBlocks).forEach(([weak, strong], number) => {
+    const entries = index.get(weak) ?? [];
+    entries.push([strong, number]);
+    index.set(weak, entries);
+  });
+
+  const parts: BlobPart[] = [];
+  let pendingCopy: [number, number] | null = null;
+  const flushCopy = () => {
+    if (pendingCopy) {
+      parts.push(header(COPY, pendingCopy[0], pendingCopy[1]));
+      pendingCopy = null;
+    }
+  };
+  const emitCopy = (offset: number, length: number) => {
+    if (pendingCopy && pendingCopy[0] + pendingCopy[1] === offset) {
+      pendingCopy[1] += length;
+    } else {
+      flushCopy();
+      pendingCopy = [offset, length];
+    }
+  };
+  const emitLiteral = (start: number, end: number) => {
+    if (end > start) {
+      flushCopy();
+      parts.push(header(LITERAL, end - start), data.slice(start, end));
+    }
+  };
+
+  let position = 0;
+  let literalStart = 0;
+  let a = 0;
+  let b = 0;
+  let fresh = true;
+  while (position + blockSize <= data.length) {
+    const window = data.subarray(position, position + blockSize);
+    if (fresh) {
+      [a, b] = weakParts(window);
+      fresh = false;
+    }
+    let match: number | null = null;
+    for (const [strong, number] of index.get((a + b * MOD) >>> 0) ?? []) {
+      if (strong === await strongHash(window)) {
+        match = number;
+        break;
+      }
+    }
+    if (match !== null) {
+      emitLiteral(literalStart, position);
+      emitCopy(match * blockSize, blockSize);
+      position += blockSize;
+      literalStart = position;
+      fresh = true;
+      continue;
+    }
+    // Roll the window one byte forward
+    if (position + blockSize < data.length) {
+      const out = data[position];
+      a = (a - out + data[position + blockSize] + MOD) % MOD;
+      b = (((b - blockSize * out + a) % MOD) + MOD) % MOD;
+    }
+    position++;
+  }
+
+  // A short final block can only match at the very end
+  const tail = signature.size - fullBlocks * blockSize;
+  if (tail && signature.blocks.length > fullBlocks && data.length - literalStart >= tail) {
+    const [weak, strong] = signature.blocks[fullBlocks];
+    const end = data.subarray(data.length - tail);
+    if (weak === weakChecksum(end) && strong === await strongHash(end)) {
+      emitLiteral(literalStart, data.length - tail);
+      emitCopy(fullBlocks * blockSize, tail);
+      flushCopy();
+      return parts;
+    }
+  }
+  emitLiteral(literalStart, data.length);
+  flushCopy();
+  return parts;
+};
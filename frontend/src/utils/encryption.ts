@@ -105,4 +105,68 @@ export const decryptFile = async (encryptedBlob: Blob, keyStr: string): Promise<
   const encryptedData = await encryptedBlob.arrayBuffer();
   const decryptedData = await decryptData(encryptedData, key);
   return new Blob([decryptedData]);
-}; 
\ No newline at end of file
+}; 
+export interface ClientKeyMetadata {
+  alg: 'AES-GCM';
+  wrap: 'AES-KW';
+  wrapped_key: string;
+}
+
+const ACCOUNT_KEY_STORAGE = 'file_account_key';
+
+/**
+ * The key that wraps every per-file key. It never leaves the browser, so
+ * the server only ever sees wrapped keys and ciphertext.
+ */
+const accountKey = async (): Promise<CryptoKey> => {
+  let stored = localStorage.getItem(ACCOUNT_KEY_STORAGE);
+  if (!stored) {
+    stored = Buffer.from(window.crypto.getRandomValues(new Uint8Array(32))).toString('base64');
+    localStorage.setItem(ACCOUNT_KEY_STORAGE, stored);
+  }
+  return await window.crypto.subtle.importKey(
+    'raw',
+    Buffer.from(stored, 'base64'),
+    'AES-KW',
+    false,
+    ['wrapKey', 'unwrapKey']
+  );
+};
+
+/**
+ * Encrypts a file for end-to-end storage, returning the ciphertext and the
+ * metadata (the file key wrapped under the account key) the server keeps
+ * alongside it
+ */
+export const encryptForUpload = async (
+  input: Blob
+): Promise<{ encryptedBlob: Blob; keyMetadata: ClientKeyMetadata }> => {
+  const key = await generateKey();
+  const encryptedBlob = new Blob([await encryptData(await input.arrayBuffer(), key)], {
+    type: 'application/octet-stream',
+  });
+  const wrapped = await window.crypto.subtle.wrapKey('raw', key, await accountKey(), 'AES-KW');
+  return {
+    encryptedBlob,
+    keyMetadata: { alg: 'AES-GCM', wrap: 'AES-KW', wrapped_key: Buffer.from(wrapped).toString('base64') },
+  };
+};
+
+/**
+ * Decrypts a downloaded end-to-end encrypted file using its key metadata
+ */
+export const decryptDownload = async (
+  encryptedBlob: Blob,
+  keyMetadata: ClientKeyMetadata
+): Promise<Blob> => {
+  const key = await window.crypto.subtle.unwrapKey(
+    'raw',
+    Buffer.from(keyMetadata.wrapped_key, 'base64'),
+    await accountKey(),
+    'AES-KW',
+    'AES-GCM',
+    false,
+    ['decrypt']
+  );
+  return new Blob([await decryptData(await encryptedBlob.arrayBuffer(), key)]);
+};